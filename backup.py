@@ -0,0 +1,322 @@
+import errno
+import json
+import logging
+import os
+import shutil
+import tarfile
+import time
+import concurrent.futures
+
+"""
+backup.py copies raw bcl run directories to the backup directory.
+
+Runs are made of tens of thousands of small files, so files are copied
+by a pool of threads, and the data is copied in the kernel with
+copy_file_range (or sendfile) where available.
+
+Alternatively, runs can be backed up as a few large tar archives written
+sequentially, with an index for extracting single files. These are much
+faster to write and delete on the RAID than many small files.
+"""
+
+# Bytes copied by each system call
+COPY_CHUNK_SIZE = 64 * 1024**2
+
+# Smaller chunks keep a throttled copy smooth
+THROTTLED_CHUNK_SIZE = 4 * 1024**2
+
+# Errors that mean a kernel copy is not supported for these files
+UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                      errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+def _copy_file_range(infd, outfd, count, offset):
+    return os.copy_file_range(infd, outfd, count, offset, offset)
+
+
+def _sendfile(infd, outfd, count, offset):
+    os.lseek(outfd, offset, os.SEEK_SET)
+    return os.sendfile(outfd, infd, offset, count)
+
+
+# Kernel-side copies, in order of preference
+KERNEL_COPIES = []
+if hasattr(os, 'copy_file_range'):
+    KERNEL_COPIES.append(_copy_file_range)
+if hasattr(os, 'sendfile'):
+    KERNEL_COPIES.append(_sendfile)
+
+
+class ThrottledReader:
+    """
+        Wraps a file object so that reads consume tokens from a
+        throttle.TokenBucket
+    """
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def copy_file(src, dest, chunk_size=COPY_CHUNK_SIZE, throttle=None):
+    """
+        Copies the contents of src to dest in the kernel where possible,
+        falling back to a read/write loop. Returns the number of bytes
+        copied. If throttle (a throttle.TokenBucket) is set, the copy
+        is rate limited by it
+    """
+    if throttle is not None:
+        chunk_size = min(chunk_size, THROTTLED_CHUNK_SIZE)
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        size = os.fstat(infd).st_size
+        copied = 0
+
+        for kernel_copy in KERNEL_COPIES:
+            try:
+                while copied < size:
+                    sent = kernel_copy(infd, outfd,
+                                       min(chunk_size, size - copied),
+                                       copied)
+                    if not sent:
+                        break
+                    copied += sent
+                    if throttle is not None:
+                        throttle.consume(sent)
+                return copied
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+
+        # Kernel copies are not supported
+        fsrc.seek(copied)
+        fdst.seek(copied)
+        if throttle is not None:
+            fsrc = ThrottledReader(fsrc, throttle)
+        shutil.copyfileobj(fsrc, fdst, chunk_size)
+        return fdst.tell()
+
+
+def scan_tree(src_dir):
+    """
+        Returns (directories, files) under src_dir, relative to it.
+        files is a list of (path, os.stat_result) tuples
+    """
+    directories = []
+    files = []
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(src_dir, relative_dir)) as entries:
+            for entry in entries:
+                path = os.path.join(relative_dir, entry.name)
+                if entry.is_dir():
+                    directories.append(path)
+                    pending.append(path)
+                else:
+                    files.append((path, entry.stat()))
+    return directories, files
+
+
+def is_copied(stat, dest):
+    """
+        Returns True if dest has the size and modification time of the
+        source file's stat, i.e. it was fully copied
+    """
+    try:
+        dest_stat = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    return dest_stat.st_size == stat.st_size and \
+        dest_stat.st_mtime_ns == stat.st_mtime_ns
+
+
+def copy_tree(src_dir, dest_dir, threads=8, resume=False, throttle=None):
+    """
+        Copies the directory tree at src_dir to dest_dir using a pool
+        of 'threads' threads. File modification times are preserved, and
+        are only set once a file is fully copied.
+
+        If resume is set, dest_dir may already exist and files in it
+        with the same size and modification time as the source are not
+        copied again.
+
+        If throttle (a throttle.TokenBucket) is set, the threads share
+        its rate limit.
+
+        Returns a dictionary with the number of "files", how many were
+        "copied" and "skipped", the "bytes" copied, the "seconds" taken
+        and the "bytes_per_second"
+    """
+    start = time.time()
+    if not resume and os.path.exists(dest_dir):
+        raise Exception(f'Cannot copy, path exists: {dest_dir}')
+
+    directories, files = scan_tree(src_dir)
+    os.makedirs(dest_dir, exist_ok=resume)
+    for directory in directories:
+        os.makedirs(os.path.join(dest_dir, directory), exist_ok=True)
+
+    def copy(item):
+        path, stat = item
+        dest = os.path.join(dest_dir, path)
+        if resume and is_copied(stat, dest):
+            return None
+        copied = copy_file(os.path.join(src_dir, path), dest,
+                           throttle=throttle)
+        shutil.copymode(os.path.join(src_dir, path), dest)
+        os.utime(dest, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        return copied
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, threads)) as pool:
+        results = list(pool.map(copy, files))
+
+    # Directory times change as files are added, so set them last
+    for directory in reversed([''] + directories):
+        shutil.copystat(os.path.join(src_dir, directory),
+                        os.path.join(dest_dir, directory))
+
+    copied = [result for result in results if result is not None]
+    seconds = time.time() - start
+    return {"files": len(files),
+            "copied": len(copied),
+            "skipped": len(files) - len(copied),
+            "bytes": sum(copied),
+            "seconds": seconds,
+            "bytes_per_second": sum(copied) / max(seconds, 1e-6)}
+
+
+def log_copy_stats(stats, dest_dir):
+    """
+        Logs the statistics returned by copy_tree
+    """
+    logging.info(f"Copied {stats['copied']}/{stats['files']} files "
+                 f"({stats['bytes'] / 1024**2:.1f} Mb, {stats['skipped']} "
+                 f"already present) to {dest_dir} in "
+                 f"{stats['seconds']:.1f}s "
+                 f"({stats['bytes_per_second'] / 1024**2:.1f} Mb/s)")
+
+
+# Name of the index of an archive backup
+ARCHIVE_INDEX = 'index.json'
+
+# Buffer for sequential writes of archive shards
+ARCHIVE_BUFFER_SIZE = 8 * 1024**2
+
+
+def archive_tree(src_dir, dest_dir, shard_size=16*1024**3, throttle=None):
+    """
+        Backs up the directory tree at src_dir as tar archives in
+        dest_dir, written sequentially in one pass. A new shard
+        (shard-000.tar, shard-001.tar, ...) is started once a shard
+        reaches 'shard_size' bytes.
+
+        dest_dir/index.json records the shard, data offset and size of
+        every file so single files can be read back without scanning
+        the shards (see extract_file).
+
+        Reads are rate limited by throttle, if set.
+
+        Returns a dictionary like copy_tree
+    """
+    start = time.time()
+    if os.path.exists(dest_dir):
+        raise Exception(f'Cannot archive, path exists: {dest_dir}')
+    os.makedirs(dest_dir)
+
+    directories, files = scan_tree(src_dir)
+    index = {"shards": [], "files": {}}
+    shard = None
+    total = 0
+    try:
+        for path, stat in sorted(files):
+            if shard is None or shard.offset >= shard_size:
+                if shard is not None:
+                    shard.close()
+                    shard.fileobj.close()
+                name = f"shard-{len(index['shards']):03d}.tar"
+                index["shards"].append(name)
+                shard = tarfile.open(
+                    fileobj=open(os.path.join(dest_dir, name), 'wb',
+                                 buffering=ARCHIVE_BUFFER_SIZE),
+                    mode='w', format=tarfile.PAX_FORMAT)
+
+            info = shard.gettarinfo(os.path.join(src_dir, path), arcname=path)
+            with open(os.path.join(src_dir, path), 'rb') as f:
+                shard.addfile(info, f if throttle is None
+                              else ThrottledReader(f, throttle))
+            # The data is the last thing written, padded to whole blocks
+            blocks = -(-info.size // tarfile.BLOCKSIZE)
+            index["files"][path] = [len(index["shards"]) - 1,
+                                    shard.offset - blocks * tarfile.BLOCKSIZE,
+                                    info.size]
+            total += info.size
+    finally:
+        if shard is not None:
+            shard.close()
+            shard.fileobj.close()
+
+    index["directories"] = sorted(directories)
+    with open(os.path.join(dest_dir, ARCHIVE_INDEX), 'w') as f:
+        json.dump(index, f)
+
+    seconds = time.time() - start
+    return {"files": len(files),
+            "copied": len(files),
+            "skipped": 0,
+            "bytes": total,
+            "seconds": seconds,
+            "bytes_per_second": total / max(seconds, 1e-6)}
+
+
+def is_archive(backup_path):
+    """
+        Returns True if backup_path is an archive backup
+    """
+    return os.path.isfile(os.path.join(backup_path, ARCHIVE_INDEX))
+
+
+def read_index(backup_path):
+    with open(os.path.join(backup_path, ARCHIVE_INDEX)) as f:
+        return json.load(f)
+
+
+def extract_file(backup_path, path, dest, index=None):
+    """
+        Copies a single file, at 'path' relative to the run directory,
+        out of an archive backup to dest
+    """
+    index = index or read_index(backup_path)
+    if path not in index["files"]:
+        raise Exception(f'{path} not found in archive: {backup_path}')
+
+    shard, offset, size = index["files"][path]
+    with open(os.path.join(backup_path, index["shards"][shard]), 'rb') as src, \
+            open(dest, 'wb') as f:
+        src.seek(offset)
+        while size:
+            data = src.read(min(COPY_CHUNK_SIZE, size))
+            if not data:
+                raise Exception(f'Archive truncated: {backup_path}')
+            f.write(data)
+            size -= len(data)
+
+
+def restore_archive(backup_path, dest_dir):
+    """
+        Extracts every file of an archive backup into dest_dir
+    """
+    index = read_index(backup_path)
+    for directory in index["directories"]:
+        os.makedirs(os.path.join(dest_dir, directory), exist_ok=True)
+    for name in index["shards"]:
+        with tarfile.open(os.path.join(backup_path, name)) as shard:
+            shard.extractall(dest_dir, filter='tar')
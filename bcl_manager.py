@@ -7,14 +7,31 @@ import shutil
 from pathlib import Path
 import subprocess
 import re
+import sys
 import glob
+import queue
+import threading
+import time
+import concurrent.futures
 from datetime import datetime
 
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent
 
 from s3_logging_handler import S3LoggingHandler
-
+from plate_scheduler import PlateScheduler
+from plate_index import (PlateIndex, is_processed_plate, directory_size,
+                         INDEX_FILE)
+from fastq_streamer import FastqStreamer
+from run_watcher import RunWatcher, run_directories
+from throttle import Throttle, TokenBucket, parse_hours
+
+import backup
+import catalogue
+import deletion
+import fastq_qc
+import metrics
+import recompress
+import upload_manifest
 import utils
 
 """
@@ -28,33 +45,110 @@ bcl_manager.py is a file-watcher that runs on wey-001 for automated:
 
 SALMONELLA_PROJECT_CODES = ["FZ2000"]
 
+# The file watcher is only started by the watch command
+observers = utils.LazyModule("watchdog.observers")
+
+# While plates are deferred for lack of space, clean up and retry
+# admission at least this often (seconds)
+DEFERRED_RETRY_SECONDS = 5 * 60
 
-def convert_to_fastq(src_dir, dest_dir):
+
+def convert_to_fastq(src_dir, dest_dir, threads=None, cpus=None, nice=None,
+                     ionice=None):
     """
         Converts an Illumina Bcl Run to Fastq using bcl-convert
+
+        threads: if set, bcl-convert uses this many conversion and
+                 compression threads, and half as many decompression
+                 threads, instead of one of each per core
+        cpus: if set, list of CPUs bcl-convert is pinned to (taskset)
+        nice: if set, nice level to run bcl-convert at
+        ionice: if set, best-effort I/O priority (0-7) to run it at
+
+        Returns the command that was run
     """
-    return_code = subprocess.run([
+    command = [
         "bcl-convert",
         "--output-directory", dest_dir,
         "--bcl-input-directory", src_dir,
         "--sample-sheet", f"{src_dir}/SampleSheet.csv",
         "--bcl-sampleproject-subdirectories", "true",
         "--no-lane-splitting", "true"
-    ]).returncode
+    ]
+    if threads:
+        command += ["--bcl-num-conversion-threads", str(threads),
+                    "--bcl-num-compression-threads", str(threads),
+                    "--bcl-num-decompression-threads",
+                    str(max(1, threads // 2))]
+    if ionice is not None:
+        command = ["ionice", "-c", "2", "-n", str(ionice)] + command
+    if nice is not None:
+        command = ["nice", "-n", str(nice)] + command
+    if cpus:
+        command = ["taskset", "-c", ",".join(map(str, cpus))] + command
+
+    return_code = subprocess.run(command).returncode
 
     if return_code:
         raise Exception('bcl-convert failed: %s' % (return_code))
+    return command
 
 
-def copy(src_dir, dest_dir):
+def split_cpus(workers, cpus=None):
+    """
+        Splits cpus (default: the CPUs this process may run on) into
+        'workers' contiguous groups of near equal size, one for each
+        conversion that may run at the same time
+    """
+    cpus = sorted(cpus or os.sched_getaffinity(0))
+    workers = max(1, min(workers, len(cpus)))
+    size, extra = divmod(len(cpus), workers)
+    groups = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (i < extra)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+def copy(src_dir, dest_dir, threads=8, archive=False,
+         shard_size=16*1024**3, throttle=None):
     """
         Backup BclFiles to another directory
+
+        Files are copied in parallel into {dest_dir}.partial, which is
+        renamed to dest_dir once complete. If an earlier backup was
+        interrupted, the partial copy is resumed: files that are already
+        fully copied are skipped.
+
+        If archive is set, the run is instead written sequentially into
+        tar shards of up to shard_size bytes with an index (see
+        backup.archive_tree). An interrupted archive is started again.
+
+        If throttle (a throttle.TokenBucket) is set, the copy is rate
+        limited by it.
     """
     # Make sure we are not overwriting anything!
     if os.path.isdir(os.path.abspath(dest_dir)):
         raise Exception('Cannot backup Bcl, path exists: %s' % dest_dir)
 
-    shutil.copytree(src_dir, dest_dir)
+    dest_dir = os.path.abspath(dest_dir)
+    partial_dir = dest_dir + '.partial'
+    if archive:
+        if os.path.isdir(partial_dir):
+            logging.info(f'Removing partial backup: {partial_dir}')
+            shutil.rmtree(partial_dir)
+        stats = backup.archive_tree(src_dir, partial_dir, shard_size,
+                                    throttle)
+    else:
+        if os.path.isdir(partial_dir):
+            logging.info(f'Resuming partial backup: {partial_dir}')
+        stats = backup.copy_tree(src_dir, partial_dir, threads, resume=True,
+                                 throttle=throttle)
+    os.rename(partial_dir, dest_dir)
+    backup.log_copy_stats(stats, dest_dir)
+    return stats
 
 
 def monitor_disk_usage(filepath):
@@ -73,16 +167,19 @@ def log_disk_usage(filepath):
     logging.info("Free space: (%.1f Gb) %s" % (free_gb, filepath))
 
 
-def clean_up(fastq_dir, watch_dir, backup_dir):
+def clean_up(fastq_dir, watch_dir, backup_dir, deleter=None):
     """
         Runs through all fully processed plates and deletes bcl data
         from watch-dir (IncomingRuns). Also deletes fastq data from
         fastq_dir and backup bcl data from backup_dir (OutputFastq)
         ONLY if any processed plate is older than 30 days. NOTE: this
         will only delete data if that plate has been fully processed.
+        Plates are deleted by the deleter if given (see remove_plate)
     """
     today = datetime.today()
     for plate in os.listdir(fastq_dir):
+        if plate == deletion.TRASH_DIR:
+            continue
         # ensure that plate is a folder
         try:
             # backup & fastq plates
@@ -94,7 +191,7 @@ def clean_up(fastq_dir, watch_dir, backup_dir):
                 bcl_plate = os.path.join(watch_dir, plate)
                 if os.path.isdir(bcl_plate):
                     # delete processed bcl data
-                    remove_plate([bcl_plate])
+                    remove_plate([bcl_plate], deleter)
                 # datetime of fastq processing for each plate
                 modified_date = \
                     datetime.fromtimestamp(os.path.getmtime(fastq_plate))
@@ -104,24 +201,87 @@ def clean_up(fastq_dir, watch_dir, backup_dir):
                 # plate is older than 21 days
                 if age.days > 21:
                     backup_plate = os.path.join(backup_dir, plate)
-                    remove_plate([fastq_plate, backup_plate])
+                    remove_plate([fastq_plate, backup_plate], deleter)
         except NotADirectoryError:
             pass
 
 
-def remove_plate(plate_paths):
+def clean_up_index(plate_index, max_age_days=21, deleter=None):
+    """
+        Clean up using the plate index rather than rescanning
+        directories. Deletes the bcl data from watch-dir of every
+        processed plate, and the fastq and backup data of plates
+        processed more than max_age_days days ago. Plates are deleted
+        by the deleter if given (see remove_plate)
+    """
+    for plate in plate_index.bcl_pending():
+        if os.path.isdir(plate["bcl_path"]):
+            remove_plate([plate["bcl_path"]], deleter)
+        if not os.path.exists(plate["bcl_path"]):
+            plate_index.mark_bcl_removed(plate["name"])
+
+    for plate in plate_index.expired(max_age_days):
+        paths = [path for path in [plate["fastq_path"],
+                                   plate["backup_path"],
+                                   plate["bcl_path"]]
+                 if os.path.exists(path)]
+        remove_plate(paths, deleter)
+        if not any(os.path.exists(path) for path in paths):
+            plate_index.mark_removed(plate["name"])
+
+
+def find_complete_runs(watch_dir, copy_complete_filename='CopyComplete.txt'):
+    """
+        Returns the paths of run directories directly under watch_dir
+        that contain copy_complete_filename, in sequence date order.
+        Only the top level of watch_dir is listed, so this stays fast
+        however large the runs are
+    """
+    runs = [path for path in run_directories(watch_dir)
+            if os.path.isfile(os.path.join(path, copy_complete_filename))]
+    # Run directories start with the yymmdd sequence date
+    return sorted(runs, key=lambda path: (basename(path).split('_')[0],
+                                          basename(path)))
+
+
+def remove_plate(plate_paths, deleter=None):
     """
         Deletes the directory tree at the paths in each element of
-        'plate_paths' (list)
+        'plate_paths' (list). With a deletion.Deleter, each tree is
+        moved to the trash straight away and deleted in the background
     """
     try:
         for path in plate_paths:
-            shutil.rmtree(path)
-            logging.info(f"Removing old data: '{path}'")
+            kind = " (archive)" if backup.is_archive(path) else ""
+            if deleter is not None:
+                deleter.remove(path)
+            else:
+                shutil.rmtree(path)
+            logging.info(f"Removing old data{kind}: '{path}'")
     except PermissionError as e:
         logging.info(f"Cannot delete. {e}")
 
 
+def parse_run_name(fastq_path):
+    """
+        Extracts metadata from a run directory path formatted as
+        yymmdd_instrumentID_runnumber_flowcellID/
+
+        Returns a dictionary with keys: sequence_date, run_id,
+        instrument_id, run_number, flowcell_id
+    """
+    match = re.search(r'(.+)_((.+)_(.+))_(.+)',
+                      basename(os.path.dirname(fastq_path)))
+    if not match:
+        raise Exception(f"Could not extract run number from {fastq_path}")
+    sequence_date = datetime.strptime(match.group(1), r'%y%m%d')
+    return {"sequence_date": str(sequence_date.date()),
+            "run_id": match.group(2),
+            "instrument_id": match.group(3),
+            "run_number": match.group(4),
+            "flowcell_id": match.group(5)}
+
+
 def is_subdirectory(filepath1, filepath2):
     """
         Checks if path1 is a subdirectory of path2
@@ -180,7 +340,41 @@ class BclEventHandler(FileSystemEventHandler):
                  s3_endpoint_url,
                  salm_submission_bucket,
                  salm_results_bucket,
-                 copy_complete_filename='CopyComplete.txt'):
+                 copy_complete_filename='CopyComplete.txt',
+                 scheduler=None,
+                 overlap_backup=False,
+                 upload_threads=8,
+                 part_size=64*1024**2,
+                 multipart_threshold=64*1024**2,
+                 stream_upload=False,
+                 settle_seconds=60,
+                 copy_threads=8,
+                 backup_format="tree",
+                 archive_shard_size=16*1024**3,
+                 plate_index_path=None,
+                 rebuild_plate_index=False,
+                 min_free_bytes=None,
+                 fastq_size_ratio=1.0,
+                 bcl_threads=None,
+                 pin_cpus=False,
+                 convert_nice=None,
+                 convert_ionice=None,
+                 upload_limit=None,
+                 copy_limit=None,
+                 full_speed_hours=None,
+                 busy_factor=1.0,
+                 project_upload_workers=1,
+                 priority_projects=None,
+                 fastq_qc=False,
+                 qc_processes=1,
+                 catalogue_runs=False,
+                 submit_jobs=True,
+                 recompress_fastq=False,
+                 recompress_level=6,
+                 recompress_processes=1,
+                 background_deletion=False,
+                 deletion_threads=4,
+                 deletion_limit=None):
         super(BclEventHandler, self).__init__()
 
         # Creation of this file indicates that an Illumina Machine has
@@ -201,10 +395,122 @@ class BclEventHandler(FileSystemEventHandler):
         self.fastq_key = fastq_key
         self.s3_endpoint_url = s3_endpoint_url
 
-        # For running Salmonella pipeline in AWS batch
+        # Number of files backed up at the same time
+        self.copy_threads = copy_threads
+
+        # Back up runs as a directory "tree" or as tar shards of up to
+        # archive_shard_size bytes ("archive")
+        if backup_format not in ("tree", "archive"):
+            raise Exception(f"Unknown backup format: {backup_format}")
+        self.backup_format = backup_format
+        self.archive_shard_size = archive_shard_size
+
+        # Fastq upload concurrency and multipart settings (bytes)
+        self.upload_threads = upload_threads
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+
+        # Projects of a plate uploaded at the same time, and the projects
+        # uploaded first (default: the Salmonella projects)
+        self.project_upload_workers = project_upload_workers
+        self.priority_projects = SALMONELLA_PROJECT_CODES \
+            if priority_projects is None else priority_projects
+
+        # Add read counts, yields and qualities of each project to its
+        # meta.json, reading qc_processes files of a project at a time.
+        # meta.json and the batch submission wait for it, so it is off
+        # by default
+        self.fastq_qc = fastq_qc
+        self.qc_processes = qc_processes
+        self.qc_pool = None
+        if fastq_qc:
+            self.qc_pool = concurrent.futures.ThreadPoolExecutor(
+                thread_name_prefix="fastq-qc")
+
+        # Add each uploaded run to the catalogue on S3 (see catalogue.py)
+        self.catalogue_runs = catalogue_runs
+
+        # Upload fastq files once they have been unchanged for
+        # settle_seconds while bcl-convert is still running
+        self.stream_upload = stream_upload
+        self.settle_seconds = settle_seconds
+
+        # Rewrite the fastq as BGZF at recompress_level before uploading
+        # it, recompress_processes files at a time (see recompress.py)
+        if recompress_fastq and stream_upload:
+            raise Exception("Fastq cannot be recompressed if it is "
+                            "uploaded while bcl-convert runs")
+        self.recompress_fastq = recompress_fastq
+        self.recompress_level = recompress_level
+        self.recompress_processes = recompress_processes
+
+        # bcl-convert threads per conversion. By default the CPUs are
+        # split evenly between the conversions that may run at once. If
+        # pin_cpus is set each conversion is pinned to its share
+        self.bcl_threads = bcl_threads
+        self.pin_cpus = pin_cpus
+        self.convert_nice = convert_nice
+        self.convert_ionice = convert_ionice
+        self.set_convert_workers(1)
+
+        # Upload and backup copy bandwidth limits (bytes per second, None
+        # for no limit). Limits are lifted during full_speed_hours and
+        # multiplied by busy_factor while sequencers write to watch_dir
+        self.upload_throttle = Throttle(upload_limit, full_speed_hours,
+                                        busy_factor, self.watch_dir,
+                                        copy_complete_filename,
+                                        name="upload")
+        self.copy_throttle = Throttle(copy_limit, full_speed_hours,
+                                      busy_factor, self.watch_dir,
+                                      copy_complete_filename, name="copy")
+
+        # For running Salmonella pipeline in AWS batch. If submit_jobs is
+        # not set, projects are uploaded without submitting the pipeline
+        self.submit_jobs = submit_jobs
         self.salm_submission_bucket = salm_submission_bucket
         self.salm_results_bucket = salm_results_bucket
 
+        # If set, on_created queues plates on this PlateScheduler rather
+        # than processing them in the file watcher thread
+        self.scheduler = scheduler
+
+        # Plates found by on_created, measured and submitted to the
+        # scheduler by the submit thread (see start_submitter), as
+        # submitting blocks while the scheduler is full
+        self.submissions = queue.Queue()
+
+        # run_watcher.RunWatcher reporting plates, if any. Told when a
+        # plate fails so that the run can be triggered again
+        self.run_watcher = None
+
+        # Run the backup copy at the same time as bcl-convert
+        self.overlap_backup = overlap_backup
+
+        # Stops concurrently finishing plates cleaning up at once
+        self.clean_up_lock = threading.Lock()
+        self.last_clean_up = 0
+
+        # If background_deletion is set, clean up moves old plates to a
+        # trash directory and deletion_threads low priority threads
+        # delete them, at most deletion_limit files per second (None for
+        # no limit). Set up below, once the directories are checked
+        self.background_deletion = background_deletion
+        self.deletion_threads = deletion_threads
+        self.deletion_limit = deletion_limit
+        self.deleter = None
+
+        # Plates are only admitted to the scheduler if the backup_dir and
+        # fastq_dir filesystems keep min_free_bytes free (None to admit
+        # every plate). The fastq output is estimated as fastq_size_ratio
+        # times the size of the raw bcl data
+        self.min_free_bytes = min_free_bytes
+        self.fastq_size_ratio = fastq_size_ratio
+
+        # Plate name -> {filesystem device: bytes} reserved by admitted
+        # plates until they finish
+        self.reservations = {}
+        self.reservation_lock = threading.Lock()
+
         # Make sure backup and fastq dirs exist
         if not os.path.isdir(self.backup_dir):
             raise Exception("Backup Directory does not exist: %s"
@@ -214,32 +520,451 @@ class BclEventHandler(FileSystemEventHandler):
             raise Exception("Fastq Directory does not exist: %s"
                             % self.fastq_dir)
 
+        # Index of processed plates used by clean up. Built from the
+        # existing directories if it is new
+        self.plate_index = None
+        if plate_index_path is not None:
+            self.plate_index = PlateIndex(plate_index_path)
+            if rebuild_plate_index or self.plate_index.is_empty():
+                self.plate_index.rebuild(self.fastq_dir, self.watch_dir,
+                                         self.backup_dir)
+
+        # Wakes the clean up thread early
+        self.clean_up_requested = threading.Event()
+
+        if self.background_deletion:
+            self.deleter = deletion.Deleter(
+                deletion_threads,
+                deletion_limit and TokenBucket(deletion_limit))
+            # Finish deleting what a crash left in the trash
+            self.deleter.resume([self.watch_dir, self.fastq_dir,
+                                 self.backup_dir])
+
         # Log disk usage
         log_disk_usage(self.watch_dir)
         log_disk_usage(self.fastq_dir)
         log_disk_usage(self.backup_dir)
 
+    def stages(self):
+        """
+            Returns the stages of processing a plate as a list of
+            (name, function) tuples. Each function takes the event
+        """
+        if self.overlap_backup:
+            stages = [("convert", self.backup_and_convert)]
+        else:
+            stages = [("copy", self.backup),
+                      ("convert", self.convert)]
+        if self.recompress_fastq:
+            stages.append(("recompress", self.recompress))
+        return stages + [("upload", self.deliver)]
+
+    def start_scheduler(self, workers=None, max_plates=8):
+        """
+            Processes plates on a PlateScheduler rather than in the file
+            watcher thread. workers maps stage name to the number of
+            plates that may run the stage at the same time
+        """
+        self.set_convert_workers((workers or {}).get("convert", 1))
+        admit = self.admit if self.min_free_bytes is not None else None
+        self.scheduler = PlateScheduler(self.stages(), workers, max_plates,
+                                        on_complete=self.plate_processed,
+                                        on_error=self.plate_failed,
+                                        admit=admit)
+        self.start_submitter()
+        return self.scheduler
+
+    def start_submitter(self):
+        """
+            Starts the thread that submits the plates queued by
+            on_created to the scheduler. Measuring a plate and waiting
+            for a free slot happen there rather than in the file watcher
+            thread, so that watching never stalls
+        """
+        def run():
+            while True:
+                event = self.submissions.get()
+                try:
+                    if self.min_free_bytes is not None:
+                        self.measure_plate(event)
+                    self.scheduler.submit(event.src_name, event)
+                except Exception as e:
+                    logging.exception(f"Could not schedule "
+                                      f"{event.src_path}: {e}")
+                finally:
+                    self.submissions.task_done()
+
+        thread = threading.Thread(target=run, daemon=True, name="submit")
+        thread.start()
+        return thread
+
+    def set_convert_workers(self, workers):
+        """
+            Shares the CPUs between 'workers' concurrent conversions
+        """
+        self.cpu_groups = queue.Queue()
+        for cpus in split_cpus(workers):
+            self.cpu_groups.put(cpus)
+
+    def run_conversion(self, event):
+        """
+            Runs bcl-convert for the plate on a share of the CPUs, and
+            logs and records the settings used and the wall time
+        """
+        cpus = self.cpu_groups.get()
+        try:
+            settings = {"threads": self.bcl_threads or len(cpus),
+                        "cpus": cpus if self.pin_cpus else None,
+                        "nice": self.convert_nice,
+                        "ionice": self.convert_ionice}
+            start = time.time()
+            with metrics.track("convert"):
+                command = convert_to_fastq(event.abs_src_path,
+                                           event.fastq_path, **settings)
+            seconds = time.time() - start
+        finally:
+            self.cpu_groups.put(cpus)
+
+        metrics.STAGE_BYTES.inc(directory_size(event.fastq_path) or 0,
+                                stage="convert")
+        logging.info(f"Converted {event.src_name} in {seconds:.1f}s with "
+                     f"{settings['threads']} threads, cpus "
+                     f"{settings['cpus'] or 'any'}, nice "
+                     f"{settings['nice']}, ionice {settings['ionice']}")
+        if self.plate_index is not None:
+            self.plate_index.record_conversion(event.src_name, start, seconds,
+                                               dict(settings,
+                                                    command=command))
+
+    def measure_plate(self, event):
+        """
+            Sets the size of the plate's raw data (input_bytes) used to
+            estimate its footprint. Called by the submit thread before
+            the plate is submitted, as admit() runs under the
+            scheduler's lock and must not scan the run directory
+        """
+        event.input_bytes = directory_size(event.abs_src_path) or 0
+
+    def estimate_footprint(self, event):
+        """
+            Returns a dictionary of directory to the estimated bytes the
+            plate will write there: its backup in the backup_dir and its
+            fastq in the fastq_dir. Stages that already completed need
+            no space
+        """
+        input_bytes = event.input_bytes
+
+        backup_path = os.path.join(self.backup_dir, event.src_name)
+        backed_up = self.stage_done(event, "backed_up") or \
+            os.path.isdir(backup_path)
+        converted = self.stage_done(event, "converted")
+        return {self.backup_dir: 0 if backed_up else input_bytes,
+                self.fastq_dir: 0 if converted else
+                int(input_bytes * self.fastq_size_ratio)}
+
+    def admit(self, event):
+        """
+            Returns True, and reserves the space, if the plate fits on
+            disk while leaving min_free_bytes free after the space
+            reserved by plates already admitted. Otherwise requests an
+            early clean up and returns False
+        """
+        gb = 1024**3
+        # backup_dir and fastq_dir may share a filesystem
+        needed = {}
+        for path, size in self.estimate_footprint(event).items():
+            device = os.stat(path).st_dev
+            needed[device] = (path, needed.get(device, (path, 0))[1] + size)
+
+        with self.reservation_lock:
+            admitted = True
+            for device, (path, size) in needed.items():
+                total, free = monitor_disk_usage(path)
+                reserved = sum(reservation.get(device, 0) for reservation
+                               in self.reservations.values())
+                fits = free - reserved - size >= self.min_free_bytes
+                logging.info(f"{'Admitting' if fits else 'Deferring'} plate "
+                             f"{event.src_name}: needs {size / gb:.1f} Gb "
+                             f"on {path} ({free / gb:.1f} Gb free, "
+                             f"{reserved / gb:.1f} Gb reserved, "
+                             f"{self.min_free_bytes / gb:.1f} Gb watermark)")
+                admitted = admitted and fits
+            if admitted:
+                self.reservations[event.src_name] = {
+                    device: size for device, (_, size) in needed.items()}
+                return True
+
+        if time.time() - self.last_clean_up >= DEFERRED_RETRY_SECONDS:
+            self.request_clean_up()
+        return False
+
+    def release_reservation(self, event):
+        """
+            Releases the disk space reserved for a plate once it has
+            finished, as its data is then counted as used
+        """
+        with self.reservation_lock:
+            self.reservations.pop(event.src_name, None)
+
     def process_bcl_plate(self, event):
         """
             Processes a bcl plate.
             Copies, converts to fastq, uploads to SCE and runs the
             Salmonella pipeline in AWS batch
         """
+        for _, stage in self.stages():
+            stage(event)
+
+    def stage_done(self, event, stage):
+        """
+            Returns True if the journal records the stage of the plate
+            as complete. Always False without a plate index
+        """
+        return self.plate_index is not None and \
+            self.plate_index.stage_completed(event.src_name, stage)
+
+    def mark_stage_done(self, event, stage):
+        """
+            Journals a stage of the plate as complete
+        """
+        if self.plate_index is not None:
+            self.plate_index.mark_stage(event.src_name, stage)
+
+    def backup(self, event):
+        """
+            Backs up the raw bcl data of the plate to the backup_dir
+        """
         backup_path = os.path.join(self.backup_dir, event.src_name, "")
+        if self.stage_done(event, "backed_up"):
+            logging.info(f'Already backed up: {backup_path}')
+            return
+
+        if self.plate_index is not None and os.path.isdir(backup_path):
+            # Backups are renamed into place once complete, so the plate
+            # was backed up before the journal could record it
+            logging.info(f'Backup already complete: {backup_path}')
+        else:
+            logging.info(f'Backing up Raw Bcl Run: {backup_path}')
+            with metrics.track("copy"):
+                stats = copy(event.abs_src_path, backup_path,
+                             self.copy_threads,
+                             archive=self.backup_format == "archive",
+                             shard_size=self.archive_shard_size,
+                             throttle=self.copy_throttle)
+            if stats:
+                metrics.STAGE_BYTES.inc(stats["bytes"], stage="copy")
+        self.mark_stage_done(event, "backed_up")
+
+    def convert(self, event):
+        """
+            Converts the raw bcl data of the plate to fastq. If
+            stream_upload is set, fastq files are uploaded while
+            bcl-convert is still running (see upload)
+        """
+        if self.stage_done(event, "converted"):
+            logging.info(f'Already converted to fastq: {event.fastq_path}')
+            return
+
+        # Read before an incomplete conversion is removed, so that a
+        # streamed upload keeps the S3 prefixes an earlier attempt claimed
+        manifest = upload_manifest.UploadManifest(
+            os.path.join(event.fastq_path, upload_manifest.MANIFEST))
 
-        # Process
-        logging.info(f'Backing up Raw Bcl Run: {backup_path}')
-        copy(event.abs_src_path, backup_path)
+        # A failed backup leaves only the manifest (see remove_conversion)
+        if os.path.isdir(event.fastq_path) and \
+                (self.plate_index is not None or
+                 os.listdir(event.fastq_path) == [upload_manifest.MANIFEST]):
+            # bcl-convert will not write into existing output
+            logging.info('Removing incomplete conversion: '
+                         f'{event.fastq_path}')
+            shutil.rmtree(event.fastq_path)
 
         logging.info(f'Converting to fastq: {event.fastq_path}')
-        convert_to_fastq(event.abs_src_path, event.fastq_path)
+        if not self.stream_upload:
+            self.run_conversion(event)
+            self.mark_stage_done(event, "converted")
+            return
+
+        run_id = parse_run_name(event.fastq_path)["run_id"]
+
+        def key_for(path):
+            project_code = basename(os.path.dirname(path))
+            return f"{self.s3_key(project_code, run_id)}/{basename(path)}"
+
+        event.streamer = FastqStreamer(event.fastq_path, self.fastq_bucket,
+                                       self.s3_endpoint_url, key_for,
+                                       settle_seconds=self.settle_seconds,
+                                       manifest=manifest,
+                                       **self.transfer_options())
+        event.streamer.start()
+        try:
+            self.run_conversion(event)
+        finally:
+            event.streamer.stop()
+        self.mark_stage_done(event, "converted")
+
+    def recompress(self, event):
+        """
+            Recompresses the fastq.gz files of the plate as BGZF, and
+            logs the bytes saved and the time taken
+        """
+        if self.stage_done(event, "recompressed"):
+            logging.info(f'Already recompressed: {event.fastq_path}')
+            return
+
+        paths = glob.glob(event.fastq_path + '*/*.fastq.gz')
+        logging.info(f'Recompressing {len(paths)} fastq files at level '
+                     f'{self.recompress_level}: {event.fastq_path}')
+        with metrics.track("recompress"):
+            stats = recompress.recompress_files(paths, self.recompress_level,
+                                                self.recompress_processes)
+        metrics.STAGE_BYTES.inc(stats["bytes_in"], stage="recompress")
+        saved = stats["bytes_in"] - stats["bytes_out"]
+        logging.info(f"Recompressed {stats['replaced']}/{stats['files']} "
+                     f"fastq files of {event.src_name} "
+                     f"({stats['reads']} reads) from "
+                     f"{stats['bytes_in'] / 1024**2:.1f} Mb to "
+                     f"{stats['bytes_out'] / 1024**2:.1f} Mb, saving "
+                     f"{saved / 1024**2:.1f} Mb "
+                     f"({saved / max(stats['bytes_in'], 1):.1%}) in "
+                     f"{stats['seconds']:.1f}s")
+        self.mark_stage_done(event, "recompressed")
+
+    def s3_key(self, project_code, run_id):
+        """
+            Returns the S3 key that a project's fastq of a run are
+            stored under
+        """
+        return os.path.join(self.fastq_key, project_code, run_id)
 
+    def transfer_options(self):
+        """
+            Returns the keyword arguments for utils.s3_upload_files
+        """
+        return {"threads": self.upload_threads,
+                "part_size": self.part_size,
+                "multipart_threshold": self.multipart_threshold,
+                "throttle": self.upload_throttle}
+
+    def backup_and_convert(self, event):
+        """
+            Backs up and converts the plate at the same time. Both are
+            always allowed to finish before this returns.
+
+            If the conversion fails, its exception is raised once the
+            backup has finished. If the backup fails, the converted fastq
+            is removed before raising, so that clean_up never deletes the
+            raw bcl data of a plate that has no backup.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            backup = pool.submit(self.backup, event)
+            try:
+                self.convert(event)
+            except Exception:
+                if backup.exception() is not None:
+                    logging.exception(backup.exception())
+                raise
+
+            if backup.exception() is not None:
+                logging.info('Backup failed, removing converted fastq: '
+                             f'{event.fastq_path}')
+                self.remove_conversion(event)
+                if self.plate_index is not None:
+                    self.plate_index.clear_stage(event.src_name, "converted")
+                raise backup.exception()
+
+    def remove_conversion(self, event):
+        """
+            Removes the fastq output of the plate. Its upload manifest,
+            if any, is kept, so that a retry may replace the objects
+            already streamed to S3
+        """
+        if not os.path.isfile(os.path.join(event.fastq_path,
+                                           upload_manifest.MANIFEST)):
+            shutil.rmtree(event.fastq_path, ignore_errors=True)
+            return
+        for name in os.listdir(event.fastq_path):
+            path = os.path.join(event.fastq_path, name)
+            if name == upload_manifest.MANIFEST:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+    def deliver(self, event, clean_up=True):
+        """
+            Uploads the fastq data of the plate. Without a plate index,
+            old plates are then removed if clean_up is set
+        """
         # upload to SCE and run Salmonella pipeline
         self.upload(event)
+        if self.catalogue_runs:
+            try:
+                self.catalogue(event)
+            except Exception as e:
+                # The data is delivered, so this is not a failure of the
+                # plate. Left unjournalled, so a backfill catalogues it
+                logging.exception(f"Could not catalogue {event.src_name}: "
+                                  f"{e}")
+
+        if self.plate_index is not None:
+            # Clean up runs on its own timer (see start_clean_up)
+            self.plate_index.record_processed(
+                event.src_name, os.path.normpath(event.fastq_path),
+                os.path.join(self.backup_dir, event.src_name),
+                os.path.normpath(event.abs_src_path))
+            return
 
         # remove all plates where the processed data is older than 30
         # days
-        clean_up(self.fastq_dir, self.watch_dir, self.backup_dir)
+        if clean_up:
+            self.run_clean_up()
+
+    def run_clean_up(self):
+        """
+            Removes processed bcl data and plates older than 21 days,
+            using the plate index if there is one
+        """
+        with self.clean_up_lock, metrics.track("cleanup"):
+            self.last_clean_up = time.time()
+            if self.plate_index is not None:
+                clean_up_index(self.plate_index, deleter=self.deleter)
+            else:
+                clean_up(self.fastq_dir, self.watch_dir, self.backup_dir,
+                         self.deleter)
+
+    def start_clean_up(self, interval):
+        """
+            Runs clean up every 'interval' seconds, or sooner if
+            request_clean_up() is called, in a background thread.
+            Admission of plates deferred for lack of space is retried
+            after each clean up, which runs at least every
+            DEFERRED_RETRY_SECONDS while plates are deferred
+        """
+        def run():
+            while True:
+                timeout = interval
+                if self.scheduler is not None and self.scheduler.deferred:
+                    timeout = min(interval, DEFERRED_RETRY_SECONDS)
+                self.clean_up_requested.wait(timeout)
+                self.clean_up_requested.clear()
+                try:
+                    self.run_clean_up()
+                except Exception as e:
+                    logging.exception(e)
+                if self.scheduler is not None:
+                    self.scheduler.retry_deferred()
+
+        thread = threading.Thread(target=run, daemon=True, name="clean-up")
+        thread.start()
+        return thread
+
+    def request_clean_up(self):
+        """
+            Wakes the clean up thread to run straight away
+        """
+        self.clean_up_requested.set()
 
     def upload(self, event):
         """
@@ -254,6 +979,22 @@ class BclEventHandler(FileSystemEventHandler):
             The project_code is the name of the subdirectory that
             contains the fastq files.
 
+            Projects in priority_projects are uploaded first, and up to
+            project_upload_workers projects are uploaded at the same
+            time, splitting the upload threads between them. Each
+            project's meta.json is uploaded, and its Salmonella pipeline
+            submitted, as soon as its own fastq files are on S3.
+
+            If the fastq was streamed to S3 during conversion, the
+            upload is reconciled instead: anything missed or changed is
+            uploaded and every file is checked to be on S3. meta.json is
+            uploaded and the Salmonella pipeline submitted only after
+            that.
+
+            With a plate index, each project's upload and batch
+            submission are journalled, and projects completed by an
+            earlier attempt are skipped.
+
             A meta.json file is also uploaded to each project_code with
             schema:
             {
@@ -267,45 +1008,247 @@ class BclEventHandler(FileSystemEventHandler):
             }
         """
         # Extract metadata
-        match = re.search(r'(.+)_((.+)_(.+))_(.+)',
-                          basename(os.path.dirname(event.fastq_path)))
-        if not match:
-            raise Exception("Could not extract run number from "
-                            f"{event.fastq_path}")
-        sequence_date = datetime.strptime(match.group(1), r'%y%m%d')
-        run_id = match.group(2)
-        instrument_id = match.group(3)
-        run_number = match.group(4)
-        flowcell_id = match.group(5)
+        run = parse_run_name(event.fastq_path)
         logging.info(f"Uploading {event.fastq_path} to "
                      f"s3://{self.fastq_bucket}/{self.fastq_key}")
-        # Upload each directory that contains fastq files
-        for dirname in glob.glob(event.fastq_path + '*/'):
+        projects, project_files = self.collect_projects(event, run)
+        order = self.project_order(projects)
+
+        start = time.time()
+        streamer = getattr(event, "streamer", None)
+        if streamer is not None:
+            # Most files were uploaded during conversion
+            with metrics.track("upload"):
+                streamed = streamer.reconcile()
+            metrics.STAGE_BYTES.inc(sum(os.path.getsize(path)
+                                        for path in streamed),
+                                    stage="upload")
+            for project_code in order:
+                qc = None
+                if self.fastq_qc and \
+                        not self.stage_done(event, f"uploaded:{project_code}"):
+                    qc = self.start_qc(project_files[project_code])
+                self.deliver_project(event, run, project_code,
+                                     projects[project_code], start, qc)
+            return
+
+        # Projects are uploaded concurrently, sharing the upload threads
+        workers = max(1, min(self.project_upload_workers, len(order)))
+        options = self.transfer_options()
+        options["threads"] = max(1, self.upload_threads // workers)
+        manifest = upload_manifest.UploadManifest(
+            os.path.join(event.fastq_path, upload_manifest.MANIFEST))
+        with metrics.track("upload"):
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                futures = [pool.submit(self.upload_project, event, run,
+                                       project_code, projects[project_code],
+                                       project_files[project_code], manifest,
+                                       options, start)
+                           for project_code in order]
+            # Raise the first failure once every project has finished
+            uploaded = sum(future.result() for future in futures)
+        seconds = time.time() - start
+        metrics.STAGE_BYTES.inc(uploaded, stage="upload")
+        metrics.UPLOAD_BYTES_PER_SECOND.set(uploaded / max(seconds, 1e-6))
+
+    def collect_projects(self, event, run):
+        """
+            Returns ({project_code: S3 key}, {project_code: [(path, key)]})
+            for every project directory of the plate's fastq that
+            contains fastq.gz files. The S3 keys are also kept as
+            event.projects, for the catalogue
+        """
+        projects = {}
+        project_files = {}
+        for dirname in sorted(glob.glob(event.fastq_path + '*/')):
+            fastq_files = glob.glob(dirname + '*.fastq.gz')
             # Skip if no fastq.gz in the directory
-            if not glob.glob(dirname + '*.fastq.gz'):
+            if not fastq_files:
                 continue
             # S3 target
             project_code = basename(os.path.dirname(dirname))
-            key = os.path.join(self.fastq_key, project_code, run_id)
-            # Upload
+            key = self.s3_key(project_code, run["run_id"])
+            projects[project_code] = key
+            project_files[project_code] = [(path, f"{key}/{basename(path)}")
+                                           for path in fastq_files]
+        event.projects = projects
+        return projects, project_files
+
+    def project_order(self, projects):
+        """
+            Returns the project codes with priority projects first, so
+            their pipelines start sooner
+        """
+        order = [project_code for project_code in self.priority_projects
+                 if project_code in projects]
+        return order + [project_code for project_code in projects
+                         if project_code not in order]
+
+    def submit(self, event):
+        """
+            Submits the Salmonella pipeline of each Salmonella project of
+            a plate whose fastq is already on S3, unless the journal
+            records it as submitted
+        """
+        run_id = parse_run_name(event.fastq_path)["run_id"]
+        projects, _ = self.collect_projects(event, {"run_id": run_id})
+        start = time.time()
+        for project_code in self.project_order(projects):
+            self.submit_project(event, run_id, project_code,
+                                projects[project_code], start)
+
+    def catalogue(self, event):
+        """
+            Adds the meta.json of each project of an uploaded plate to
+            the run catalogue on S3. The meta.json files are read back
+            from S3, as some may have been written by an earlier attempt
+        """
+        if self.stage_done(event, "catalogued"):
+            return
+        metas = [catalogue.read_meta(self.fastq_bucket, f"{key}/meta.json",
+                                     self.s3_endpoint_url)
+                 for key in event.projects.values()]
+        catalogue.add_runs(self.fastq_bucket, metas, self.s3_endpoint_url,
+                           self.fastq_key)
+        self.mark_stage_done(event, "catalogued")
+
+    def upload_project(self, event, run, project_code, key, files, manifest,
+                       transfer_options, start):
+        """
+            Uploads the (path, key) fastq files of one project of a
+            plate, unless an earlier attempt did, then delivers it (see
+            deliver_project). Only files missing from S3 or changed
+            since an earlier attempt are uploaded. Returns the bytes
+            uploaded
+        """
+        uploaded = 0
+        qc = None
+        if not self.stage_done(event, f"uploaded:{project_code}"):
+            if self.fastq_qc:
+                # Read alongside the upload, while the files are most
+                # likely still in the page cache
+                qc = self.start_qc(files)
+            results = upload_manifest.upload_files(
+                files, self.fastq_bucket, self.s3_endpoint_url, manifest,
+                **transfer_options)
+            uploaded = sum(result["bytes"] for result in results)
+        self.deliver_project(event, run, project_code, key, start, qc)
+        return uploaded
+
+    def start_qc(self, files):
+        """
+            Computes the fastq_qc.project_stats of the (path, key) files
+            of a project in the background. Returns a Future
+        """
+        def run():
+            with metrics.track("qc"):
+                return fastq_qc.project_stats([path for path, _ in files],
+                                              self.qc_processes)
+
+        return self.qc_pool.submit(run)
+
+    def deliver_project(self, event, run, project_code, key, start,
+                        qc=None):
+        """
+            Uploads the meta.json of a project whose fastq files are on
+            S3 and, for Salmonella projects, submits the pipeline to AWS
+            batch straight away (unless submit_jobs is unset). start is
+            when the plate's upload started.
+
+            qc is a Future of the project's fastq statistics (see
+            start_qc). The project summary is added to meta.json, and
+            the per-sample statistics are uploaded next to it, so
+            meta.json and the batch submission wait for the QC to
+            finish. If it fails, the error is logged and meta.json is
+            written without it
+        """
+        run_id = run["run_id"]
+        if not self.stage_done(event, f"uploaded:{project_code}"):
+            meta = {"project_code": project_code,
+                    "instrument_id": run["instrument_id"],
+                    "run_number": run["run_number"],
+                    "run_id": run_id,
+                    "flowcell_id": run["flowcell_id"],
+                    "sequence_date": run["sequence_date"],
+                    "upload_time": str(datetime.now())}
+            if qc is not None:
+                try:
+                    meta["qc"], samples = qc.result()
+                except Exception as e:
+                    logging.exception(f"Could not compute fastq QC of "
+                                      f"{project_code}: {e}")
+                else:
+                    utils.upload_json(self.fastq_bucket,
+                                      f"{key}/{fastq_qc.STATS_FILE}",
+                                      self.s3_endpoint_url, samples)
             utils.upload_json(self.fastq_bucket,
                               f"{key}/meta.json",
                               self.s3_endpoint_url,
-                              {"project_code": project_code,
-                               "instrument_id": instrument_id,
-                               "run_number": run_number,
-                               "run_id": run_id,
-                               "flowcell_id": flowcell_id,
-                               "sequence_date": str(sequence_date.date()),
-                               "upload_time": str(datetime.now())})
-            utils.s3_sync(dirname, self.fastq_bucket, key, self.s3_endpoint_url)
-            if project_code in SALMONELLA_PROJECT_CODES:
-                # submit salmonella Nextflow pipeline to AWS batch
+                              meta)
+            self.mark_stage_done(event, f"uploaded:{project_code}")
+        if self.submit_jobs:
+            self.submit_project(event, run_id, project_code, key, start)
+
+    def submit_project(self, event, run_id, project_code, key, start):
+        """
+            Submits the Salmonella pipeline of a project to AWS batch,
+            if it is a Salmonella project not yet journalled as
+            submitted. start is when the plate's upload started
+        """
+        if project_code in SALMONELLA_PROJECT_CODES and \
+                not self.stage_done(event, f"submitted:{project_code}"):
+            # submit salmonella Nextflow pipeline to AWS batch
+            with metrics.track("batch_submit"):
                 submit_batch_job(self.fastq_bucket, key,
                                  self.salm_results_bucket,
                                  f"{run_id}_{datetime.today().strftime('%Y%m%d%H%M%S')}",
                                  self.salm_submission_bucket,
                                  self.s3_endpoint_url)
+            self.mark_stage_done(event, f"submitted:{project_code}")
+            logging.info(f"Submitted {project_code} of {run_id} to AWS batch "
+                         f"{time.time() - start:.1f}s after the upload "
+                         "started")
+
+    def is_processed(self, name):
+        """
+            Returns True if the plate has been processed. Uses the plate
+            index if there is one, otherwise looks for bcl-convert
+            output in the fastq_dir
+        """
+        if self.plate_index is not None:
+            return self.plate_index.get(name) is not None
+        return is_processed_plate(os.path.join(self.fastq_dir, name))
+
+    def catch_up(self, complete=None):
+        """
+            Queues every run in the watch_dir that finished copying but
+            was never processed, e.g. while bcl_manager was not running.
+            Runs are queued oldest first. complete is the list of
+            complete runs, from find_complete_runs (scanned if None).
+            Returns the queued run paths
+        """
+        start = time.time()
+        if complete is None:
+            complete = find_complete_runs(self.watch_dir,
+                                          self.copy_complete_filename)
+        runs = [path for path in complete
+                if not self.is_processed(basename(path))]
+        logging.info(f"Found {len(runs)} unprocessed runs in "
+                     f"{self.watch_dir} in {time.time() - start:.1f}s")
+        for path in runs:
+            self.on_created(FileCreatedEvent(
+                os.path.join(path, self.copy_complete_filename)))
+        return runs
+
+    def start_catch_up(self, complete=None):
+        """
+            Runs catch_up in a background thread, so that watching
+            starts while the watch_dir is listed
+        """
+        thread = threading.Thread(target=self.catch_up, args=(complete,),
+                                  daemon=True, name="catch-up")
+        thread.start()
+        return thread
 
     def on_created(self, event):
         """Called when a file or directory is created.
@@ -322,12 +1265,14 @@ class BclEventHandler(FileSystemEventHandler):
         if (ntpath.basename(event.src_path) != self.copy_complete_filename):
             return
 
-        # Extract run number of the plate
-        event.abs_src_path = \
-            os.path.join(os.path.dirname(os.path.abspath(event.src_path)), "")
-        event.src_name = basename(event.abs_src_path[:-1])
-        # Output path for fastq data of the plate
-        event.fastq_path = os.path.join(self.fastq_dir, event.src_name, "")
+        self.set_plate_paths(event)
+
+        # Hand over to the submit thread so the file watcher is not
+        # blocked
+        if self.scheduler is not None:
+            logging.info('Scheduling new plate: %s' % event.src_path)
+            self.submissions.put(event)
+            return
 
         # log if anything fails
         try:
@@ -337,12 +1282,59 @@ class BclEventHandler(FileSystemEventHandler):
             logging.exception(e)
             raise e
 
+        self.plate_processed(event)
+
+    def set_plate_paths(self, event):
+        """
+            Sets the run directory (abs_src_path), run name (src_name)
+            and fastq output directory (fastq_path) of the plate whose
+            CopyComplete.txt event.src_path is
+        """
+        # Extract run number of the plate
+        event.abs_src_path = \
+            os.path.join(os.path.dirname(os.path.abspath(event.src_path)), "")
+        event.src_name = basename(event.abs_src_path[:-1])
+        # Output path for fastq data of the plate
+        event.fastq_path = os.path.join(self.fastq_dir, event.src_name, "")
+
+    def plate_processed(self, event):
+        """
+            Called once a plate has been fully processed
+        """
+        self.release_reservation(event)
         # Log remaining disk space
         logging.info('New Illumina Plate Processed: %s' % event.src_path)
         log_disk_usage(self.watch_dir)
         log_disk_usage(self.fastq_dir)
         log_disk_usage(self.backup_dir)
 
+    def register_metrics(self):
+        """
+            Collects the scheduler's queue depth and the free space of
+            each directory whenever the metrics are exported
+        """
+        def plates():
+            return {(stage, state): len(names)
+                    for stage, states in self.scheduler.status().items()
+                    for state, names in states.items()}
+
+        def free_bytes():
+            return {(path,): monitor_disk_usage(path)[1]
+                    for path in [self.watch_dir, self.backup_dir,
+                                 self.fastq_dir]}
+
+        if self.scheduler is not None:
+            metrics.QUEUE_DEPTH.set_function(plates)
+        metrics.FREE_BYTES.set_function(free_bytes)
+
+    def plate_failed(self, event, stage, exception):
+        """
+            Called when a stage of a scheduled plate raises
+        """
+        self.release_reservation(event)
+        if self.run_watcher is not None:
+            self.run_watcher.rearm(event.abs_src_path)
+
 
 class SubdirectoryException(Exception):
     """
@@ -359,9 +1351,40 @@ def start(watch_dir,
           fastq_key,
           s3_endpoint_url,
           salm_submission_bucket,
-          salm_results_bucket):
+          salm_results_bucket,
+          copy_workers=1,
+          convert_workers=1,
+          upload_workers=1,
+          max_plates=8,
+          clean_up_interval=60*60,
+          catch_up=True,
+          metrics_port=None,
+          metrics_textfile=None,
+          watch_mode="recursive",
+          poll_interval=5*60,
+          **handler_options):
     """
         Watches a directory for CopyComplete.txt files
+
+        Plates are processed by a PlateScheduler. copy_workers,
+        convert_workers and upload_workers set how many plates may run
+        each stage at the same time (convert_workers also applies to
+        recompress). max_plates bounds the number of
+        plates queued or in flight. Clean up runs every
+        clean_up_interval seconds. If catch_up is set, runs that finished
+        copying while bcl_manager was not running are queued, oldest
+        first, alongside watching. Metrics are served on localhost at
+        metrics_port and/or written to metrics_textfile, if set.
+
+        watch_mode selects how CopyComplete.txt files are found:
+        "recursive" watches the whole watch_dir tree, "runs" only
+        watches the top level of watch_dir and of each incomplete run
+        (also polling every poll_interval seconds for missed events),
+        and "poll" only polls every poll_interval seconds (see
+        run_watcher.RunWatcher).
+
+        Any other keyword arguments (e.g. overlap_backup,
+        upload_threads) are passed on to BclEventHandler.
     """
     #  Ensure backup/fastq dirs are not subdirectories of watch_dir.
     #    This causes catastrophic recursive behaviors
@@ -374,47 +1397,278 @@ def start(watch_dir,
                                      of the watch directory")
 
     # Setup file watcher in a new thread
-    observer = Observer()
+    observer = observers.Observer()
     handler = BclEventHandler(watch_dir, backup_dir, fastq_dir, fastq_bucket,
                               fastq_key, s3_endpoint_url,
-                              salm_submission_bucket, salm_results_bucket)
-    observer.schedule(handler, watch_dir, recursive=True)
+                              salm_submission_bucket, salm_results_bucket,
+                              **handler_options)
+    handler.start_scheduler({"copy": copy_workers,
+                             "convert": convert_workers,
+                             "recompress": convert_workers,
+                             "upload": upload_workers},
+                            max_plates)
+    handler.start_clean_up(clean_up_interval)
+    handler.register_metrics()
+    if metrics_port is not None:
+        metrics.start_http_server(metrics_port)
+    if metrics_textfile is not None:
+        metrics.start_textfile_writer(metrics_textfile)
+    # Runs complete on start up are left to the catch up. The run
+    # watcher is given the same runs, so that it reports every other
+    # run, including any completing after the catch up's scan
+    complete = None
+    if watch_mode in ("runs", "poll"):
+        complete = find_complete_runs(handler.watch_dir,
+                                      handler.copy_complete_filename)
+    if watch_mode == "recursive":
+        observer.schedule(handler, watch_dir, recursive=True)
+    elif watch_mode in ("runs", "poll"):
+        handler.run_watcher = RunWatcher(
+            handler, watch_dir, handler.copy_complete_filename,
+            observer if watch_mode == "runs" else None, poll_interval)
+        handler.run_watcher.start(complete)
+    else:
+        raise Exception(f"Unknown watch mode: {watch_mode}")
 
     # Start File Watcher
     observer.start()
+    # Only once watching, so that in recursive mode a run completing
+    # before the catch up's scan is seen by one or the other
+    if catch_up:
+        handler.start_catch_up(complete)
     logging.info(f"""
         --------------------
         BCL Manager Started
         --------------------
 
-        Bcl Watch Directory: {watch_dir}
+        Bcl Watch Directory: {watch_dir} ({watch_mode})
         Backup Directory: {handler.backup_dir}
         Fastq Directory: {handler.fastq_dir}
+        Workers (copy/convert/upload): {copy_workers}/{convert_workers}/{upload_workers}
     """)
 
     # Sleep till exit
     observer.join()
+    handler.submissions.join()
+    handler.scheduler.shutdown()
 
 
-if __name__ == "__main__":
-    # Parse
-    parser = argparse.ArgumentParser(description="Watch a directory for a \
-                                     creation of CopyComplete.txt files")
-    parser.add_argument('dir', nargs='?',
-                        default='/Illumina/IncomingRuns/',
-                        help='Watch directory')
+# Stages the backfill command can run, in order
+BACKFILL_STAGES = ["backup", "convert", "recompress", "upload", "submit"]
+
+
+def default_backfill_stages(recompress_fastq=False):
+    """
+        Returns the stages backfilled by default: every stage, but
+        recompress only if recompress_fastq is set
+    """
+    return [stage for stage in BACKFILL_STAGES
+            if stage != "recompress" or recompress_fastq]
+
+
+def backfill_stages(stages):
+    """
+        Returns the backfill stages that run on their own, in order.
+        Along with upload, submit is part of the upload stage
+    """
+    return [stage for stage in BACKFILL_STAGES if stage in stages and
+            not (stage == "submit" and "upload" in stages)]
+
+
+def find_runs(patterns, copy_complete_filename='CopyComplete.txt'):
+    """
+        Returns the run directories matching a list of paths or glob
+        patterns, in the order given (the matches of each pattern
+        sorted), without duplicates. Raises an exception if a pattern
+        matches no directory, if two runs have the same name or if a
+        run has not finished copying
+    """
+    runs = []
+    for pattern in patterns:
+        matches = sorted(os.path.join(os.path.abspath(path), "")
+                         for path in glob.glob(pattern)
+                         if os.path.isdir(path))
+        if not matches:
+            raise Exception(f"No run directories match: {pattern}")
+        runs += [path for path in matches if path not in runs]
+
+    names = [basename(path[:-1]) for path in runs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise Exception(f"Runs with the same name: {', '.join(duplicates)}")
+
+    incomplete = [path for path in runs if not os.path.isfile(
+        os.path.join(path, copy_complete_filename))]
+    if incomplete:
+        raise Exception("Runs have not finished copying: "
+                        f"{', '.join(incomplete)}")
+    return runs
+
+
+def backfill(runs,
+             watch_dir,
+             backup_dir,
+             fastq_dir,
+             fastq_bucket,
+             fastq_key,
+             s3_endpoint_url,
+             salm_submission_bucket,
+             salm_results_bucket,
+             stages=None,
+             copy_workers=1,
+             convert_workers=1,
+             upload_workers=1,
+             max_plates=8,
+             **handler_options):
+    """
+        Processes run directories without the file watcher, e.g. to
+        reprocess runs after a failure. Only the given stages are run,
+        in the order of BACKFILL_STAGES (by default every stage, but
+        recompress only if recompress_fastq is set):
+
+            backup: back up the raw bcl data to backup_dir
+            convert: convert the raw bcl data to fastq
+            recompress: recompress the fastq as BGZF (see recompress.py)
+            upload: upload the fastq and meta.json of each project, and
+                    add the run to the catalogue if catalogue_runs is set
+            submit: submit the Salmonella pipeline of the uploaded
+                    fastq. Along with upload, each project is submitted
+                    as soon as it is uploaded, as part of that stage
+
+        Runs are processed by a PlateScheduler, so one run can be
+        converting while another uploads. copy_workers, convert_workers
+        and upload_workers set how many runs may run the backup,
+        convert (and recompress) and upload (or submit) stages at the
+        same time. Old
+        plates are not cleaned up, and runs are never deferred for lack
+        of space. With a plate index, stages journalled as complete are
+        skipped, so runs can be backfilled again after a failure.
+
+        watch_dir is only used to slow down copies and uploads while
+        sequencers write to it (see busy_factor). Any other keyword
+        arguments are passed on to BclEventHandler.
+
+        Returns a list with a dictionary for each run, in order:
+            {"run": str, "seconds": {stage: float}, "error": str or None}
+        where error names the stage that failed
+    """
+    if stages is None:
+        stages = default_backfill_stages(
+            handler_options.get("recompress_fastq", False))
+    unknown = sorted(set(stages) - set(BACKFILL_STAGES))
+    if unknown or not stages:
+        raise Exception(f"Unknown backfill stages: {', '.join(unknown)}")
+
+    # Nothing is cleaned up, so the watcher's trash is left to it
+    handler_options["background_deletion"] = False
+    handler = BclEventHandler(watch_dir, backup_dir, fastq_dir, fastq_bucket,
+                              fastq_key, s3_endpoint_url,
+                              salm_submission_bucket, salm_results_bucket,
+                              submit_jobs="submit" in stages,
+                              **handler_options)
+    functions = {"backup": handler.backup,
+                 "convert": handler.convert,
+                 "recompress": handler.recompress,
+                 "upload": lambda event: handler.deliver(event,
+                                                         clean_up=False),
+                 "submit": handler.submit}
+    selected = backfill_stages(stages)
+
+    # Run name -> result, in the order the runs were given
+    results = {}
+
+    def timed(stage, function):
+        def run(event):
+            started = time.time()
+            try:
+                function(event)
+            finally:
+                results[event.src_name]["seconds"][stage] = \
+                    time.time() - started
+        return run
+
+    def failed(event, stage, exception):
+        results[event.src_name]["error"] = f"{stage}: {exception}"
+
+    handler.set_convert_workers(convert_workers)
+    scheduler = PlateScheduler([(stage, timed(stage, functions[stage]))
+                                for stage in selected],
+                               {"backup": copy_workers,
+                                "convert": convert_workers,
+                                "recompress": convert_workers,
+                                "upload": upload_workers,
+                                "submit": upload_workers},
+                               max_plates, on_error=failed)
+
+    start = time.time()
+    logging.info(f"Backfilling {len(runs)} runs ({', '.join(selected)})")
+    for path in runs:
+        event = FileCreatedEvent(os.path.join(path,
+                                              handler.copy_complete_filename))
+        handler.set_plate_paths(event)
+        results[event.src_name] = {"run": event.src_name, "seconds": {},
+                                   "error": None}
+        scheduler.submit(event.src_name, event)
+    scheduler.shutdown()
+
+    results = list(results.values())
+    failures = sum(1 for result in results if result["error"])
+    logging.info(f"Backfilled {len(results) - failures}/{len(results)} runs "
+                 f"in {time.time() - start:.1f}s")
+    return results
+
+
+def timing_summary(results, stages):
+    """
+        Returns a table of the seconds each run of backfill() spent in
+        each of the stages, with the outcome of the run and the total
+        time of each stage
+    """
+    width = max([len("Total")] + [len(result["run"]) for result in results])
+
+    def row(name, seconds, status):
+        cells = "".join(f"{seconds[stage]:>9.1f}s" if stage in seconds
+                        else f"{'-':>10}" for stage in stages)
+        return f"{name:<{width}}{cells}  {status}".rstrip()
+
+    lines = [f"{'Run':<{width}}" +
+             "".join(f"{stage:>10}" for stage in stages) + "  Status"]
+    for result in results:
+        lines.append(row(result["run"], result["seconds"],
+                         f"failed in {result['error']}" if result["error"]
+                         else "ok"))
+    totals = {stage: sum(result["seconds"][stage] for result in results
+                         if stage in result["seconds"])
+              for stage in stages
+              if any(stage in result["seconds"] for result in results)}
+    lines.append(row("Total", totals, ""))
+    return "\n".join(lines)
+
+
+def add_common_arguments(parser, log_name):
+    """
+        Adds the options shared by the watch and backfill commands.
+        Logs are written to ./{log_name} and uploaded to
+        logs/{log_name} by default
+    """
     parser.add_argument('--backup-dir',
                         default='/Illumina/OutputFastq/BclRuns/',
                         help='Where to backup data to')
     parser.add_argument('--fastq-dir',
                         default='/Illumina/OutputFastq/FastqRuns/',
                         help='Where to put converted fastq data')
+    parser.add_argument('--log-file', default=f'./{log_name}',
+                        help='Local log file')
     parser.add_argument('--s3-log-bucket',
                         default='s3-csu-001',
                         help='S3 Bucket to upload log file')
     parser.add_argument('--s3-log-key',
-                        default='logs/bcl-manager.log',
+                        default=f'logs/{log_name}',
                         help='S3 Key to upload log file')
+    parser.add_argument('--s3-log-flush-seconds', type=int, default=30,
+                        help='Seconds between uploads of the log file')
+    parser.add_argument('--s3-log-max-mb', type=int, default=10,
+                        help='Rotate the log file once it reaches this size')
     parser.add_argument('--s3-fastq-bucket',
                         default='s3-csu-001',
                         help='S3 Bucket to upload fastq files')
@@ -430,21 +1684,185 @@ if __name__ == "__main__":
     parser.add_argument('--salmonella-results-bucket',
                         default='s3-ranch-050',
                         help='S3 bucket for Salmonella pipeline results')
-
-    args = parser.parse_args()
-
-    # Setup logging
+    parser.add_argument('--copy-workers', type=int, default=1,
+                        help='Number of plates backed up at the same time')
+    parser.add_argument('--convert-workers', type=int, default=1,
+                        help='Number of plates converted at the same time')
+    parser.add_argument('--upload-workers', type=int, default=1,
+                        help='Number of plates uploaded at the same time')
+    parser.add_argument('--max-plates', type=int, default=8,
+                        help='Maximum number of plates queued or in flight')
+    parser.add_argument('--plate-index',
+                        help='SQLite index of processed plates used by '
+                             f'clean up (default: {INDEX_FILE} in the fastq '
+                             'directory)')
+    parser.add_argument('--rebuild-plate-index', action='store_true',
+                        help='Rebuild the plate index from the fastq '
+                             'directory on start up')
+    parser.add_argument('--bcl-threads', type=int,
+                        help='bcl-convert threads per conversion (default: '
+                             'the CPUs shared between --convert-workers)')
+    parser.add_argument('--pin-cpus', action='store_true',
+                        help='Pin each conversion to its share of the CPUs')
+    parser.add_argument('--convert-nice', type=int,
+                        help='Nice level to run bcl-convert at')
+    parser.add_argument('--convert-ionice', type=int, choices=range(8),
+                        help='Best-effort I/O priority to run bcl-convert at')
+    parser.add_argument('--copy-threads', type=int, default=8,
+                        help='Number of files backed up at the same time')
+    parser.add_argument('--backup-format', choices=['tree', 'archive'],
+                        default='tree',
+                        help='Back up runs as a directory tree or as '
+                             'indexed tar archives')
+    parser.add_argument('--archive-shard-gb', type=int, default=16,
+                        help='Maximum size of each archive backup shard')
+    parser.add_argument('--upload-threads', type=int, default=8,
+                        help='Number of concurrent S3 part uploads')
+    parser.add_argument('--part-size-mb', type=int, default=64,
+                        help='Size of each part of a multipart S3 upload')
+    parser.add_argument('--multipart-threshold-mb', type=int, default=64,
+                        help='Upload files of at least this size in parts')
+    parser.add_argument('--upload-limit-mb', type=float,
+                        help='Limit the fastq upload to this many Mb/s')
+    parser.add_argument('--copy-limit-mb', type=float,
+                        help='Limit the backup copy to this many Mb/s')
+    parser.add_argument('--full-speed-hours', type=parse_hours,
+                        help='Hours of the day without upload and copy '
+                             'limits, e.g. 22-6')
+    parser.add_argument('--busy-factor', type=float, default=1.0,
+                        help='Multiply the upload and copy limits by this '
+                             'while runs are still being sequenced')
+    parser.add_argument('--project-upload-workers', type=int, default=2,
+                        help='Number of projects of a plate uploaded at '
+                             'the same time')
+    parser.add_argument('--priority-projects', nargs='+',
+                        default=SALMONELLA_PROJECT_CODES,
+                        help='Project codes uploaded before the others')
+    parser.add_argument('--fastq-qc', action='store_true',
+                        help='Add fastq read counts and qualities to '
+                             'meta.json. Delays meta.json and the batch '
+                             'submission until every file has been read')
+    parser.add_argument('--qc-processes', type=int, default=4,
+                        help='Number of fastq files of a project read at '
+                             'the same time for QC')
+    parser.add_argument('--no-catalogue', action='store_true',
+                        help='Do not add uploaded runs to the catalogue on '
+                             'S3')
+    parser.add_argument('--no-background-deletion', action='store_true',
+                        help='Delete old plates during clean up rather '
+                             'than in the background')
+    parser.add_argument('--deletion-threads', type=int, default=4,
+                        help='Number of directories of old plates deleted '
+                             'at the same time')
+    parser.add_argument('--deletion-limit', type=int,
+                        help='Delete at most this many files per second')
+    parser.add_argument('--recompress', action='store_true',
+                        help='Recompress fastq files as BGZF before '
+                             'uploading them')
+    parser.add_argument('--recompress-level', type=int, choices=range(1, 10),
+                        default=6,
+                        help='gzip compression level of recompressed fastq')
+    parser.add_argument('--recompress-processes', type=int, default=4,
+                        help='Number of fastq files of a plate recompressed '
+                             'at the same time')
+
+
+def handler_options(args):
+    """
+        Returns the BclEventHandler keyword arguments of the options
+        added by add_common_arguments
+    """
+    plate_index_path = args.plate_index
+    if plate_index_path is None:
+        plate_index_path = os.path.join(args.fastq_dir, INDEX_FILE)
+    return {"plate_index_path": plate_index_path,
+            "rebuild_plate_index": args.rebuild_plate_index,
+            "bcl_threads": args.bcl_threads,
+            "pin_cpus": args.pin_cpus,
+            "convert_nice": args.convert_nice,
+            "convert_ionice": args.convert_ionice,
+            "copy_threads": args.copy_threads,
+            "backup_format": args.backup_format,
+            "archive_shard_size": args.archive_shard_gb * 1024**3,
+            "upload_threads": args.upload_threads,
+            "part_size": args.part_size_mb * 1024**2,
+            "multipart_threshold": args.multipart_threshold_mb * 1024**2,
+            "upload_limit": args.upload_limit_mb and
+            args.upload_limit_mb * 1024**2,
+            "copy_limit": args.copy_limit_mb and args.copy_limit_mb * 1024**2,
+            "full_speed_hours": args.full_speed_hours,
+            "busy_factor": args.busy_factor,
+            "project_upload_workers": args.project_upload_workers,
+            "priority_projects": args.priority_projects,
+            "fastq_qc": args.fastq_qc,
+            "qc_processes": args.qc_processes,
+            "catalogue_runs": not args.no_catalogue,
+            "background_deletion": not args.no_background_deletion,
+            "deletion_threads": args.deletion_threads,
+            "deletion_limit": args.deletion_limit,
+            "recompress_fastq": args.recompress,
+            "recompress_level": args.recompress_level,
+            "recompress_processes": args.recompress_processes}
+
+
+def setup_logging(args):
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S',
         handlers=[logging.StreamHandler(),
-                  S3LoggingHandler('./bcl-manager.log',
+                  S3LoggingHandler(args.log_file,
                                    args.s3_log_bucket,
                                    args.s3_log_key,
-                                   args.s3_endpoint_url)])
+                                   args.s3_endpoint_url,
+                                   args.s3_log_flush_seconds,
+                                   max_bytes=args.s3_log_max_mb * 1024**2)])
 
-    # Run
+
+def watch_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="bcl_manager.py [watch]",
+        description="Watch a directory for a creation of CopyComplete.txt "
+                    "files. See 'bcl_manager.py backfill --help' to "
+                    "process runs without watching")
+    parser.add_argument('dir', nargs='?',
+                        default='/Illumina/IncomingRuns/',
+                        help='Watch directory')
+    add_common_arguments(parser, 'bcl-manager.log')
+    parser.add_argument('--clean-up-interval-minutes', type=int, default=60,
+                        help='Minutes between clean up runs')
+    parser.add_argument('--no-catch-up', action='store_true',
+                        help='Do not queue runs that completed while '
+                             'bcl_manager was not running')
+    parser.add_argument('--min-free-gb', type=int, default=100,
+                        help='Defer plates that would leave less free '
+                             'space than this on the backup or fastq disk')
+    parser.add_argument('--fastq-size-ratio', type=float, default=1.0,
+                        help='Estimated size of the fastq output relative '
+                             'to the raw bcl data')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on this localhost '
+                             'port')
+    parser.add_argument('--metrics-textfile',
+                        help='Write Prometheus metrics to this file for '
+                             'the node_exporter textfile collector')
+    parser.add_argument('--watch-mode', choices=['runs', 'poll', 'recursive'],
+                        default='runs',
+                        help='Watch only the top level of each run '
+                             'directory, only poll, or watch every file')
+    parser.add_argument('--poll-seconds', type=int, default=5*60,
+                        help='Seconds between scans of the watch directory '
+                             'in the runs and poll watch modes')
+    parser.add_argument('--overlap-backup', action='store_true',
+                        help='Backup raw bcl data while converting to fastq')
+    parser.add_argument('--stream-upload', action='store_true',
+                        help='Upload fastq files while bcl-convert runs')
+    parser.add_argument('--settle-seconds', type=int, default=60,
+                        help='Seconds a fastq file must be unchanged for '
+                             'before it is streamed')
+    args = parser.parse_args(argv)
+
+    setup_logging(args)
     start(args.dir,
           args.backup_dir,
           args.fastq_dir,
@@ -452,4 +1870,88 @@ if __name__ == "__main__":
           args.s3_fastq_key,
           args.s3_endpoint_url,
           args.salmonella_submission_bucket,
-          args.salmonella_results_bucket)
+          args.salmonella_results_bucket,
+          args.copy_workers,
+          args.convert_workers,
+          args.upload_workers,
+          args.max_plates,
+          args.clean_up_interval_minutes * 60,
+          not args.no_catch_up,
+          args.metrics_port,
+          args.metrics_textfile,
+          args.watch_mode,
+          args.poll_seconds,
+          min_free_bytes=args.min_free_gb * 1024**3,
+          fastq_size_ratio=args.fastq_size_ratio,
+          overlap_backup=args.overlap_backup,
+          stream_upload=args.stream_upload,
+          settle_seconds=args.settle_seconds,
+          **handler_options(args))
+    return 0
+
+
+def backfill_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="bcl_manager.py backfill",
+        description="Process run directories without the file watcher, "
+                    "running several at a time, and print how long each "
+                    "stage of each run took")
+    parser.add_argument('runs', nargs='+',
+                        help='Run directories, or glob patterns of run '
+                             'directories, e.g. "/Illumina/IncomingRuns/'
+                             '2204*/"')
+    parser.add_argument('--stages', nargs='+', choices=BACKFILL_STAGES,
+                        help='Stages to run (default: all, recompress only '
+                             'with --recompress). Along with upload, submit '
+                             'runs as each project is uploaded')
+    parser.add_argument('--watch-dir', default='/Illumina/IncomingRuns/',
+                        help='Directory sequencers write runs to, used by '
+                             '--busy-factor')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only list the runs that would be processed')
+    add_common_arguments(parser, 'bcl-manager-backfill.log')
+    args = parser.parse_args(argv)
+
+    runs = find_runs(args.runs)
+    stages = args.stages or default_backfill_stages(args.recompress)
+    if args.dry_run:
+        print(f"Would run {', '.join(stages)} on {len(runs)} runs:")
+        print("\n".join(runs))
+        return 0
+
+    setup_logging(args)
+    results = backfill(runs,
+                       args.watch_dir,
+                       args.backup_dir,
+                       args.fastq_dir,
+                       args.s3_fastq_bucket,
+                       args.s3_fastq_key,
+                       args.s3_endpoint_url,
+                       args.salmonella_submission_bucket,
+                       args.salmonella_results_bucket,
+                       stages,
+                       args.copy_workers,
+                       args.convert_workers,
+                       args.upload_workers,
+                       args.max_plates,
+                       **handler_options(args))
+    print(timing_summary(results, backfill_stages(stages)))
+    return 1 if any(result["error"] for result in results) else 0
+
+
+def main(argv=None):
+    """
+        Runs a command: "watch" (the default, so the command may be
+        left out) watches a directory for new runs, "backfill"
+        processes given run directories
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] == "backfill":
+        return backfill_main(argv[1:])
+    if argv and argv[0] == "watch":
+        argv = argv[1:]
+    return watch_main(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,581 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+"""
+benchmark.py measures the throughput of the whole bcl_manager pipeline.
+
+It generates synthetic run directories, replaces bcl-convert with a fake
+that writes fastq.gz files at a configurable rate, and uploads to an
+in-memory S3 (moto) unless an endpoint url is given. Plates are driven
+through BclEventHandler and its scheduler exactly as the file watcher
+would, and plates/hour, per-stage timings and peak memory are reported.
+
+Results can be saved as a JSON baseline, and later runs compared with
+it:
+
+    python benchmark.py --plates 4 --save-baseline baseline.json
+    python benchmark.py --plates 4 --baseline baseline.json
+
+The cost of fastq QC is measured by comparing a run with --fastq-qc
+against a baseline without it:
+
+    python benchmark.py --save-baseline plain.json
+    python benchmark.py --fastq-qc --baseline plain.json
+
+and likewise for recompressing the fastq with --recompress.
+
+The overhead of each file watching mode can be compared with:
+
+    python benchmark.py --watcher --plates 4 --files 2000
+"""
+
+SAMPLE_SHEET = """[Header]
+FileFormatVersion,2
+RunName,{name}
+
+[BCLConvert_Settings]
+CreateFastqForIndexReads,0
+
+[BCLConvert_Data]
+Sample_ID,Sample_Project
+{samples}
+"""
+
+RUN_INFO = """<?xml version="1.0"?>
+<RunInfo Version="5">
+  <Run Id="{name}" Number="{number}">
+    <Flowcell>{flowcell}</Flowcell>
+    <Instrument>{instrument}</Instrument>
+  </Run>
+</RunInfo>
+"""
+
+INSTRUMENT = "NB000000"
+
+# Bytes of generated data reused for every file
+BLOCK_SIZE = 1024**2
+
+# Timings and bytes reported for each stage
+STAGES = ["copy", "convert", "recompress", "upload", "qc", "batch_submit",
+          "cleanup"]
+
+
+def random_block(size=BLOCK_SIZE, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def fastq_block(size=BLOCK_SIZE, seed=0):
+    """
+        Returns about 'size' bytes of fastq records with random 150bp
+        reads, which compress about as well as real reads
+    """
+    rng = random.Random(seed)
+    records = []
+    total = 0
+    while total < size:
+        read = "".join(rng.choices("ACGT", k=150))
+        quality = "".join(rng.choices("FF:,", weights=[80, 10, 5, 5], k=150))
+        record = f"@BENCH:{len(records)} 1:N:0:1\n{read}\n+\n{quality}\n"
+        records.append(record)
+        total += len(record)
+    return "".join(records).encode()
+
+
+def write_file(path, size, block):
+    with open(path, "wb") as f:
+        while size > 0:
+            f.write(block[:size])
+            size -= len(block)
+
+
+def make_run(watch_dir, number, projects, files=32, file_size=16*1024**2,
+             copy_complete_filename="CopyComplete.txt"):
+    """
+        Creates a synthetic run directory in watch_dir named like
+        yymmdd_instrumentID_runnumber_flowcellID, with 'files' cbcl
+        files of 'file_size' bytes, a SampleSheet.csv with a sample in
+        each project and a RunInfo.xml. copy_complete_filename is
+        written last. Returns the run directory
+    """
+    sequence_date = date(2022, 1, 1) + timedelta(days=number)
+    flowcell = f"BENCH{number:04d}XX"
+    name = f"{sequence_date:%y%m%d}_{INSTRUMENT}_{number:04d}_{flowcell}"
+    run_dir = os.path.join(watch_dir, name)
+
+    block = random_block(min(file_size, BLOCK_SIZE), number)
+    lanes = max(1, min(4, files))
+    for i in range(files):
+        cycle_dir = os.path.join(run_dir, "Data", "Intensities", "BaseCalls",
+                                 f"L{i % lanes + 1:03d}",
+                                 f"C{i // lanes + 1}.1")
+        os.makedirs(cycle_dir, exist_ok=True)
+        write_file(os.path.join(cycle_dir, f"L{i % lanes + 1:03d}_1.cbcl"),
+                   file_size, block)
+
+    samples = "\n".join(f"{project}-{number}-S{i},{project}"
+                        for i, project in enumerate(projects))
+    with open(os.path.join(run_dir, "SampleSheet.csv"), "w") as f:
+        f.write(SAMPLE_SHEET.format(name=name, samples=samples))
+    with open(os.path.join(run_dir, "RunInfo.xml"), "w") as f:
+        f.write(RUN_INFO.format(name=name, number=number, flowcell=flowcell,
+                                instrument=INSTRUMENT))
+    open(os.path.join(run_dir, copy_complete_filename), "w").close()
+    return run_dir
+
+
+def read_samples(sample_sheet):
+    """
+        Returns (sample id, project) of each sample in a sample sheet
+    """
+    samples = []
+    with open(sample_sheet) as f:
+        in_data = False
+        header = False
+        for line in f:
+            line = line.strip()
+            if line.startswith("["):
+                in_data = line.endswith("_Data]") or line == "[Data]"
+                header = True
+                continue
+            if not in_data or not line:
+                continue
+            if header:
+                header = False
+                continue
+            sample_id, project = line.split(",")[:2]
+            samples.append((sample_id, project))
+    return samples
+
+
+def fake_bcl_convert(argv):
+    """
+        Stands in for bcl-convert. Writes an R1 and R2 fastq.gz of
+        BENCHMARK_FASTQ_BYTES bytes for each sample into its project
+        directory at BENCHMARK_FASTQ_RATE bytes per second (0 for no
+        limit), and the Logs and Reports directories
+    """
+    parser = argparse.ArgumentParser(prog="bcl-convert")
+    parser.add_argument("--output-directory", required=True)
+    parser.add_argument("--bcl-input-directory", required=True)
+    parser.add_argument("--sample-sheet", required=True)
+    args, _ = parser.parse_known_args(argv)
+
+    size = int(os.environ.get("BENCHMARK_FASTQ_BYTES", 8 * 1024**2))
+    rate = float(os.environ.get("BENCHMARK_FASTQ_RATE", 0))
+
+    os.makedirs(args.output_directory)
+    block = fastq_block()
+    start = time.time()
+    written = 0
+    for sample_id, project in read_samples(args.sample_sheet):
+        os.makedirs(os.path.join(args.output_directory, project),
+                    exist_ok=True)
+        for read in ["R1", "R2"]:
+            path = os.path.join(args.output_directory, project,
+                                f"{sample_id}_S1_{read}_001.fastq.gz")
+            with open(path, "wb") as raw, \
+                    gzip.GzipFile(fileobj=raw, mode="wb",
+                                  compresslevel=1) as f:
+                while raw.tell() < size:
+                    f.write(block)
+                    if rate:
+                        # Sleep until the target rate is met
+                        written += len(block)
+                        delay = written / rate - (time.time() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+    for directory in ["Logs", "Reports"]:
+        os.makedirs(os.path.join(args.output_directory, directory))
+
+
+def install_fake_bcl_convert(bin_dir):
+    """
+        Writes a bcl-convert executable to bin_dir that runs
+        fake_bcl_convert, and puts bin_dir first on the PATH
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "bcl-convert")
+    with open(path, "w") as f:
+        f.write(f"#!/bin/sh\nexec '{sys.executable}' "
+                f"'{os.path.abspath(__file__)}' fake-bcl-convert \"$@\"\n")
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+
+def use_fake_credentials(config_dir):
+    """
+        Points boto3 at dummy credentials, including the "batch" profile
+        used to submit batch jobs
+    """
+    path = os.path.join(config_dir, "aws-config")
+    with open(path, "w") as f:
+        for section in ["default", "profile batch"]:
+            f.write(f"[{section}]\naws_access_key_id = benchmark\n"
+                    "aws_secret_access_key = benchmark\n"
+                    "region = eu-west-1\n")
+    os.environ["AWS_CONFIG_FILE"] = path
+    os.environ["AWS_SHARED_CREDENTIALS_FILE"] = path
+
+
+def peak_rss_mb():
+    """
+        Returns the peak resident memory of this process and of its
+        largest child process (e.g. bcl-convert) in Mb
+    """
+    return {who: resource.getrusage(usage).ru_maxrss / 1024
+            for who, usage in [("self", resource.RUSAGE_SELF),
+                               ("children", resource.RUSAGE_CHILDREN)]}
+
+
+def run_benchmark(work_dir, plates=4, projects=("FZ2000", "FZ2001", "FZ2002"),
+                  files=32, file_size=16*1024**2, fastq_bytes=8*1024**2,
+                  fastq_rate=0, s3_endpoint_url=None, copy_workers=1,
+                  convert_workers=1, upload_workers=1, max_plates=8,
+                  **handler_options):
+    """
+        Generates 'plates' runs in work_dir and processes them through
+        BclEventHandler. Returns a dictionary of results
+    """
+    import bcl_manager
+    import metrics
+    import utils
+    from watchdog.events import FileCreatedEvent
+
+    dirs = {name: os.path.join(work_dir, name)
+            for name in ["watch", "backup", "fastq", "bin"]}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+
+    install_fake_bcl_convert(dirs["bin"])
+    os.environ["BENCHMARK_FASTQ_BYTES"] = str(fastq_bytes)
+    os.environ["BENCHMARK_FASTQ_RATE"] = str(fastq_rate)
+    use_fake_credentials(work_dir)
+    utils.clear_s3_clients()
+
+    buckets = {"fastq": "benchmark-fastq",
+               "submission": "benchmark-submission",
+               "results": "benchmark-results"}
+    s3 = utils.s3_client(s3_endpoint_url)
+    for bucket in buckets.values():
+        s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={
+            "LocationConstraint": "eu-west-1"})
+
+    generate_start = time.time()
+    runs = [make_run(dirs["watch"], number, projects, files, file_size)
+            for number in range(plates)]
+    generate_seconds = time.time() - generate_start
+
+    before = {stage: (metrics.STAGE_SECONDS.count(stage=stage),
+                      metrics.STAGE_SECONDS.total(stage=stage),
+                      metrics.STAGE_BYTES.get(stage=stage),
+                      metrics.STAGE_FAILURES.get(stage=stage))
+              for stage in STAGES}
+
+    handler = bcl_manager.BclEventHandler(
+        dirs["watch"], dirs["backup"], dirs["fastq"], buckets["fastq"], "",
+        s3_endpoint_url, buckets["submission"], buckets["results"],
+        plate_index_path=os.path.join(work_dir, "plate-index.sqlite"),
+        **handler_options)
+    handler.start_scheduler({"copy": copy_workers,
+                             "convert": convert_workers,
+                             "recompress": convert_workers,
+                             "upload": upload_workers}, max_plates)
+
+    start = time.time()
+    for run in runs:
+        handler.on_created(FileCreatedEvent(
+            os.path.join(run, handler.copy_complete_filename)))
+    handler.submissions.join()
+    handler.scheduler.shutdown()
+    # Processed raw bcl data is removed by the next clean up
+    handler.run_clean_up()
+    seconds = time.time() - start
+    handler.plate_index.close()
+
+    stages = {}
+    for stage in STAGES:
+        count, total, processed, failures = before[stage]
+        count = metrics.STAGE_SECONDS.count(stage=stage) - count
+        total = metrics.STAGE_SECONDS.total(stage=stage) - total
+        stages[stage] = {
+            "runs": count,
+            "seconds_total": total,
+            "seconds_mean": total / count if count else None,
+            "bytes": metrics.STAGE_BYTES.get(stage=stage) - processed,
+            "failures": metrics.STAGE_FAILURES.get(stage=stage) - failures}
+
+    return {"config": {"plates": plates, "projects": list(projects),
+                       "files": files, "file_size": file_size,
+                       "fastq_bytes": fastq_bytes, "fastq_rate": fastq_rate,
+                       "copy_workers": copy_workers,
+                       "convert_workers": convert_workers,
+                       "upload_workers": upload_workers,
+                       "max_plates": max_plates,
+                       "s3_endpoint_url": s3_endpoint_url,
+                       **handler_options},
+            "generate_seconds": generate_seconds,
+            "seconds": seconds,
+            "plates_per_hour": plates / seconds * 60 * 60,
+            "stages": stages,
+            "peak_rss_mb": peak_rss_mb()}
+
+
+def benchmark_watcher(work_dir, mode, runs=4, files=2000, lanes=4,
+                      timeout=60):
+    """
+        Measures the cost of finding CopyComplete.txt files while 'runs'
+        runs of 'files' cbcl files are written into work_dir. mode is a
+        watch mode of bcl_manager.start ("recursive", "runs" or "poll")
+        or "none" to measure writing the runs alone.
+
+        Returns the number of events dispatched, the peak number of
+        watched directories, the process CPU seconds and the mean
+        seconds from writing each CopyComplete.txt to its detection
+    """
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+    from run_watcher import RunWatcher
+
+    watch_dir = os.path.join(work_dir, f"watch-{mode}")
+    os.makedirs(watch_dir)
+    written = {}
+    detected = {}
+    done = threading.Event()
+
+    class Detector(FileSystemEventHandler):
+        # Filters events like BclEventHandler.on_created
+        def on_created(self, event):
+            if os.path.basename(event.src_path) == "CopyComplete.txt":
+                detected[os.path.dirname(event.src_path)] = time.time()
+                if len(detected) == runs:
+                    done.set()
+
+    detector = Detector()
+    observer = Observer()
+    watcher = None
+    if mode == "recursive":
+        scheduled = detector
+        observer.schedule(detector, watch_dir, recursive=True)
+    elif mode in ("runs", "poll"):
+        watcher = RunWatcher(detector, watch_dir,
+                             observer=observer if mode == "runs" else None,
+                             poll_interval=1 if mode == "poll" else None)
+        scheduled = watcher
+    elif mode != "none":
+        raise Exception(f"Unknown watch mode: {mode}")
+
+    events = [0]
+    peak_watches = [1 if mode in ("recursive", "runs") else 0]
+    if mode != "none":
+        dispatch = scheduled.dispatch
+
+        def counting_dispatch(event):
+            events[0] += 1
+            dispatch(event)
+            if watcher is not None and mode == "runs":
+                peak_watches[0] = max(peak_watches[0], len(watcher.runs) + 1)
+        scheduled.dispatch = counting_dispatch
+    if watcher is not None:
+        watcher.start()
+    observer.start()
+
+    cpu = time.process_time()
+    start = time.time()
+    block = random_block(4096)
+    for number in range(runs):
+        run_dir = os.path.join(watch_dir, f"run_{number}")
+        for i in range(files):
+            cycle_dir = os.path.join(run_dir, "Data", "Intensities",
+                                     "BaseCalls", f"L{i % lanes + 1:03d}",
+                                     f"C{i // lanes + 1}.1")
+            if i < lanes or not os.path.isdir(cycle_dir):
+                os.makedirs(cycle_dir, exist_ok=True)
+            write_file(os.path.join(cycle_dir, "L001_1.cbcl"), 4096, block)
+        open(os.path.join(run_dir, "CopyComplete.txt"), "w").close()
+        written[run_dir] = time.time()
+    if mode == "recursive":
+        # One inotify watch per directory
+        peak_watches[0] = sum(1 for _ in os.walk(watch_dir))
+    if mode != "none":
+        done.wait(timeout)
+    seconds = time.time() - start
+    cpu = time.process_time() - cpu
+    if watcher is not None:
+        watcher.stop()
+    observer.stop()
+    observer.join()
+
+    latencies = [detected[path] - written[path] for path in detected
+                 if path in written]
+    return {"mode": mode,
+            "runs": runs,
+            "files": files,
+            "detected": len(detected),
+            "events": events[0],
+            "peak_watches": peak_watches[0],
+            "cpu_seconds": cpu,
+            "seconds": seconds,
+            "latency_mean": sum(latencies) / len(latencies)
+            if latencies else None}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+        Logs the change of each result relative to the baseline. Returns
+        False if plates_per_hour dropped by more than 'tolerance'
+    """
+    def change(new, old):
+        if not old or new is None:
+            return "n/a"
+        return f"{(new - old) / old:+.1%}"
+
+    print(f"plates/hour: {results['plates_per_hour']:.1f} (baseline "
+          f"{baseline['plates_per_hour']:.1f}, "
+          f"{change(results['plates_per_hour'], baseline['plates_per_hour'])})")
+    for stage, result in results["stages"].items():
+        old = baseline["stages"].get(stage, {})
+        if result["seconds_mean"] is None:
+            continue
+        print(f"{stage}: {result['seconds_mean']:.2f}s mean "
+              f"({change(result['seconds_mean'], old.get('seconds_mean'))})")
+    for who, mb in results["peak_rss_mb"].items():
+        print(f"peak rss ({who}): {mb:.0f} Mb "
+              f"({change(mb, baseline['peak_rss_mb'].get(who))})")
+    return results["plates_per_hour"] >= \
+        baseline["plates_per_hour"] * (1 - tolerance)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the bcl_manager "
+                                     "pipeline on synthetic runs")
+    parser.add_argument('--plates', type=int, default=4,
+                        help='Number of runs to process')
+    parser.add_argument('--projects', default='FZ2000,FZ2001,FZ2002',
+                        help='Comma separated project codes of each run')
+    parser.add_argument('--files', type=int, default=32,
+                        help='Number of cbcl files in each run')
+    parser.add_argument('--file-mb', type=float, default=16,
+                        help='Size of each cbcl file')
+    parser.add_argument('--fastq-mb', type=float, default=8,
+                        help='Size of each fastq.gz file written by the '
+                             'fake bcl-convert')
+    parser.add_argument('--fastq-mb-per-second', type=float, default=0,
+                        help='Rate the fake bcl-convert writes at (0 for '
+                             'no limit)')
+    parser.add_argument('--s3-endpoint-url',
+                        help='S3 to upload to, e.g. a local MinIO. By '
+                             'default an in-memory S3 (moto) is used')
+    parser.add_argument('--copy-workers', type=int, default=1)
+    parser.add_argument('--convert-workers', type=int, default=1)
+    parser.add_argument('--upload-workers', type=int, default=1)
+    parser.add_argument('--max-plates', type=int, default=8)
+    parser.add_argument('--overlap-backup', action='store_true')
+    parser.add_argument('--stream-upload', action='store_true')
+    parser.add_argument('--fastq-qc', action='store_true',
+                        help='Compute fastq QC statistics during upload')
+    parser.add_argument('--qc-processes', type=int, default=2)
+    parser.add_argument('--recompress', action='store_true',
+                        help='Recompress the fastq as BGZF before upload')
+    parser.add_argument('--recompress-level', type=int, default=6)
+    parser.add_argument('--recompress-processes', type=int, default=2)
+    parser.add_argument('--backup-format', choices=['tree', 'archive'],
+                        default='tree')
+    parser.add_argument('--work-dir',
+                        help='Where to generate runs (default: a temporary '
+                             'directory that is removed afterwards)')
+    parser.add_argument('--output', help='Write the results as JSON here')
+    parser.add_argument('--save-baseline',
+                        help='Write the results as a JSON baseline here')
+    parser.add_argument('--baseline',
+                        help='JSON baseline to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Fail if plates/hour drops by more than this '
+                             'fraction of the baseline')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log the pipeline as it runs')
+    parser.add_argument('--watcher', action='store_true',
+                        help='Instead, compare the overhead of each watch '
+                             'mode while --plates runs of --files files '
+                             'are written')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else
+                        logging.WARNING,
+                        format='%(asctime)s - %(threadName)s - %(message)s')
+
+    options = dict(plates=args.plates,
+                   projects=args.projects.split(","),
+                   files=args.files,
+                   file_size=int(args.file_mb * 1024**2),
+                   fastq_bytes=int(args.fastq_mb * 1024**2),
+                   fastq_rate=args.fastq_mb_per_second * 1024**2,
+                   s3_endpoint_url=args.s3_endpoint_url,
+                   copy_workers=args.copy_workers,
+                   convert_workers=args.convert_workers,
+                   upload_workers=args.upload_workers,
+                   max_plates=args.max_plates,
+                   overlap_backup=args.overlap_backup,
+                   stream_upload=args.stream_upload,
+                   settle_seconds=1,
+                   backup_format=args.backup_format,
+                   fastq_qc=args.fastq_qc,
+                   qc_processes=args.qc_processes,
+                   recompress_fastq=args.recompress,
+                   recompress_level=args.recompress_level,
+                   recompress_processes=args.recompress_processes)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bcl-benchmark-")
+    if args.watcher:
+        try:
+            results = [benchmark_watcher(work_dir, mode, args.plates,
+                                         args.files)
+                       for mode in ["none", "recursive", "runs", "poll"]]
+        finally:
+            if not args.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        print(json.dumps(results, indent=4))
+        return 0
+
+    try:
+        if args.s3_endpoint_url:
+            results = run_benchmark(work_dir, **options)
+        else:
+            from moto import mock_aws
+            with mock_aws():
+                results = run_benchmark(work_dir, **options)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(results, indent=4))
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            print("plates/hour regressed beyond the tolerance")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["fake-bcl-convert"]:
+        fake_bcl_convert(sys.argv[2:])
+    else:
+        sys.exit(main())
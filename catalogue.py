@@ -0,0 +1,238 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import random
+import time
+from datetime import datetime
+
+import utils
+
+"""
+catalogue.py keeps a catalogue of every uploaded run on S3, so that
+questions like "all FZ2000 runs this month" need a couple of GETs rather
+than listing and reading thousands of meta.json files.
+
+The catalogue is stored under {prefix}/_catalogue/ next to the per-run
+files:
+
+    _catalogue/manifest.json
+    _catalogue/{project_code}/{YYYY-MM}.jsonl
+
+Each partition holds the meta.json of every run of a project sequenced
+that month, one per line, in the order they were added. Uploading a run
+again replaces its line. manifest.json lists the partitions with their
+number of runs.
+
+Objects are updated with conditional writes (If-Match / If-None-Match),
+so concurrent updates never lose each other's runs.
+"""
+
+CATALOGUE_DIR = '_catalogue'
+MANIFEST = 'manifest.json'
+
+# Conditional writes retried this many times before giving up
+MAX_ATTEMPTS = 10
+
+# Error codes of a conditional write that lost a race
+CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+def catalogue_key(prefix, *parts):
+    return '/'.join(part for part in (prefix.strip('/'), CATALOGUE_DIR) +
+                    parts if part)
+
+
+def partition(meta):
+    """
+        Returns the partition of a run's meta.json, e.g. "FZ2000/2022-04"
+    """
+    return f"{meta['project_code']}/{meta['sequence_date'][:7]}"
+
+
+def read_object(s3, bucket, key):
+    """
+        Returns the (body, ETag) of an S3 object, or (None, None) if it
+        does not exist
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except utils.botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    return response['Body'].read(), response['ETag']
+
+
+def update_object(s3, bucket, key, update):
+    """
+        Replaces the S3 object at key with update(body), where body is
+        its current contents or None. The write only succeeds if nobody
+        else wrote the object in the meantime; otherwise it is read and
+        updated again
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        body, etag = read_object(s3, bucket, key)
+        new_body = update(body)
+        if new_body == body:
+            return
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            s3.put_object(Bucket=bucket, Key=key, Body=new_body,
+                          ACL='bucket-owner-full-control', **condition)
+            return
+        except utils.botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in CONFLICTS:
+                raise
+        # Someone else updated it, back off and try again
+        time.sleep(random.uniform(0, 0.1 * 2**attempt))
+    raise Exception(f'Could not update s3://{bucket}/{key}: too many '
+                    'concurrent updates')
+
+
+def read_lines(body):
+    return [json.loads(line) for line in (body or b'').decode().splitlines()
+            if line]
+
+
+def write_lines(entries):
+    return ''.join(json.dumps(entry, sort_keys=True) + '\n'
+                   for entry in entries).encode()
+
+
+def add_entries(body, metas):
+    """
+        Returns the partition body with metas appended, replacing any
+        earlier line of the same run and project
+    """
+    entries = read_lines(body)
+    new = {(meta['run_id'], meta['project_code']): meta for meta in metas}
+    entries = [new.pop((entry['run_id'], entry['project_code']), entry)
+               for entry in entries]
+    return write_lines(entries + list(new.values()))
+
+
+def update_manifest(body, partitions):
+    """
+        Returns the manifest body with the run counts of 'partitions'
+        ({partition: runs}) updated
+    """
+    manifest = json.loads(body) if body else {"partitions": {}}
+    for name, runs in partitions.items():
+        manifest["partitions"][name] = {"runs": runs}
+    manifest["partitions"] = dict(sorted(manifest["partitions"].items()))
+    manifest["updated"] = str(datetime.now())
+    return json.dumps(manifest, indent=4).encode()
+
+
+def add_runs(bucket, metas, s3_endpoint_url, prefix=''):
+    """
+        Adds the meta.json dictionaries of uploaded runs to the
+        catalogue in the bucket under prefix
+    """
+    s3 = utils.s3_client(s3_endpoint_url)
+    partitions = {}
+    for meta in metas:
+        partitions.setdefault(partition(meta), []).append(meta)
+
+    counts = {}
+    for name, entries in sorted(partitions.items()):
+        key = catalogue_key(prefix, f"{name}.jsonl")
+
+        def update(body):
+            body = add_entries(body, entries)
+            counts[name] = len(read_lines(body))
+            return body
+
+        update_object(s3, bucket, key, update)
+
+    update_object(s3, bucket, catalogue_key(prefix, MANIFEST),
+                  lambda body: update_manifest(body, counts))
+    logging.info(f"Catalogued {len(metas)} runs in "
+                 f"s3://{bucket}/{catalogue_key(prefix)}/")
+
+
+def read_meta(bucket, key, s3_endpoint_url):
+    body, _ = read_object(utils.s3_client(s3_endpoint_url), bucket, key)
+    if body is None:
+        raise Exception(f's3://{bucket}/{key} not found')
+    return json.loads(body)
+
+
+def rebuild(bucket, s3_endpoint_url, prefix='', threads=16):
+    """
+        Regenerates the whole catalogue from every meta.json under
+        prefix. Partitions that no longer have any runs are removed.
+        Partitions are overwritten, so runs catalogued by bcl_manager
+        during a rebuild may be lost; rebuild while it is stopped.
+        Returns the number of runs catalogued
+    """
+    start = time.time()
+    s3 = utils.s3_client(s3_endpoint_url)
+    list_prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+    catalogue_prefix = catalogue_key(prefix) + '/'
+    keys = sorted(key for key in utils.s3_list_keys(bucket, list_prefix,
+                                                    s3_endpoint_url)
+                  if key.endswith('/meta.json') and
+                  not key.startswith(catalogue_prefix))
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        metas = list(pool.map(
+            lambda key: read_meta(bucket, key, s3_endpoint_url), keys))
+
+    partitions = {}
+    for meta in sorted(metas, key=lambda meta: (meta['sequence_date'],
+                                                meta['run_id'])):
+        partitions.setdefault(partition(meta), []).append(meta)
+    for name, entries in partitions.items():
+        s3.put_object(Bucket=bucket, Key=catalogue_key(prefix,
+                                                       f"{name}.jsonl"),
+                      Body=write_lines(entries),
+                      ACL='bucket-owner-full-control')
+
+    body, _ = read_object(s3, bucket, catalogue_key(prefix, MANIFEST))
+    old = json.loads(body)["partitions"] if body else {}
+    for name in set(old) - set(partitions):
+        s3.delete_object(Bucket=bucket,
+                         Key=catalogue_key(prefix, f"{name}.jsonl"))
+
+    manifest = {"partitions": {name: {"runs": len(entries)}
+                               for name, entries in sorted(partitions.items())},
+                "updated": str(datetime.now())}
+    s3.put_object(Bucket=bucket, Key=catalogue_key(prefix, MANIFEST),
+                  Body=json.dumps(manifest, indent=4).encode(),
+                  ACL='bucket-owner-full-control')
+    logging.info(f"Rebuilt catalogue of {len(metas)} runs in "
+                 f"{len(partitions)} partitions of "
+                 f"s3://{bucket}/{catalogue_prefix} in "
+                 f"{time.time() - start:.1f}s")
+    return len(metas)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the catalogue "
+                                                 "of runs uploaded to S3")
+    parser.add_argument('command', choices=['rebuild'],
+                        help='rebuild: regenerate the catalogue from every '
+                             'meta.json')
+    parser.add_argument('--s3-fastq-bucket', default='s3-csu-001',
+                        help='S3 Bucket the fastq files are uploaded to')
+    parser.add_argument('--s3-fastq-key', default='',
+                        help='S3 Key the fastq files are uploaded under')
+    parser.add_argument('--s3-endpoint-url',
+                        default='https://bucket.vpce-0a9b8c4b880602f6e-w4s7h1by.s3.eu-west-1.vpce.amazonaws.com',
+                        help='aws s3 endpoint url')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='Number of meta.json files read at a time')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    rebuild(args.s3_fastq_bucket, args.s3_endpoint_url, args.s3_fastq_key,
+            args.threads)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import concurrent.futures
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import metrics
+
+"""
+deletion.py deletes old plates in the background, so that clean up does
+not hold up the processing of new plates.
+
+Runs are made of tens of thousands of small files, so deleting them is
+limited by metadata operations rather than bytes. Each directory tree is
+first renamed into a trash directory next to it, which is atomic: the
+plate disappears from the watch, fastq or backup directory at once, and
+a half deleted plate is never mistaken for a processed one. The trash is
+then emptied by a pool of low priority threads, each emptying one
+directory at a time, so subtrees are deleted in parallel. Trees left in
+the trash by a crash are deleted on the next start up.
+"""
+
+# Trash directory created next to each deleted tree. Hidden, so that it
+# is not mistaken for a run
+TRASH_DIR = '.bcl-manager-trash'
+
+
+def lower_priority(nice=19, io_class=3):
+    """
+        Lowers the CPU and I/O priority of the calling thread, as nice
+        and ionice (3 is the idle class) would. Linux sets both per
+        thread. Failures are logged, the thread still runs
+    """
+    tid = threading.get_native_id()
+    try:
+        if nice is not None:
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+        if io_class is not None:
+            subprocess.run(["ionice", "-c", str(io_class), "-p", str(tid)],
+                           check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.info(f"Could not lower deletion priority: {e}")
+
+
+def move_to_trash(path):
+    """
+        Renames the file or directory tree at path into the trash
+        directory next to it, under a unique name. Returns its new path
+    """
+    path = os.path.normpath(path)
+    trash_dir = os.path.join(os.path.dirname(path), TRASH_DIR)
+    os.makedirs(trash_dir, exist_ok=True)
+    trash = os.path.join(trash_dir,
+                         f"{os.path.basename(path)}.{time.time_ns()}")
+    os.rename(path, trash)
+    return trash
+
+
+def delete_tree(path, pool, limit=None):
+    """
+        Deletes the file or directory tree at path. Each directory is
+        emptied by a task on the 'pool' of threads, and the directories
+        are removed deepest first once every file is deleted. limit (a
+        throttle.TokenBucket) limits the files deleted per second.
+
+        Returns a dictionary of the "files" deleted and their "bytes"
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        size = os.lstat(path).st_size
+        os.unlink(path)
+        return {"files": 1, "bytes": size}
+
+    lock = threading.Lock()
+    directories = []
+    totals = {"files": 0, "bytes": 0}
+
+    def empty(directory):
+        files = 0
+        size = 0
+        subdirectories = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                    continue
+                size += entry.stat(follow_symlinks=False).st_size
+                if limit is not None:
+                    limit.consume(1)
+                os.unlink(entry.path)
+                files += 1
+        with lock:
+            directories.append(directory)
+            totals["files"] += files
+            totals["bytes"] += size
+        return subdirectories
+
+    pending = {pool.submit(empty, path)}
+    try:
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                for subdirectory in future.result():
+                    pending.add(pool.submit(empty, subdirectory))
+    finally:
+        # Let running tasks finish before raising
+        concurrent.futures.wait(pending)
+
+    for directory in sorted(directories, key=lambda d: d.count(os.sep),
+                            reverse=True):
+        os.rmdir(directory)
+    return totals
+
+
+class Deleter:
+    """
+        Deletes directory trees in a background thread.
+
+        threads: number of directories emptied at the same time
+        limit: throttle.TokenBucket limiting the files deleted per
+               second (None for no limit)
+        nice, io_class: CPU nice level and ionice class of the deleting
+                        threads (None to leave unchanged)
+    """
+    def __init__(self, threads=4, limit=None, nice=19, io_class=3):
+        self.limit = limit
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max(1, threads), thread_name_prefix="delete",
+            initializer=lower_priority, initargs=(nice, io_class))
+        # (trash path, original path) of trees waiting to be deleted
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._work, daemon=True,
+                                       name="deleter")
+        self.thread.start()
+
+    def remove(self, path):
+        """
+            Moves the tree at path to the trash straight away and queues
+            its deletion. Returns the trash path
+        """
+        trash = move_to_trash(path)
+        self.queue.put((trash, path))
+        return trash
+
+    def resume(self, directories):
+        """
+            Queues the deletion of everything left in the trash of each
+            of the directories, e.g. by a crash. Returns the number of
+            trees queued
+        """
+        count = 0
+        for directory in directories:
+            trash_dir = os.path.join(directory, TRASH_DIR)
+            if not os.path.isdir(trash_dir):
+                continue
+            for name in sorted(os.listdir(trash_dir)):
+                trash = os.path.join(trash_dir, name)
+                self.queue.put((trash, trash))
+                count += 1
+        if count:
+            logging.info(f"Resuming deletion of {count} trees in the trash")
+        return count
+
+    def delete(self, trash, path):
+        """
+            Deletes a tree in the trash, and logs the space freed and
+            the deletion rate
+        """
+        start = time.time()
+        with metrics.track("delete"):
+            stats = delete_tree(trash, self.pool, self.limit)
+        seconds = max(time.time() - start, 1e-6)
+        metrics.STAGE_BYTES.inc(stats["bytes"], stage="delete")
+        logging.info(f"Deleted '{path}': {stats['files']} files, "
+                     f"{stats['bytes'] / 1024**3:.2f} Gb freed in "
+                     f"{seconds:.1f}s ({stats['files'] / seconds:.0f} "
+                     f"files/s, {stats['bytes'] / 1024**2 / seconds:.1f} "
+                     "Mb/s)")
+        return stats
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.delete(*item)
+            except Exception as e:
+                # Left in the trash until the next start up
+                logging.exception(f"Could not delete '{item[1]}': {e}")
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        """
+            Blocks until every queued tree has been deleted
+        """
+        self.queue.join()
+
+    def shutdown(self):
+        """
+            Stops once every queued tree has been deleted
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.pool.shutdown()
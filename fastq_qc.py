@@ -0,0 +1,149 @@
+import gzip
+import os
+import re
+
+import utils
+
+"""
+fastq_qc.py computes read counts, yields and base qualities of fastq.gz
+files in a single streaming pass, so that downstream users do not have to
+download and decompress every file to get them.
+
+Files are decompressed in chunks of CHUNK_SIZE bytes, so memory use does
+not depend on the file size. Quality strings are counted in bulk rather
+than base by base.
+"""
+
+# Bytes of decompressed data processed at a time
+CHUNK_SIZE = 4 * 1024**2
+
+# Phred+33 encoded qualities
+QUALITY_OFFSET = 33
+QUALITIES = range(QUALITY_OFFSET, QUALITY_OFFSET + 94)
+Q30 = QUALITY_OFFSET + 30
+QUALITY_BYTES = {quality: bytes([quality]) for quality in QUALITIES}
+
+# bcl-convert names files {sample}_S{n}[_L{lane}]_{read}_001.fastq.gz
+FASTQ_NAME = re.compile(r'^(?P<sample>.+)_S\d+(?:_L\d{3})?_'
+                        r'(?P<read>[RI]\d)_001\.fastq\.gz$')
+
+# Name of the per-sample statistics file uploaded with meta.json
+STATS_FILE = 'fastq-stats.json'
+
+
+def count_qualities(lines, counts):
+    """
+        Adds the records of complete fastq 'lines' to counts. Returns the
+        number of reads
+    """
+    qualities = b''.join(lines[3::4])
+    # Instruments only use a few quality values. Counting the most
+    # common first, all bases are usually found after a few passes
+    remaining = len(qualities)
+    for quality in sorted(QUALITIES, key=lambda q: -counts.get(q, 0)):
+        if not remaining:
+            break
+        found = qualities.count(QUALITY_BYTES[quality])
+        if found:
+            counts[quality] = counts.get(quality, 0) + found
+            remaining -= found
+    return len(lines) // 4
+
+
+def fastq_stats(path, chunk_size=CHUNK_SIZE):
+    """
+        Reads a fastq.gz file once and returns a dictionary of:
+            "reads": number of records
+            "bases": number of bases
+            "quality_sum": sum of the base qualities
+            "q30_bases": number of bases with quality 30 or more
+    """
+    counts = {}
+    reads = 0
+    remainder = b''
+    with gzip.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            lines = (remainder + chunk).split(b'\n')
+            if not chunk:
+                if lines[-1] == b'':
+                    lines.pop()
+                if len(lines) % 4:
+                    raise Exception(f'Truncated fastq record in {path}')
+                reads += count_qualities(lines, counts)
+                break
+            # Keep incomplete records for the next chunk
+            complete = (len(lines) - 1) // 4 * 4
+            reads += count_qualities(lines[:complete], counts)
+            remainder = b'\n'.join(lines[complete:])
+
+    return {"reads": reads,
+            "bases": sum(counts.values()),
+            "quality_sum": sum((quality - QUALITY_OFFSET) * count
+                               for quality, count in counts.items()),
+            "q30_bases": sum(count for quality, count in counts.items()
+                             if quality >= Q30)}
+
+
+def summarise(stats, reads=None):
+    """
+        Combines the fastq_stats of several files. The read count is
+        taken from the stats in 'reads' if given, e.g. only the R1 files
+        so that pairs are counted once. Returns a dictionary of "reads",
+        "bases", "mean_quality" and "q30_fraction"
+    """
+    bases = sum(s["bases"] for s in stats)
+    return {"reads": sum(s["reads"] for s in
+                         (stats if reads is None else reads)),
+            "bases": bases,
+            "mean_quality": round(sum(s["quality_sum"] for s in stats) /
+                                  bases, 2) if bases else None,
+            "q30_fraction": round(sum(s["q30_bases"] for s in stats) /
+                                  bases, 4) if bases else None}
+
+
+def project_stats(paths, processes=1):
+    """
+        Computes the statistics of a project's fastq.gz files, reading
+        files in parallel in 'processes' processes (see
+        utils.map_processes).
+
+        Returns (summary, samples) where summary is the summarise of the
+        whole project with its number of "samples", and samples is the
+        per-sample dictionary written to STATS_FILE:
+        {
+            "samples": {sample: summarise of its files},
+            "files": {file name: fastq_stats of the file}
+        }
+        Read counts are of R1 files (clusters); index reads are counted
+        in "files" only
+    """
+    paths = sorted(paths)
+    results = utils.map_processes(fastq_stats, paths, processes)
+
+    files = {}
+    samples = {}
+    for path, stats in zip(paths, results):
+        name = os.path.basename(path)
+        files[name] = stats
+        match = FASTQ_NAME.match(name)
+        sample, read = (match["sample"], match["read"]) if match \
+            else (name, "R1")
+        if read.startswith("R"):
+            samples.setdefault(sample, []).append((read, stats))
+
+    def reads(sample_files):
+        first = [stats for read, stats in sample_files if read == "R1"]
+        return first or [stats for _, stats in sample_files]
+
+    summary = summarise([stats for sample_files in samples.values()
+                         for _, stats in sample_files],
+                        [stats for sample_files in samples.values()
+                         for stats in reads(sample_files)])
+    summary["samples"] = len(samples)
+    return summary, {"samples": {sample: summarise(
+                                     [stats for _, stats in sample_files],
+                                     reads(sample_files))
+                                 for sample, sample_files
+                                 in sorted(samples.items())},
+                     "files": files}
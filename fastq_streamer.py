@@ -0,0 +1,157 @@
+import logging
+import os
+import glob
+import threading
+import time
+
+import upload_manifest
+import utils
+
+
+def file_state(path):
+    """
+        Returns the (size, mtime) of a file, used to tell if it has
+        changed
+    """
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+
+class FastqStreamer:
+    """
+        Uploads fastq.gz files to S3 while bcl-convert is still writing
+        them. A file is uploaded once its size and modification time
+        have not changed for 'settle_seconds'.
+
+        Once bcl-convert exits, reconcile() uploads anything that was
+        missed or has changed since it was uploaded and checks that every
+        file is on S3.
+
+        Uploads go through upload_manifest.upload_files, so the prefixes
+        claimed and the objects uploaded are recorded in the plate's
+        UploadManifest, and a retry of a failed plate may replace them.
+    """
+    def __init__(self, fastq_path, bucket, s3_endpoint_url, key_for,
+                 settle_seconds=60, poll_interval=10, manifest=None,
+                 **transfer_options):
+        """
+            fastq_path: output directory of bcl-convert
+            bucket: S3 bucket to upload to
+            s3_endpoint_url: the s3 endpoint url
+            key_for: function that returns the S3 key for a fastq path
+            settle_seconds: how long a file must be unchanged for before
+                            it is uploaded
+            poll_interval: seconds between scans of fastq_path
+            manifest: UploadManifest of the plate (by default the one
+                      in fastq_path)
+            transfer_options: passed on to utils.s3_upload_files
+        """
+        self.fastq_path = fastq_path
+        self.bucket = bucket
+        self.s3_endpoint_url = s3_endpoint_url
+        self.key_for = key_for
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.transfer_options = transfer_options
+
+        # path -> (size, mtime) when it was uploaded
+        self.uploaded = {}
+
+        # path -> ((size, mtime), time that state was first seen)
+        self.seen = {}
+
+        self.manifest = manifest or upload_manifest.UploadManifest(
+            os.path.join(fastq_path, upload_manifest.MANIFEST))
+
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name="fastq-streamer")
+
+    def start(self):
+        logging.info(f"Streaming fastq uploads from: {self.fastq_path}")
+        self.thread.start()
+
+    def stop(self):
+        """
+            Stops watching once any upload in progress has finished
+        """
+        self.stopping.set()
+        self.thread.join()
+
+    def fastq_files(self):
+        """
+            Returns the fastq.gz files in the project subdirectories
+        """
+        return sorted(glob.glob(os.path.join(self.fastq_path,
+                                             '*', '*.fastq.gz')))
+
+    def settled_files(self):
+        """
+            Returns files not yet uploaded that have been unchanged for
+            settle_seconds
+        """
+        now = time.time()
+        settled = []
+        for path in self.fastq_files():
+            if path in self.uploaded:
+                continue
+            try:
+                state = file_state(path)
+            except FileNotFoundError:
+                continue
+            previous = self.seen.get(path)
+            if previous is None or previous[0] != state:
+                self.seen[path] = (state, now)
+            elif now - previous[1] >= self.settle_seconds:
+                settled.append(path)
+        return settled
+
+    def _run(self):
+        while not self.stopping.is_set():
+            settled = self.settled_files()
+            if settled:
+                try:
+                    self._upload(settled)
+                except Exception as e:
+                    # reconcile() retries anything that failed
+                    logging.exception(e)
+            self.stopping.wait(self.poll_interval)
+
+    def _upload(self, paths):
+        files = [(path, self.key_for(path)) for path in paths]
+        states = {path: file_state(path) for path in paths}
+        # Refuses to replace another run's data
+        upload_manifest.upload_files(files, self.bucket, self.s3_endpoint_url,
+                                     self.manifest, **self.transfer_options)
+        self.uploaded.update(states)
+
+    def reconcile(self):
+        """
+            Uploads files that were not uploaded or have changed since
+            they were uploaded. Raises an exception if any file is then
+            missing from S3 or has the wrong size there.
+
+            Returns a dictionary of path: key for every fastq file
+        """
+        files = {path: self.key_for(path) for path in self.fastq_files()}
+
+        missing = [path for path in files if path not in self.uploaded]
+        changed = [path for path in files if path in self.uploaded
+                   and self.uploaded[path] != file_state(path)]
+        logging.info(f"Reconciling streamed upload of {self.fastq_path}: "
+                     f"{len(self.uploaded)} streamed, {len(missing)} "
+                     f"missing, {len(changed)} changed")
+        if missing or changed:
+            self._upload(missing + changed)
+
+        # Check every file made it
+        prefixes = {os.path.dirname(key) + '/' for key in files.values()}
+        on_s3 = {}
+        for prefix in prefixes:
+            on_s3.update(utils.s3_list_keys(self.bucket, prefix,
+                                            self.s3_endpoint_url))
+        for path, key in files.items():
+            if on_s3.get(key) != os.path.getsize(path):
+                raise Exception(f"s3://{self.bucket}/{key} is missing or "
+                                f"does not match {path}")
+        return files
@@ -0,0 +1,274 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+metrics.py keeps counters, gauges and histograms of the bcl_manager
+pipeline and exports them in the Prometheus text format, either from a
+local HTTP endpoint or as a file for node_exporter's textfile collector.
+"""
+
+# Seconds, from a small copy to a large conversion
+DURATION_BUCKETS = (1, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400,
+                    28800)
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"'
+                          for name, value in pairs) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+        Base class of a metric with a fixed list of label names. Values
+        are kept per tuple of label values
+    """
+    type = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise Exception(f"{self.name} requires labels: {self.labels}")
+        return tuple(labels[name] for name in self.labels)
+
+    def samples(self):
+        """
+            Returns a list of (suffix, label values, extra labels, value)
+        """
+        with self.lock:
+            return [("", key, None, value)
+                    for key, value in sorted(self.values.items())]
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.type}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}"
+                         f"{format_labels(self.labels, key, extra)} "
+                         f"{format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+        A value that can go up and down. Instead of being set, the values
+        can be computed when scraped by a function returning a
+        dictionary of label values tuple to value (see set_function)
+    """
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function = None
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels))
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        try:
+            values = self.function()
+        except Exception as e:
+            logging.exception(f"Could not collect {self.name}: {e}")
+            return []
+        return [("", key, None, value)
+                for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS,
+                 registry=None):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            counts = [count + (value <= bound)
+                      for count, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, _ = self.values.get(self.key(labels), ([0], 0))
+        return counts[-1]
+
+    def total(self, **labels):
+        with self.lock:
+            _, total = self.values.get(self.key(labels), ([0], 0))
+        return total
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts):
+                samples.append(("_bucket", key,
+                                [("le", format_value(bound))], count))
+            samples.append(("_sum", key, None, total))
+            samples.append(("_count", key, None, counts[-1]))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def expose(self):
+        """
+            Returns every metric in the Prometheus text format
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        return "\n".join(metric.expose() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram("bcl_manager_stage_seconds",
+                          "Duration of each pipeline stage", ["stage"])
+STAGE_BYTES = Counter("bcl_manager_stage_bytes_total",
+                      "Bytes processed by each pipeline stage", ["stage"])
+STAGE_FAILURES = Counter("bcl_manager_stage_failures_total",
+                         "Failures of each pipeline stage", ["stage"])
+UPLOAD_BYTES_PER_SECOND = Gauge("bcl_manager_upload_bytes_per_second",
+                                "Throughput of the last fastq upload")
+QUEUE_DEPTH = Gauge("bcl_manager_plates",
+                    "Plates in each stage of the scheduler, by state",
+                    ["stage", "state"])
+FREE_BYTES = Gauge("bcl_manager_free_bytes",
+                   "Free space of the filesystem of each directory",
+                   ["path"])
+
+
+@contextmanager
+def track(stage):
+    """
+        Observes the duration of the block as a run of 'stage', or
+        counts a failure of the stage if it raises
+    """
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        STAGE_FAILURES.inc(stage=stage)
+        raise
+    STAGE_SECONDS.observe(time.time() - start, stage=stage)
+
+
+def start_http_server(port, address="127.0.0.1", registry=REGISTRY):
+    """
+        Serves the metrics at http://{address}:{port}/metrics from a
+        background thread. Returns the server; port 0 picks a free port
+        (see server.server_port)
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.expose().encode()
+            self.send_response(200)
+            self.send_header("Content-Type",
+                             "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would flood the log
+            pass
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True,
+                              name="metrics")
+    thread.start()
+    logging.info(f"Serving metrics on http://{address}:"
+                 f"{server.server_port}/metrics")
+    return server
+
+
+def write_textfile(path, registry=REGISTRY):
+    """
+        Writes the metrics to path for the textfile collector. The file
+        is replaced atomically so a partial file is never read
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(registry.expose())
+    os.replace(temp_path, path)
+
+
+def start_textfile_writer(path, interval=15, registry=REGISTRY):
+    """
+        Writes the metrics to path every 'interval' seconds from a
+        background thread
+    """
+    def run():
+        while True:
+            try:
+                write_textfile(path, registry)
+            except Exception as e:
+                logging.exception(e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, daemon=True, name="metrics-textfile")
+    thread.start()
+    return thread
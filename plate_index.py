@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+"""
+plate_index.py keeps a small SQLite index of processed plates, so that
+clean up can query which plates have expired instead of rescanning the
+fastq, watch and backup directories.
+
+It also journals which processing stages of each plate have completed,
+so a plate that is triggered again resumes from its first incomplete
+stage.
+"""
+
+# Default name of the index in the fastq directory. Hidden, so that it
+# is never mistaken for a plate
+INDEX_FILE = '.plate-index.sqlite'
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS plates (
+        name TEXT PRIMARY KEY,
+        processed_time REAL NOT NULL,
+        fastq_path TEXT NOT NULL,
+        fastq_bytes INTEGER,
+        backup_path TEXT NOT NULL,
+        backup_bytes INTEGER,
+        bcl_path TEXT NOT NULL,
+        bcl_removed INTEGER NOT NULL DEFAULT 0,
+        removed INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS plates_processed_time
+        ON plates (removed, processed_time);
+    CREATE TABLE IF NOT EXISTS plate_stages (
+        name TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        completed_time REAL NOT NULL,
+        PRIMARY KEY (name, stage)
+    );
+    CREATE TABLE IF NOT EXISTS conversions (
+        name TEXT NOT NULL,
+        started_time REAL NOT NULL,
+        seconds REAL NOT NULL,
+        settings TEXT NOT NULL,
+        PRIMARY KEY (name, started_time)
+    );
+"""
+
+
+def directory_size(path):
+    """
+        Returns the total size in bytes of the files under path, or
+        None if it does not exist
+    """
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    pending = [path]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def is_processed_plate(fastq_plate):
+    """
+        Returns True if fastq_plate is a directory of bcl-convert output
+    """
+    try:
+        contents = os.listdir(fastq_plate)
+    except (NotADirectoryError, FileNotFoundError):
+        return False
+    return "Logs" in contents and "Reports" in contents
+
+
+class PlateIndex:
+    """
+        SQLite index of each processed plate: when it was processed, the
+        sizes of its fastq and backup, and its fastq, backup and raw bcl
+        locations. Safe to use from multiple threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def is_empty(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM plates").fetchone()[0] == 0
+
+    def record_processed(self, name, fastq_path, backup_path, bcl_path,
+                         processed_time=None):
+        """
+            Records that a plate has been processed (now, by default)
+        """
+        processed_time = time.time() if processed_time is None \
+            else processed_time
+        row = (name, processed_time,
+               fastq_path, directory_size(fastq_path),
+               backup_path, directory_size(backup_path),
+               bcl_path, int(not os.path.exists(bcl_path)))
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO plates (name, processed_time, "
+                "fastq_path, fastq_bytes, backup_path, backup_bytes, "
+                "bcl_path, bcl_removed) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                row)
+
+    def get(self, name):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM plates WHERE name = ?", (name,)).fetchone()
+
+    def bcl_pending(self):
+        """
+            Returns processed plates whose raw bcl data has not been
+            removed
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM plates WHERE bcl_removed = 0 "
+                "ORDER BY processed_time").fetchall()
+
+    def expired(self, max_age_days=21, now=None):
+        """
+            Returns plates that are not removed and were processed more
+            than max_age_days whole days ago
+        """
+        now = time.time() if now is None else now
+        cutoff = now - (max_age_days + 1) * 24 * 60 * 60
+        with self.lock:
+            return self.connection.execute(
+                "SELECT * FROM plates WHERE removed = 0 "
+                "AND processed_time <= ? ORDER BY processed_time",
+                (cutoff,)).fetchall()
+
+    def mark_bcl_removed(self, name):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE plates SET bcl_removed = 1 WHERE name = ?", (name,))
+
+    def mark_removed(self, name):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE plates SET removed = 1, bcl_removed = 1 "
+                "WHERE name = ?", (name,))
+            # A new run with the same name starts from scratch
+            self.connection.execute(
+                "DELETE FROM plate_stages WHERE name = ?", (name,))
+
+    def mark_stage(self, name, stage):
+        """
+            Journals that a stage of processing a plate has completed.
+            Committed before returning, so it survives a crash
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO plate_stages (name, stage, "
+                "completed_time) VALUES (?, ?, ?)",
+                (name, stage, time.time()))
+
+    def stage_completed(self, name, stage):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT 1 FROM plate_stages WHERE name = ? AND stage = ?",
+                (name, stage)).fetchone() is not None
+
+    def clear_stage(self, name, stage):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM plate_stages WHERE name = ? AND stage = ?",
+                (name, stage))
+
+    def record_conversion(self, name, started_time, seconds, settings):
+        """
+            Records the bcl-convert settings (dictionary) used for a
+            plate and how long the conversion took
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO conversions (name, started_time, "
+                "seconds, settings) VALUES (?, ?, ?, ?)",
+                (name, started_time, seconds, json.dumps(settings)))
+
+    def conversions(self, name):
+        """
+            Returns (started_time, seconds, settings) of each conversion
+            of a plate, oldest first
+        """
+        with self.lock:
+            return [(row["started_time"], row["seconds"],
+                     json.loads(row["settings"]))
+                    for row in self.connection.execute(
+                        "SELECT * FROM conversions WHERE name = ? "
+                        "ORDER BY started_time", (name,))]
+
+    def rebuild(self, fastq_dir, watch_dir, backup_dir):
+        """
+            Re-creates the index from the processed plates in fastq_dir.
+            The processed time of each plate is taken from the
+            modification time of its fastq directory
+        """
+        start = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM plates")
+
+        count = 0
+        for plate in sorted(os.listdir(fastq_dir)):
+            fastq_plate = os.path.join(fastq_dir, plate)
+            if not is_processed_plate(fastq_plate):
+                continue
+            self.record_processed(plate, fastq_plate,
+                                  os.path.join(backup_dir, plate),
+                                  os.path.join(watch_dir, plate),
+                                  os.path.getmtime(fastq_plate))
+            count += 1
+        logging.info(f"Rebuilt plate index {self.path} with {count} plates "
+                     f"in {time.time() - start:.1f}s")
@@ -0,0 +1,229 @@
+import logging
+import queue
+import threading
+
+
+class PlateScheduler:
+    """
+        Runs plates through a fixed sequence of stages (e.g. copy,
+        convert, upload). Each stage has its own pool of worker threads,
+        so one plate can be converting while another is uploading.
+    """
+    def __init__(self, stages, workers=None, max_plates=8,
+                 on_complete=None, on_error=None, admit=None):
+        """
+            stages: list of (name, function) tuples, run in order. Each
+                    function is called with the job of the plate
+            workers: dictionary of stage name to the number of plates
+                     that may run that stage at the same time (default 1)
+            max_plates: maximum number of plates queued or in flight.
+                        submit() blocks while the scheduler is full
+            on_complete: called with the job once every stage succeeds
+            on_error: called with (job, stage name, exception) if a
+                      stage raises. The plate is then dropped
+            admit: called with the job before a plate is admitted. If it
+                   returns False the plate is deferred, and admission is
+                   retried (in submission order) whenever a plate
+                   finishes or retry_deferred() is called
+        """
+        if not stages:
+            raise Exception("PlateScheduler requires at least one stage")
+
+        workers = workers or {}
+        self.stages = list(stages)
+        self.max_plates = max_plates
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.admit = admit
+
+        # One queue of waiting plates per stage
+        self.queues = [queue.Queue() for _ in self.stages]
+
+        # Bounds the number of plates admitted into the pipeline
+        self.slots = threading.BoundedSemaphore(max_plates)
+
+        # Plate name -> (stage name,
+        #                "waiting" | "queued" | "running" | "deferred")
+        self.plates = {}
+
+        # (name, job) of deferred plates, in submission order
+        self.deferred = []
+        self.lock = threading.Condition()
+
+        # Start the worker threads
+        self.threads = []
+        for index, (name, _) in enumerate(self.stages):
+            for i in range(max(1, workers.get(name, 1))):
+                thread = threading.Thread(target=self._work, args=(index,),
+                                          name=f"{name}-{i}", daemon=True)
+                thread.start()
+                self.threads.append((index, thread))
+
+    def submit(self, name, job):
+        """
+            Queue a plate for processing. Blocks while max_plates are
+            already queued or in flight. Returns False if a plate with
+            the same name is already being processed, True otherwise
+        """
+        with self.lock:
+            if name in self.plates:
+                logging.info(f"Plate already scheduled, ignoring: {name}")
+                return False
+            # Reserve the name while waiting for a slot, so that the
+            # same plate cannot be submitted twice meanwhile
+            self.plates[name] = (self.stages[0][0], "waiting")
+
+        try:
+            self.slots.acquire()
+        except BaseException:
+            with self.lock:
+                self.plates.pop(name, None)
+                self.lock.notify_all()
+            raise
+        with self.lock:
+            # Keep deferred plates in order
+            deferred = bool(self.deferred) or not self._admit(name, job)
+            if deferred:
+                self.plates[name] = (self.stages[0][0], "deferred")
+                self.deferred.append((name, job))
+            else:
+                self.plates[name] = (self.stages[0][0], "queued")
+        if deferred:
+            self.slots.release()
+            self.log_status(f"Deferred plate: {name}")
+            return True
+        self.queues[0].put((name, job))
+        self.log_status(f"Queued plate: {name}")
+        return True
+
+    def _admit(self, name, job):
+        if self.admit is None:
+            return True
+        try:
+            return self.admit(job)
+        except Exception as e:
+            logging.exception(f"Admission check failed for {name}: {e}")
+            return False
+
+    def retry_deferred(self):
+        """
+            Admits deferred plates, oldest first, while there are free
+            slots and admit() accepts them
+        """
+        while True:
+            with self.lock:
+                if not self.deferred or not self.slots.acquire(False):
+                    return
+                name, job = self.deferred[0]
+                if not self._admit(name, job):
+                    self.slots.release()
+                    return
+                self.deferred.pop(0)
+                self.plates[name] = (self.stages[0][0], "queued")
+            self.queues[0].put((name, job))
+            self.log_status(f"Admitted deferred plate: {name}")
+
+    def _work(self, index):
+        """
+            Worker thread loop for the stage at 'index'
+        """
+        stage_name, function = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                return
+
+            name, job = item
+            self._set_state(name, stage_name, "running")
+            try:
+                function(job)
+            except Exception as e:
+                logging.exception(f"Plate {name} failed in stage "
+                                  f"'{stage_name}': {e}")
+                try:
+                    if self.on_error:
+                        self.on_error(job, stage_name, e)
+                except Exception as callback_error:
+                    logging.exception(callback_error)
+                finally:
+                    self._finish(name)
+                continue
+
+            if index + 1 < len(self.stages):
+                self._set_state(name, self.stages[index + 1][0], "queued")
+                self.queues[index + 1].put((name, job))
+                self.log_status(f"Plate {name} finished stage "
+                                f"'{stage_name}'")
+            else:
+                try:
+                    if self.on_complete:
+                        self.on_complete(job)
+                except Exception as e:
+                    logging.exception(e)
+                finally:
+                    self._finish(name)
+                self.log_status(f"Plate {name} finished all stages")
+
+    def _set_state(self, name, stage_name, state):
+        with self.lock:
+            self.plates[name] = (stage_name, state)
+
+    def _finish(self, name):
+        with self.lock:
+            self.plates.pop(name, None)
+            self.lock.notify_all()
+        self.slots.release()
+        self.retry_deferred()
+
+    def status(self):
+        """
+            Returns a dictionary of stage name to a dictionary with
+            lists of "waiting" (for a slot), "queued", "running" and
+            "deferred" plate names
+        """
+        status = {name: {"waiting": [], "queued": [], "running": [],
+                         "deferred": []}
+                  for name, _ in self.stages}
+        with self.lock:
+            for plate, (stage_name, state) in sorted(self.plates.items()):
+                status[stage_name][state].append(plate)
+        return status
+
+    def log_status(self, message):
+        """
+            Logs a message along with the queue depth and in-flight
+            plates of each stage
+        """
+        stages = []
+        counts = {"waiting": 0, "deferred": 0, "in_flight": 0}
+        for stage_name, plates in self.status().items():
+            stages.append(f"{stage_name}: {len(plates['queued'])} queued, "
+                          f"running [{', '.join(plates['running'])}]")
+            counts["waiting"] += len(plates["waiting"])
+            counts["deferred"] += len(plates["deferred"])
+            counts["in_flight"] += (len(plates["queued"]) +
+                                    len(plates["running"]))
+        logging.info(f"{message} | {counts['in_flight']}/"
+                     f"{self.max_plates} plates in flight, "
+                     f"{counts['waiting']} waiting, "
+                     f"{counts['deferred']} deferred | " + "; ".join(stages))
+
+    def wait(self, timeout=None):
+        """
+            Blocks until every admitted plate has finished. Returns
+            False if the timeout expired first, True otherwise
+        """
+        with self.lock:
+            return self.lock.wait_for(
+                lambda: len(self.plates) == len(self.deferred), timeout)
+
+    def shutdown(self, wait=True):
+        """
+            Stops the worker threads once they have drained their queues
+        """
+        if wait:
+            self.wait()
+        for index, _ in self.threads:
+            self.queues[index].put(None)
+        for _, thread in self.threads:
+            thread.join()
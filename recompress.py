@@ -0,0 +1,206 @@
+import functools
+import gzip
+import logging
+import os
+import shutil
+import struct
+import time
+import zlib
+
+import utils
+
+"""
+recompress.py rewrites the fastq.gz files written by bcl-convert, which
+compresses quickly but poorly, as BGZF at a higher compression level, so
+less is uploaded to S3 and kept on the RAID.
+
+BGZF (blocked gzip, as written by htslib's bgzip) is a series of gzip
+members of at most 64 Kb of data each, so every gzip reader can still
+read the files, and htslib based tools can also seek in them.
+
+Each file is written next to the original and read back, and only
+replaces the original if it holds the same reads and data (checked with
+the read count, length and CRC32 of the decompressed data) and is
+smaller.
+"""
+
+# Bytes of data compressed into each BGZF block (as in htslib)
+BLOCK_SIZE = 0xff00
+
+# Largest BGZF block, as its size is stored in 16 bits
+MAX_BLOCK_SIZE = 0x10000
+
+# Bytes of decompressed data processed at a time
+CHUNK_SIZE = 4 * 1024**2
+
+# Suffix of a recompressed file until it replaces the original
+PARTIAL_SUFFIX = '.recompress'
+
+# gzip header with the BGZF extra field: FEXTRA flag, OS unknown, XLEN 6,
+# subfield "BC" of length 2, followed by the block size minus 1
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+
+# Empty block ending every BGZF file
+BGZF_EOF = BGZF_HEADER + b'\x1b\x00\x03\x00' + bytes(8)
+
+
+def bgzf_block(data, level=6):
+    """
+        Returns 'data' (at most BLOCK_SIZE bytes) compressed as a BGZF
+        block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = len(BGZF_HEADER) + 2 + len(deflated) + 8
+    if size > MAX_BLOCK_SIZE:
+        # Incompressible data is stored as is
+        return bgzf_block(data, 0)
+    return (BGZF_HEADER + struct.pack('<H', size - 1) + deflated +
+            struct.pack('<II', zlib.crc32(data), len(data)))
+
+
+def is_bgzf(path):
+    """
+        Returns True if the file starts with a BGZF block
+    """
+    with open(path, 'rb') as f:
+        header = f.read(len(BGZF_HEADER))
+    return header[:4] == BGZF_HEADER[:4] and header[10:] == BGZF_HEADER[10:]
+
+
+def read_summary(path, chunk_size=CHUNK_SIZE):
+    """
+        Decompresses a gzip file and returns the (reads, bytes, CRC32)
+        of its data. A last line without a newline counts as a line
+    """
+    lines = 0
+    length = 0
+    crc = 0
+    last = b'\n'
+    with gzip.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            lines += chunk.count(b'\n')
+            length += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            last = chunk[-1:]
+    if last != b'\n':
+        lines += 1
+    return lines // 4, length, crc
+
+
+def write_bgzf(source, dest, level=6, chunk_size=CHUNK_SIZE):
+    """
+        Compresses the gzip file source into the BGZF file dest. Returns
+        the (reads, bytes, CRC32) of the data, as read_summary
+    """
+    lines = 0
+    length = 0
+    crc = 0
+    last = b'\n'
+    pending = b''
+    with gzip.open(source, 'rb') as src, open(dest, 'wb') as out:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            lines += chunk.count(b'\n')
+            length += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            last = chunk[-1:]
+            pending += chunk
+            complete = len(pending) - len(pending) % BLOCK_SIZE
+            view = memoryview(pending)
+            for offset in range(0, complete, BLOCK_SIZE):
+                out.write(bgzf_block(view[offset:offset + BLOCK_SIZE],
+                                     level))
+            view.release()
+            pending = pending[complete:]
+        if pending:
+            out.write(bgzf_block(pending, level))
+        out.write(BGZF_EOF)
+        out.flush()
+        os.fsync(out.fileno())
+    if last != b'\n':
+        lines += 1
+    return lines // 4, length, crc
+
+
+def recompress_file(path, level=6):
+    """
+        Rewrites a fastq.gz file as BGZF at compression 'level'. The
+        original is only replaced once the new file has been read back
+        and found to hold the same data, and if it is smaller. Files
+        that are already BGZF are left alone.
+
+        Returns a dictionary of:
+            "path": the file
+            "reads": number of reads (None if already BGZF)
+            "bytes_in": size before
+            "bytes_out": size after
+            "seconds": time spent
+            "replaced": whether the original was replaced
+    """
+    start = time.time()
+    bytes_in = os.path.getsize(path)
+    result = {"path": path, "reads": None, "bytes_in": bytes_in,
+              "bytes_out": bytes_in, "replaced": False}
+    if is_bgzf(path):
+        result["seconds"] = time.time() - start
+        return result
+
+    partial = path + PARTIAL_SUFFIX
+    try:
+        written = write_bgzf(path, partial, level)
+        checked = read_summary(partial)
+        if checked != written:
+            raise Exception(f"Recompressed {path} does not match the "
+                            f"original: {checked[0]} reads of "
+                            f"{written[0]}, {checked[1]} bytes of "
+                            f"{written[1]}")
+        result["reads"] = written[0]
+        bytes_out = os.path.getsize(partial)
+        if bytes_out < bytes_in:
+            shutil.copymode(path, partial)
+            os.replace(partial, path)
+            result["bytes_out"] = bytes_out
+            result["replaced"] = True
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    result["seconds"] = time.time() - start
+    return result
+
+
+def recompress_files(paths, level=6, processes=1):
+    """
+        Recompresses fastq.gz files (see recompress_file) in 'processes'
+        processes (see utils.map_processes). Returns a dictionary of:
+            "files": number of files
+            "replaced": number of files replaced
+            "reads": number of reads of the recompressed files
+            "bytes_in": total size before
+            "bytes_out": total size after
+            "seconds": time spent
+
+        The first failure is raised once every file has finished. Files
+        recompressed before it keep their new, checked, contents
+    """
+    start = time.time()
+    results = utils.map_processes(
+        functools.partial(recompress_file, level=level), sorted(paths),
+        processes)
+
+    summary = {"files": len(results),
+               "replaced": sum(result["replaced"] for result in results),
+               "reads": sum(result["reads"] or 0 for result in results),
+               "bytes_in": sum(result["bytes_in"] for result in results),
+               "bytes_out": sum(result["bytes_out"] for result in results),
+               "seconds": time.time() - start}
+    for result in results:
+        if not result["replaced"] and result["reads"] is not None:
+            logging.info(f"Kept {result['path']}: recompressing did not "
+                         "make it smaller")
+    return summary
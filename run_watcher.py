@@ -0,0 +1,225 @@
+import logging
+import os
+import threading
+
+from watchdog.events import (FileSystemEventHandler, FileCreatedEvent,
+                             DirCreatedEvent, FileMovedEvent, DirMovedEvent,
+                             DirDeletedEvent)
+
+"""
+run_watcher.py reports new CopyComplete.txt files in the watch directory
+without watching every file the sequencers write.
+
+Only the top level of the watch directory and the top level of each
+incomplete run directory are watched, so the cbcl files written deeper
+in a run generate no events. Alternatively (or as a safety net), the
+watch directory is polled with os.scandir.
+"""
+
+# Only these events are delivered by the kernel for a watch
+EVENTS = [FileCreatedEvent, DirCreatedEvent, FileMovedEvent, DirMovedEvent,
+          DirDeletedEvent]
+
+
+def run_directories(watch_dir):
+    """
+        Returns the paths of the run directories directly under
+        watch_dir. Hidden directories (e.g. the trash) are not runs
+    """
+    with os.scandir(watch_dir) as entries:
+        return [entry.path for entry in entries
+                if entry.is_dir() and not entry.name.startswith('.')]
+
+
+class RunWatcher(FileSystemEventHandler):
+    """
+        Calls handler.on_created with a FileCreatedEvent for the
+        CopyComplete file of each run directory created directly under
+        watch_dir, once that file appears.
+
+        If observer is set, the top level of watch_dir and of each run
+        directory that is still being copied are watched. The watch of a
+        run is removed once its CopyComplete file is reported, and added
+        back if its plate fails (see rearm), so that re-creating the
+        file triggers the run again.
+
+        If poll_interval is set, watch_dir is also scanned every
+        poll_interval seconds. Without an observer this is the only way
+        runs are found; with one it catches any missed events.
+    """
+    def __init__(self, handler, watch_dir,
+                 copy_complete_filename='CopyComplete.txt', observer=None,
+                 poll_interval=None):
+        super().__init__()
+        self.handler = handler
+        self.watch_dir = os.path.abspath(watch_dir)
+        self.copy_complete_filename = copy_complete_filename
+        self.observer = observer
+        self.poll_interval = poll_interval
+
+        # Run directory -> its ObservedWatch
+        self.runs = {}
+
+        # Run directories whose CopyComplete file has been reported
+        self.reported = set()
+
+        # Run directory -> (inode, mtime) of the CopyComplete file of a
+        # failed run, which is reported again once the file changes
+        self.failed = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def start(self, complete=None):
+        """
+            Starts watching. Runs that are already complete are left to
+            the start up catch up (see BclEventHandler.catch_up).
+
+            complete: the run directories the catch up found complete,
+                      so that a run completing after its scan is still
+                      reported. Scanned here if None
+        """
+        if complete is None:
+            complete = [path for path in self.run_directories()
+                        if self.is_complete(path)]
+        self.reported.update(os.path.abspath(path) for path in complete)
+        if self.observer is not None:
+            self.observer.schedule(self, self.watch_dir, recursive=False,
+                                   event_filter=EVENTS)
+            for path in self.run_directories():
+                if path not in self.reported:
+                    self.watch_run(path)
+        if self.poll_interval:
+            threading.Thread(target=self._poll, daemon=True,
+                             name="run-poller").start()
+        logging.info(f"Watching run directories in {self.watch_dir} "
+                     f"({len(self.runs)} incomplete runs watched, polling "
+                     f"every {self.poll_interval or 'never'}s)")
+
+    def stop(self):
+        self.stopping.set()
+
+    def run_directories(self):
+        return run_directories(self.watch_dir)
+
+    def is_complete(self, path):
+        return os.path.isfile(os.path.join(path,
+                                           self.copy_complete_filename))
+
+    def watch_run(self, path):
+        """
+            Watches the top level of a run directory until its
+            CopyComplete file appears
+        """
+        with self.lock:
+            if path in self.runs or path in self.reported:
+                return
+            try:
+                self.runs[path] = self.observer.schedule(
+                    self, path, recursive=False, event_filter=EVENTS)
+            except OSError as e:
+                # e.g. out of inotify watches. Polling will find the run
+                logging.info(f"Cannot watch {path}: {e}")
+                return
+        # It may have been written before the watch started
+        if self.is_complete(path):
+            self.report(path)
+
+    def unwatch_run(self, path):
+        with self.lock:
+            watch = self.runs.pop(path, None)
+        if watch is not None:
+            try:
+                self.observer.unschedule(watch)
+            except (KeyError, OSError):
+                pass
+
+    def copy_complete_id(self, path):
+        try:
+            stat = os.stat(os.path.join(path, self.copy_complete_filename))
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def report(self, path):
+        """
+            Passes the CopyComplete file of a run to the handler, once.
+            A failed run is passed again once its file has changed
+        """
+        with self.lock:
+            if path in self.reported:
+                return
+            if path in self.failed:
+                if self.copy_complete_id(path) == self.failed[path]:
+                    return
+                del self.failed[path]
+            self.reported.add(path)
+        if self.observer is not None:
+            self.unwatch_run(path)
+        self.handler.on_created(FileCreatedEvent(
+            os.path.join(path, self.copy_complete_filename)))
+
+    def rearm(self, path):
+        """
+            Called when the plate of a reported run fails. The run is
+            watched (or polled) again, and reported once its
+            CopyComplete file is re-created
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            if path not in self.reported:
+                return
+            self.reported.discard(path)
+            self.failed[path] = self.copy_complete_id(path)
+        logging.info(f"Waiting for {self.copy_complete_filename} to be "
+                     f"re-created to retry {path}")
+        if self.observer is not None:
+            self.watch_run(path)
+
+    def created(self, path, is_directory):
+        parent = os.path.dirname(path)
+        if is_directory and parent == self.watch_dir:
+            if not os.path.basename(path).startswith('.'):
+                self.watch_run(path)
+        elif not is_directory and \
+                os.path.basename(path) == self.copy_complete_filename and \
+                os.path.dirname(parent) == self.watch_dir:
+            self.report(parent)
+
+    def on_created(self, event):
+        self.created(os.path.abspath(event.src_path), event.is_directory)
+
+    def on_moved(self, event):
+        self.created(os.path.abspath(event.dest_path), event.is_directory)
+
+    def on_deleted(self, event):
+        path = os.path.abspath(event.src_path)
+        if event.is_directory and os.path.dirname(path) == self.watch_dir:
+            self.unwatch_run(path)
+            with self.lock:
+                self.reported.discard(path)
+                self.failed.pop(path, None)
+
+    def poll(self):
+        """
+            Reports complete runs that have not been reported yet. Costs
+            one scandir of watch_dir and a stat of each incomplete run
+        """
+        paths = self.run_directories()
+        for path in paths:
+            if path not in self.reported and self.is_complete(path):
+                self.report(path)
+        # Forget runs that have been removed
+        with self.lock:
+            removed = [path for path in
+                       self.reported.union(self.failed).difference(paths)
+                       if not os.path.isdir(path)]
+            self.reported.difference_update(removed)
+            for path in removed:
+                self.failed.pop(path, None)
+
+    def _poll(self):
+        while not self.stopping.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logging.exception(e)
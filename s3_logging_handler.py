@@ -1,15 +1,42 @@
+import glob
+import gzip
 import logging
+import logging.handlers
+import os
+import posixpath
+import shutil
+import threading
+import traceback
+from datetime import datetime
 
-import boto3
+import utils
 
-class S3LoggingHandler(logging.FileHandler):
+class S3LoggingHandler(logging.handlers.BaseRotatingHandler):
 
-    def __init__(self, filename, bucket, key, endpoint_url=None):
+    def __init__(self, filename, bucket, key, endpoint_url=None,
+                 flush_interval=30, flush_records=50,
+                 max_bytes=10*1024**2, rotate_daily=True):
         """
             This custom logger logs events to a file and uploads to S3
+
+            Records are written to the file immediately. The file is
+            uploaded to 'key' by a background thread every
+            'flush_interval' seconds, or once 'flush_records' records
+            have been written since the last upload. Records at ERROR
+            level or above wake the thread to upload straight away, and
+            closing the handler uploads the remainder. S3 is never called
+            from emit, as it runs under the handler's lock and the S3
+            client's own threads log through this handler.
+
+            The file is rotated once it reaches 'max_bytes' (0 for no
+            limit) or, if 'rotate_daily' is set, when the day changes.
+            Each closed segment is gzipped and uploaded once to
+            {dirname(key)}/{YYYY-MM-DD}/{basename(key)}.{start time}.gz
+            and then removed locally, so only the small active segment is
+            uploaded repeatedly.
         """
         # Initialise class like a normal FileHandler does
-        super().__init__(filename)
+        super().__init__(filename, 'a')
 
         # S3 Target
         self.bucket = bucket
@@ -17,23 +44,182 @@ class S3LoggingHandler(logging.FileHandler):
 
         # bit of a hack as botocore.credentials seems log changing
         # credentials, which is not useful. This forces it to only log
-        # error messages 
-        boto3.set_stream_logger(name='botocore.credentials',
-                                level=logging.ERROR)
+        # error messages
+        utils.boto3.set_stream_logger(name='botocore.credentials',
+                                      level=logging.ERROR)
 
         # Endpoint Url is required to transfer from Weybridge to the SCE
         # However it is not required for transfers within the SCE
-        if endpoint_url is None:
-            self.s3 = boto3.client("s3")
-        else:
-            self.s3 = boto3.client("s3", endpoint_url=endpoint_url)
+        self.s3 = utils.s3_client(endpoint_url)
+
+        # Rotation
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.segment_start = self._segment_start()
+
+        # Closed segments waiting to be uploaded, including any left
+        # behind by a previous run
+        self.segments = sorted(
+            path for path in glob.glob(glob.escape(self.baseFilename) + '.*')
+            if path[len(self.baseFilename) + 1:][:8].isdigit())
+
+        # Number of records written since the last upload
+        self.flush_interval = flush_interval
+        self.flush_records = flush_records
+        self.dirty = 0
+        self.rolled_over = False
+        self.flush_requested = False
+        self.condition = threading.Condition()
+        self.upload_lock = threading.Lock()
+
+        # Upload in the background
+        self.stopping = False
+        self.worker = threading.Thread(target=self._run, daemon=True,
+                                       name="s3-logging")
+        self.worker.start()
+
+    def _segment_start(self):
+        """
+            Returns when the active segment was started: now if it is
+            empty, otherwise when it was last written
+        """
+        if os.path.getsize(self.baseFilename):
+            return datetime.fromtimestamp(os.path.getmtime(self.baseFilename))
+        return datetime.now()
+
+    def shouldRollover(self, record):
+        """
+            Returns True if the active segment should be closed before
+            writing the record
+        """
+        if self.stream is None or not self.stream.tell():
+            return False
+        if self.rotate_daily and \
+                datetime.fromtimestamp(record.created).date() != \
+                self.segment_start.date():
+            return True
+        if self.max_bytes:
+            size = len(self.format(record)) + len(self.terminator)
+            return self.stream.tell() + size > self.max_bytes
+        return False
+
+    def doRollover(self):
+        """
+            Closes the active segment and queues it for upload
+        """
+        self.stream.close()
+        self.stream = None
+
+        segment = (f"{self.baseFilename}."
+                   f"{self.segment_start.strftime('%Y%m%d-%H%M%S')}")
+        name = segment
+        count = 1
+        while os.path.exists(name) or os.path.exists(name + '.gz'):
+            name = f"{segment}-{count}"
+            count += 1
+        os.rename(self.baseFilename, name)
+
+        self.stream = self._open()
+        self.segment_start = datetime.now()
+        with self.condition:
+            self.segments.append(name)
+            self.rolled_over = True
+            self.condition.notify()
+
+    def segment_key(self, segment):
+        """
+            Returns the S3 key for a closed (gzipped) segment
+        """
+        stamp = os.path.basename(segment)[
+            len(os.path.basename(self.baseFilename)) + 1:]
+        date = datetime.strptime(stamp[:8], '%Y%m%d').date()
+        name = f"{posixpath.basename(self.key)}.{stamp}"
+        if not name.endswith('.gz'):
+            name += '.gz'
+        return posixpath.join(posixpath.dirname(self.key), str(date), name)
 
     def emit(self, record):
         """
-            Logs file locally and then upload to s3
+            Logs file locally and schedules an upload to s3
         """
-        # Log like a normal FileHandler does
+        # Log like a normal RotatingFileHandler does
         super().emit(record)
 
-        # Upload to S3
-        self.s3.upload_file(self.baseFilename, self.bucket, self.key)
+        with self.condition:
+            self.dirty += 1
+            # Get failures to S3 quickly. If the process then exits,
+            # close() uploads them
+            if record.levelno >= logging.ERROR:
+                self.flush_requested = True
+            if self.flush_requested or self.dirty >= self.flush_records:
+                self.condition.notify()
+
+    def ship_segments(self):
+        """
+            Gzips and uploads each closed segment once, then removes it
+        """
+        while True:
+            with self.condition:
+                if not self.segments:
+                    return
+                segment = self.segments[0]
+
+            if not segment.endswith('.gz'):
+                with open(segment, 'rb') as src, \
+                        gzip.open(segment + '.gz', 'wb') as dest:
+                    shutil.copyfileobj(src, dest)
+                os.remove(segment)
+                segment += '.gz'
+                with self.condition:
+                    self.segments[0] = segment
+
+            self.s3.upload_file(segment, self.bucket,
+                                self.segment_key(segment))
+            os.remove(segment)
+            with self.condition:
+                self.segments.pop(0)
+
+    def upload(self):
+        """
+            Uploads closed segments and the active log file to s3
+        """
+        with self.upload_lock:
+            with self.condition:
+                self.dirty = 0
+                self.rolled_over = False
+                self.flush_requested = False
+            try:
+                self.ship_segments()
+                self.s3.upload_file(self.baseFilename, self.bucket, self.key)
+            except Exception:
+                # Logging the failure would try to upload again
+                traceback.print_exc()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.stopping or self.rolled_over
+                    or self.flush_requested
+                    or self.dirty >= self.flush_records,
+                    timeout=self.flush_interval)
+                if self.stopping:
+                    return
+                pending = self.dirty or self.segments
+            if pending:
+                self.upload()
+
+    def close(self):
+        """
+            Stops the upload thread and uploads any remaining records
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.worker.is_alive():
+            self.worker.join()
+        with self.condition:
+            pending = self.dirty or self.segments
+        if pending:
+            self.upload()
+        super().close()
@@ -0,0 +1,190 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from run_watcher import run_directories
+
+"""
+throttle.py limits the bandwidth used by the backup copy and the fastq
+upload, so the network link and disks stay free for the sequencers
+copying runs into the watch directory.
+
+A Throttle is a token bucket shared by every thread of a stage. Its rate
+can be lifted during full speed hours (e.g. overnight) and reduced while
+a sequencer is still writing a run to the watch directory.
+"""
+
+# Run directories still being written are counted this often (seconds)
+CHECK_INTERVAL = 60
+
+# Incomplete runs not modified for this long are assumed abandoned
+STALE_SECONDS = 3 * 24 * 60 * 60
+
+# Longest single sleep, so that rate changes take effect promptly
+MAX_WAIT = 1.0
+
+
+class TokenBucket:
+    """
+        Limits a flow of bytes to 'rate' bytes per second, allowing
+        bursts of up to 'burst' bytes (default: one second's worth). A
+        rate of None is unlimited.
+
+        Amounts larger than the burst may be consumed: the bucket goes
+        into debt, and every caller waits until it is paid back
+    """
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = self.capacity()
+        self.last = time.monotonic()
+        # Total seconds callers were made to wait
+        self.waited = 0.0
+
+    def capacity(self):
+        return self.burst or self.rate or 0
+
+    def refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity(),
+                              self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+            self.tokens = min(self.tokens, self.capacity()) if rate else 0
+
+    def consume(self, amount):
+        """
+            Takes 'amount' tokens, blocking until the bucket is out of
+            debt. Returns the seconds waited
+        """
+        waited = 0.0
+        with self.lock:
+            if not self.rate:
+                return waited
+            self.refill()
+            self.tokens -= amount
+        while True:
+            with self.lock:
+                self.refill()
+                if not self.rate or self.tokens >= 0:
+                    self.waited += waited
+                    return waited
+                wait = min(-self.tokens / self.rate, MAX_WAIT)
+            time.sleep(wait)
+            waited += wait
+
+
+def parse_hours(hours):
+    """
+        Parses "start-end" hours of the day, e.g. "22-6", into a
+        (start, end) tuple. The range may wrap past midnight
+    """
+    try:
+        start, end = (int(hour) for hour in hours.split("-"))
+    except ValueError:
+        raise Exception(f"Hours must be formatted as start-end: {hours}")
+    if not (0 <= start < 24 and 0 <= end < 24):
+        raise Exception(f"Hours must be between 0 and 23: {hours}")
+    return start, end
+
+
+def in_hours(hours, now):
+    start, end = hours
+    if start <= end:
+        return start <= now.hour < end
+    return now.hour >= start or now.hour < end
+
+
+def count_sequencing_runs(watch_dir,
+                          copy_complete_filename='CopyComplete.txt',
+                          stale_seconds=STALE_SECONDS):
+    """
+        Returns the number of run directories in watch_dir without a
+        CopyComplete file, i.e. still being written by a sequencer.
+        Directories not modified for stale_seconds are ignored
+    """
+    now = time.time()
+    count = 0
+    for path in run_directories(watch_dir):
+        if now - os.path.getmtime(path) > stale_seconds:
+            continue
+        if not os.path.isfile(os.path.join(path, copy_complete_filename)):
+            count += 1
+    return count
+
+
+class Throttle(TokenBucket):
+    """
+        A TokenBucket whose rate follows a schedule.
+
+        rate: bytes per second, or None for no limit
+        full_speed_hours: (start, end) hours of the day without a limit
+        busy_factor: the rate is multiplied by this while runs in
+                     watch_dir are still being written by a sequencer
+        name: used in log messages
+
+        The schedule is checked at most every check_interval seconds,
+        when bytes are consumed
+    """
+    def __init__(self, rate=None, full_speed_hours=None, busy_factor=1.0,
+                 watch_dir=None, copy_complete_filename='CopyComplete.txt',
+                 check_interval=CHECK_INTERVAL, name="transfer"):
+        super().__init__(rate)
+        self.limit = rate
+        self.full_speed_hours = full_speed_hours
+        self.busy_factor = busy_factor
+        self.watch_dir = watch_dir
+        self.copy_complete_filename = copy_complete_filename
+        self.check_interval = check_interval
+        self.name = name
+        self.last_check = None
+
+    def scheduled_rate(self, now=None):
+        """
+            Returns the rate that applies now, and the number of runs
+            being written by sequencers
+        """
+        now = now or datetime.now()
+        if self.limit is None or (self.full_speed_hours and
+                                  in_hours(self.full_speed_hours, now)):
+            return None, 0
+        sequencing = 0
+        if self.watch_dir is not None and self.busy_factor != 1.0:
+            sequencing = count_sequencing_runs(self.watch_dir,
+                                               self.copy_complete_filename)
+        if sequencing:
+            return self.limit * self.busy_factor, sequencing
+        return self.limit, sequencing
+
+    def update(self, now=None):
+        """
+            Applies the scheduled rate, logging any change
+        """
+        self.last_check = time.monotonic()
+        try:
+            rate, sequencing = self.scheduled_rate(now)
+        except OSError as e:
+            logging.info(f"Could not check {self.name} limit: {e}")
+            return
+        if rate != self.rate:
+            limit = "none" if rate is None else \
+                f"{rate / 1024**2:.1f} Mb/s"
+            logging.info(f"{self.name.capitalize()} limit: {limit} "
+                         f"({sequencing} runs being sequenced)")
+            self.set_rate(rate)
+
+    def consume(self, amount):
+        if self.limit is None:
+            return 0.0
+        if self.last_check is None or \
+                time.monotonic() - self.last_check >= self.check_interval:
+            self.update()
+        return super().consume(amount)
@@ -1,15 +1,46 @@
 import unittest
+import argparse
 from unittest.mock import Mock, MagicMock, patch, call
 import time
 import os
+import logging
+import gzip
+import json
+import errno
+from os.path import basename
 import tempfile
 import pathlib
+import threading
+import concurrent.futures
+import glob
+import subprocess
+import urllib.request
+from datetime import datetime
 
 from pyfakefs import fake_filesystem_unittest
 import watchdog
+import boto3
+from moto import mock_aws
 
 import bcl_manager
+import upload_manifest
+import utils
 from bcl_manager import SubdirectoryException
+from plate_scheduler import PlateScheduler
+from fastq_streamer import FastqStreamer
+from s3_logging_handler import S3LoggingHandler
+import backup
+from plate_index import PlateIndex
+import metrics
+import benchmark
+import catalogue
+import deletion
+import fastq_qc
+import recompress
+from run_watcher import RunWatcher
+import throttle
+from throttle import TokenBucket, Throttle, parse_hours
+from watchdog.observers import Observer
 
 
 class TestBclManager(fake_filesystem_unittest.TestCase):
@@ -17,6 +48,28 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
         """
             Set up method
         """
+        # Tests below replace module attributes with mocks directly.
+        # Patching each attribute with itself restores it afterwards.
+        for target, attribute in [(bcl_manager, 'logging'),
+                                  (bcl_manager, 'remove_plate'),
+                                  (bcl_manager, 'observers'),
+                                  (bcl_manager.utils, 'boto3'),
+                                  (bcl_manager.utils, 's3_upload_files'),
+                                  (bcl_manager.upload_manifest,
+                                   'upload_files'),
+                                  (bcl_manager.backup, 'copy_tree'),
+                                  (glob, 'glob'),
+                                  (subprocess, 'run')]:
+            patcher = patch.object(target, attribute,
+                                   getattr(target, attribute))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # Don't keep S3 clients made from a mocked boto3
+        patcher = patch.dict(bcl_manager.utils.s3_clients)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         # use "fake" in-memory filesystem
         self.setUpPyfakefs()
 
@@ -73,17 +126,88 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
 
         self.assertTrue(bcl_manager.logging.exception.called)
 
+    def test_on_created_scheduled(self):
+        """
+            Assert on_created only queues plates when a scheduler is set
+        """
+        bcl_manager.logging = MagicMock()
+        bcl_manager.shutil.disk_usage = Mock(return_value=(0, 0, 0))
+        handler = bcl_manager.BclEventHandler('./', './', './', '', '', '',
+                                              '', '')
+        handler.process_bcl_plate = Mock()
+        handler.scheduler = Mock()
+
+        event = watchdog.events.FileCreatedEvent(
+            '/path/to/220401_NB501786_0396_AHKGT5AFX3/CopyComplete.txt')
+        handler.on_created(event)
+        handler.scheduler.submit.assert_not_called()
+
+        # Submitted by the submit thread
+        handler.start_submitter()
+        handler.submissions.join()
+        handler.scheduler.submit.assert_called_once_with(
+            '220401_NB501786_0396_AHKGT5AFX3', event)
+        handler.process_bcl_plate.assert_not_called()
+
+    def test_backup_and_convert(self):
+        """
+            Asserts the backup runs alongside the conversion and that
+            failures of either are raised once both have finished
+        """
+        bcl_manager.logging = MagicMock()
+        bcl_manager.shutil.disk_usage = Mock(return_value=(0, 0, 0))
+        handler = bcl_manager.BclEventHandler('./', './', './', '', '', '',
+                                              '', '', overlap_backup=True)
+        self.assertEqual([name for name, _ in handler.stages()],
+                         ["convert", "upload"])
+
+        class Event():
+            fastq_path = "./fastq/plate/"
+        event = Event()
+
+        # Both stages overlap
+        converting = threading.Event()
+        overlapped = threading.Event()
+        handler.convert = Mock(side_effect=lambda _: (converting.set(),
+                                                      overlapped.wait(5)))
+        handler.backup = Mock(side_effect=lambda _: (converting.wait(5),
+                                                     overlapped.set()))
+        handler.backup_and_convert(event)
+        self.assertTrue(overlapped.is_set())
+
+        # Conversion failure is raised after the backup finishes
+        handler.convert = Mock(side_effect=Exception("bcl-convert failed"))
+        handler.backup = Mock()
+        with self.assertRaisesRegex(Exception, "bcl-convert failed"):
+            handler.backup_and_convert(event)
+        handler.backup.assert_called_once_with(event)
+
+        # Backup failure removes the converted fastq
+        os.makedirs(event.fastq_path)
+        handler.convert = Mock()
+        handler.backup = Mock(side_effect=Exception("backup failed"))
+        with self.assertRaisesRegex(Exception, "backup failed"):
+            handler.backup_and_convert(event)
+        self.assertFalse(os.path.exists(event.fastq_path))
+
     def test_copy(self):
         """
             Asserts the copy method does not overwrite directories
         """
-        # Mocking shutil.copytree prevents any actual data from being copied during testing
-        bcl_manager.shutil.copytree = Mock()
+        def copy_tree(src, dest, *args, **kwargs):
+            os.makedirs(dest)
+            return dict.fromkeys(["files", "copied", "skipped", "bytes",
+                                  "seconds", "bytes_per_second"], 0)
+
+        # Mocking copy_tree prevents any actual data from being copied during testing
+        bcl_manager.backup.copy_tree = Mock(side_effect=copy_tree)
 
         with self.assertRaises(Exception):
             bcl_manager.copy('./', './')
 
         bcl_manager.copy('./', './DOES/NOT/EXIST/')
+        self.assertTrue(os.path.isdir('./DOES/NOT/EXIST/'))
+        self.assertFalse(os.path.exists('./DOES/NOT/EXIST.partial'))
 
     def assertOnCreatedProcessing(self, handler, bcl_plate_processing_expected, src_path):
         """
@@ -99,6 +223,24 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
         # Assert if process_bcl_plate() was called
         self.assertTrue(bcl_plate_processing_expected == handler.process_bcl_plate.called)
 
+    @unittest.mock.patch("bcl_manager.BclEventHandler")
+    def test_start_catch_up_after_watching(self, handler_class):
+        """
+            The catch up only lists the watch directory once it is
+            watched, so no run is missed in between
+        """
+        bcl_manager.logging = Mock()
+        bcl_manager.observers = Mock()
+        calls = Mock()
+        calls.attach_mock(bcl_manager.observers.Observer.return_value.start,
+                          "watch")
+        calls.attach_mock(handler_class.return_value.start_catch_up,
+                          "catch_up")
+        bcl_manager.start('./watch_dir/', './fastq_dir/', './backup_dir/', '',
+                          '', '', '', '', watch_mode="recursive")
+        self.assertEqual([name for name, _, _ in calls.mock_calls],
+                         ["watch", "catch_up"])
+
     @unittest.mock.patch("bcl_manager.BclEventHandler")
     def test_start(self, _):
         """
@@ -106,7 +248,7 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
         """
         # Mocking allows us to stop logging and s3 uploads during testing
         bcl_manager.logging = Mock()
-        bcl_manager.Observer = Mock()
+        bcl_manager.observers = Mock()
         bcl_manager.input = Mock()
 
         # This case should pass
@@ -144,6 +286,29 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
         with self.assertRaises(Exception):
             bcl_manager.convert_to_fastq('./', './')
 
+    def test_convert_settings(self):
+        """
+            Thread budgets, CPU affinity and priorities are passed to
+            bcl-convert
+        """
+        bcl_manager.subprocess.run = Mock(return_value=Mock(returncode=0))
+        command = bcl_manager.convert_to_fastq('./', './', threads=6,
+                                               cpus=[4, 5], nice=10,
+                                               ionice=7)
+        self.assertEqual(command[:12],
+                         ["taskset", "-c", "4,5", "nice", "-n", "10",
+                          "ionice", "-c", "2", "-n", "7", "bcl-convert"])
+        self.assertEqual(command[-6:],
+                         ["--bcl-num-conversion-threads", "6",
+                          "--bcl-num-compression-threads", "6",
+                          "--bcl-num-decompression-threads", "3"])
+        bcl_manager.subprocess.run.assert_called_once_with(command)
+
+        # CPUs are split between concurrent conversions
+        self.assertEqual(bcl_manager.split_cpus(3, range(8)),
+                         [[0, 1, 2], [3, 4, 5], [6, 7]])
+        self.assertEqual(bcl_manager.split_cpus(4, [0, 1]), [[0], [1]])
+
     def test_upload(self):
         # Test cases
         class Event():
@@ -152,8 +317,8 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
         good_event = Event("220401_instrumentID_runnumber_flowcellID/")
         bad_event = Event("incorrectly-formatted/")
         # Mocks
-        s3_sync_mock = Mock()
-        bcl_manager.utils.s3_sync = s3_sync_mock
+        upload_files_mock = Mock(return_value=[])
+        bcl_manager.upload_manifest.upload_files = upload_files_mock
         bcl_manager.subprocess.run = Mock()
         bcl_manager.utils.boto3 = Mock()
         bcl_manager.glob.glob = Mock(return_value=["directory_name"])
@@ -168,11 +333,205 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
 
         # Successful upload
         handler.upload(good_event)
+        upload_files_mock.assert_called_once()
 
         # Raises error if src_path is incorrectly formatted
         with self.assertRaises(Exception):
             handler.upload(bad_event)
 
+    def test_upload_priority(self):
+        """
+            Salmonella projects are uploaded first and submitted as soon
+            as they are on S3, while other projects upload concurrently
+        """
+        fastq_path = "/fastq/220401_NB501786_0396_AHKGT5AFX3/"
+        for project in ["TB0001", "FZ2000", "TB0002"]:
+            self.fs.create_file(f"{fastq_path}{project}/a.fastq.gz")
+        event = Mock(fastq_path=fastq_path, streamer=None)
+
+        log = []
+        lock = threading.Lock()
+        active = []
+
+        def upload_files(files, *args, **options):
+            with lock:
+                active.append(files)
+                log.append(("upload", os.path.dirname(files[0][1]),
+                            options["threads"], len(active)))
+            time.sleep(0.05)
+            with lock:
+                active.remove(files)
+            return []
+
+        def upload_json(bucket, key, *args, **kwargs):
+            log.append(("meta", os.path.dirname(key)))
+
+        def submit_batch_job(bucket, key, *args):
+            log.append(("submit", key))
+
+        bcl_manager.upload_manifest.upload_files = Mock(
+            side_effect=upload_files)
+        with patch("bcl_manager.utils.upload_json",
+                   side_effect=upload_json), \
+                patch("bcl_manager.submit_batch_job",
+                      side_effect=submit_batch_job):
+            handler = bcl_manager.BclEventHandler(
+                "./", "./", "./", "bucket", "key", None, "", "")
+            handler.upload(event)
+            self.assertEqual(log[:3],
+                             [("upload", "key/FZ2000/NB501786_0396", 8, 1),
+                              ("meta", "key/FZ2000/NB501786_0396"),
+                              ("submit", "key/FZ2000/NB501786_0396")])
+            self.assertEqual([entry[1] for entry in log[3:]],
+                             ["key/TB0001/NB501786_0396"] * 2 +
+                             ["key/TB0002/NB501786_0396"] * 2)
+
+            # Two projects at a time, with half the threads each
+            log.clear()
+            handler = bcl_manager.BclEventHandler(
+                "./", "./", "./", "bucket", "key", None, "", "",
+                project_upload_workers=2)
+            handler.upload(event)
+            uploads = [entry for entry in log if entry[0] == "upload"]
+            self.assertEqual([entry[2] for entry in uploads], [4, 4, 4])
+            self.assertEqual(max(entry[3] for entry in uploads), 2)
+
+    def test_recompress_stage(self):
+        """
+            Recompression runs as a stage between convert and upload,
+            and cannot be combined with streamed uploads
+        """
+        bcl_manager.logging = MagicMock()
+        bcl_manager.shutil.disk_usage = Mock(return_value=(0, 0, 0))
+        handler = bcl_manager.BclEventHandler('./', './', './', '', '', '',
+                                              '', '', recompress_fastq=True,
+                                              recompress_level=9)
+        self.assertEqual([name for name, _ in handler.stages()],
+                         ["copy", "convert", "recompress", "upload"])
+        with self.assertRaises(Exception):
+            bcl_manager.BclEventHandler('./', './', './', '', '', '', '', '',
+                                        recompress_fastq=True,
+                                        stream_upload=True)
+
+        self.fs.create_file("/fastq/plate/FZ2000/a.fastq.gz")
+        self.fs.create_file("/fastq/plate/a.fastq.gz")
+        stats = {"files": 1, "replaced": 1, "reads": 10, "bytes_in": 100,
+                 "bytes_out": 60, "seconds": 1.0}
+        event = Mock(fastq_path="/fastq/plate/", src_name="plate")
+        with patch("bcl_manager.recompress.recompress_files",
+                   return_value=stats) as recompress_files:
+            handler.recompress(event)
+        recompress_files.assert_called_once_with(
+            ["/fastq/plate/FZ2000/a.fastq.gz"], 9, 1)
+        self.assertIn("saving 0.0 Mb (40.0%)",
+                      bcl_manager.logging.info.call_args[0][0])
+
+    def test_backfill(self):
+        """
+            Runs are found by path or glob, run through the chosen
+            stages and timed, and a failed run does not stop the others
+        """
+        bcl_manager.logging = MagicMock()
+        bcl_manager.shutil.disk_usage = Mock(return_value=(0, 0, 0))
+        runs = ["220401_NB501786_0396_AHKGT5AFX3",
+                "220402_NB501786_0397_AHKGT5AFX4"]
+        for run in runs:
+            self.fs.create_file(f"/runs/{run}/CopyComplete.txt")
+        self.fs.create_dir("/runs/220403_NB501786_0398_AHKGT5AFX5")
+        self.fs.create_dir("/backup")
+        self.fs.create_dir("/fastq")
+
+        self.assertEqual(bcl_manager.find_runs(["/runs/220402*",
+                                                "/runs/2204*1_*/",
+                                                f"/runs/{runs[1]}"]),
+                         [f"/runs/{runs[1]}/", f"/runs/{runs[0]}/"])
+        with self.assertRaises(Exception):
+            bcl_manager.find_runs(["/runs/2204*"])
+        with self.assertRaises(Exception):
+            bcl_manager.find_runs(["/runs/2205*"])
+
+        def convert(handler, event):
+            self.assertFalse(handler.submit_jobs)
+            if event.src_name == runs[1]:
+                raise Exception("bcl-convert failed")
+
+        with patch.object(bcl_manager.BclEventHandler, "convert",
+                          autospec=True, side_effect=convert), \
+                patch.object(bcl_manager.BclEventHandler, "deliver",
+                             autospec=True) as deliver:
+            results = bcl_manager.backfill(
+                bcl_manager.find_runs(["/runs/2204*1_*", "/runs/2204*2_*"]),
+                "/runs/", "/backup/", "/fastq/", "bucket", "", None, "", "",
+                ["convert", "upload"], convert_workers=2)
+
+        self.assertEqual([result["run"] for result in results], runs)
+        self.assertEqual(sorted(results[0]["seconds"]), ["convert", "upload"])
+        self.assertIsNone(results[0]["error"])
+        self.assertEqual(list(results[1]["seconds"]), ["convert"])
+        self.assertEqual(results[1]["error"], "convert: bcl-convert failed")
+        deliver.assert_called_once()
+        self.assertEqual(deliver.call_args[0][1].fastq_path,
+                         f"/fastq/{runs[0]}/")
+        self.assertEqual(deliver.call_args[1], {"clean_up": False})
+
+        summary = bcl_manager.timing_summary(results, ["convert", "upload"])
+        lines = summary.splitlines()
+        self.assertEqual(lines[0].split(), ["Run", "convert", "upload",
+                                            "Status"])
+        self.assertTrue(lines[1].startswith(runs[0]))
+        self.assertTrue(lines[1].endswith("ok"))
+        self.assertIn("-  failed in convert: bcl-convert failed", lines[2])
+        self.assertTrue(lines[3].startswith("Total"))
+
+        # Submitting on its own only submits the Salmonella projects
+        for project in ["FZ2000", "TB0001"]:
+            self.fs.create_file(f"/fastq/{runs[0]}/{project}/a.fastq.gz")
+        with patch("bcl_manager.submit_batch_job") as submit_batch_job:
+            results = bcl_manager.backfill(
+                [f"/runs/{runs[0]}/"], "/runs/", "/backup/", "/fastq/",
+                "bucket", "key", None, "", "", ["submit"])
+        self.assertIsNone(results[0]["error"])
+        submit_batch_job.assert_called_once()
+        self.assertEqual(submit_batch_job.call_args[0][:2],
+                         ("bucket", "key/FZ2000/NB501786_0396"))
+
+        with self.assertRaises(Exception):
+            bcl_manager.backfill([], "/runs/", "/backup/", "/fastq/", "", "",
+                                 None, "", "", ["download"])
+
+    def test_backfill_dry_run(self):
+        """
+            A dry run lists the runs without importing boto3 or watchdog
+            observers
+        """
+        self.fs.create_file("/runs/220401_NB501786_0396_AHKGT5AFX3/"
+                            "CopyComplete.txt")
+        lazy = [utils.LazyModule("boto3"),
+                utils.LazyModule("watchdog.observers")]
+        bcl_manager.utils.boto3, bcl_manager.observers = lazy
+        with patch("builtins.print") as output:
+            self.assertEqual(bcl_manager.main(["backfill", "/runs/*",
+                                               "--dry-run"]), 0)
+        self.assertIn("/runs/220401_NB501786_0396_AHKGT5AFX3/",
+                      output.call_args_list[1][0][0])
+        self.assertTrue(all(module.module is None for module in lazy))
+        self.assertIs(lazy[0].client, boto3.client)
+        self.assertIs(lazy[1].Observer, watchdog.observers.Observer)
+
+    def test_plate_index_default(self):
+        """
+            The plate index defaults to a hidden file in the fastq
+            directory
+        """
+        parser = argparse.ArgumentParser()
+        bcl_manager.add_common_arguments(parser, "test.log")
+        args = parser.parse_args(["--fastq-dir", "/fastq/"])
+        self.assertEqual(bcl_manager.handler_options(args)["plate_index_path"],
+                         "/fastq/.plate-index.sqlite")
+        args = parser.parse_args(["--plate-index", "/index.sqlite"])
+        self.assertEqual(bcl_manager.handler_options(args)["plate_index_path"],
+                         "/index.sqlite")
+
     def test_clean_up(self):
         """
             Test removing old plates
@@ -231,13 +590,13 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
                 bcl_manager.clean_up(os.path.join(temp_directory, "fastq_dir"),
                                      os.path.join(temp_directory, "watch_dir"),
                                      os.path.join(temp_directory, "backup_dir"))
-        correct_calls = [call([os.path.join(temp_directory, "watch_dir/plate_1")]),
+        correct_calls = [call([os.path.join(temp_directory, "watch_dir/plate_1")], None),
                          call([os.path.join(temp_directory, "fastq_dir/plate_1"),
-                               os.path.join(temp_directory, "backup_dir/plate_1")]),
-                         call([os.path.join(temp_directory, "watch_dir/plate_2")]),
+                               os.path.join(temp_directory, "backup_dir/plate_1")], None),
+                         call([os.path.join(temp_directory, "watch_dir/plate_2")], None),
                          call([os.path.join(temp_directory, "fastq_dir/plate_2"),
-                               os.path.join(temp_directory, "backup_dir/plate_2")]),
-                         call([os.path.join(temp_directory, "watch_dir/plate_3")])]
+                               os.path.join(temp_directory, "backup_dir/plate_2")], None),
+                         call([os.path.join(temp_directory, "watch_dir/plate_3")], None)]
         # assert correct calls regardless of order
         self.assertCountEqual(correct_calls, bcl_manager.remove_plate.mock_calls)
         # reset call attributes of bcl_manager.remove_plate mock
@@ -273,9 +632,9 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
                 bcl_manager.clean_up(os.path.join(temp_directory, "fastq_dir"),
                                      os.path.join(temp_directory, "watch_dir"),
                                      os.path.join(temp_directory, "backup_dir"))
-        correct_calls = [call([os.path.join(temp_directory, "watch_dir/plate_1")]),
-                         call([os.path.join(temp_directory, "watch_dir/plate_2")]),
-                         call([os.path.join(temp_directory, "watch_dir/plate_3")])]
+        correct_calls = [call([os.path.join(temp_directory, "watch_dir/plate_1")], None),
+                         call([os.path.join(temp_directory, "watch_dir/plate_2")], None),
+                         call([os.path.join(temp_directory, "watch_dir/plate_3")], None)]
         # assert correct calls regardless of order
         self.assertCountEqual(correct_calls, bcl_manager.remove_plate.mock_calls)
         # reset call attributes of bcl_manager.remove_plate mock
@@ -309,9 +668,9 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
         # assert bcl_manager.shutil.rmtree() is called only once with
         # 'fastq_dir/plate_1' filepath, i.e. skips filepaths that do not match
         # plate format
-        correct_calls = [call([os.path.join(temp_directory, "watch_dir/plate_1")]),
+        correct_calls = [call([os.path.join(temp_directory, "watch_dir/plate_1")], None),
                          call([os.path.join(temp_directory, "fastq_dir/plate_1"),
-                               os.path.join(temp_directory, "backup_dir/plate_1")])]
+                               os.path.join(temp_directory, "backup_dir/plate_1")], None)]
         # assert correct calls regardless of order
         self.assertCountEqual(correct_calls, bcl_manager.remove_plate.mock_calls)
         # assert NotADirectoryError is raised (plate_3)
@@ -337,5 +696,1627 @@ class TestBclManager(fake_filesystem_unittest.TestCase):
         assert not bcl_manager.remove_plate.called
 
 
+class TestPlateScheduler(unittest.TestCase):
+    def test_stages_run_in_order(self):
+        """
+            Every plate runs each stage in order and completes
+        """
+        calls = []
+        lock = threading.Lock()
+
+        def stage(name):
+            def run(job):
+                with lock:
+                    calls.append((name, job))
+            return run
+
+        completed = []
+        scheduler = PlateScheduler([("copy", stage("copy")),
+                                    ("convert", stage("convert")),
+                                    ("upload", stage("upload"))],
+                                   workers={"convert": 2},
+                                   on_complete=completed.append)
+        scheduler.submit("plate_1", "job_1")
+        scheduler.submit("plate_2", "job_2")
+        self.assertTrue(scheduler.wait(timeout=5))
+        scheduler.shutdown()
+
+        self.assertCountEqual(completed, ["job_1", "job_2"])
+        for job in ["job_1", "job_2"]:
+            self.assertEqual([name for name, j in calls if j == job],
+                             ["copy", "convert", "upload"])
+
+    def test_stages_overlap(self):
+        """
+            A plate can convert while another is uploading
+        """
+        uploading = threading.Event()
+        overlapped = threading.Event()
+
+        def convert(job):
+            if job == "plate_2" and uploading.is_set():
+                overlapped.set()
+
+        def upload(job):
+            if job == "plate_1":
+                uploading.set()
+                overlapped.wait(timeout=5)
+
+        scheduler = PlateScheduler([("convert", convert),
+                                    ("upload", upload)])
+        scheduler.submit("plate_1", "plate_1")
+        uploading.wait(timeout=5)
+        scheduler.submit("plate_2", "plate_2")
+        self.assertTrue(scheduler.wait(timeout=5))
+        scheduler.shutdown()
+        self.assertTrue(overlapped.is_set())
+
+    def test_failure_and_duplicates(self):
+        """
+            Failed plates are reported and dropped, and a plate that is
+            already in flight is not queued twice
+        """
+        release = threading.Event()
+
+        def copy(job):
+            release.wait(timeout=5)
+            if job == "bad":
+                raise Exception("copy failed")
+
+        convert = Mock()
+        errors = []
+        scheduler = PlateScheduler([("copy", copy), ("convert", convert)],
+                                   on_error=lambda *args: errors.append(args))
+        self.assertTrue(scheduler.submit("bad", "bad"))
+        self.assertFalse(scheduler.submit("bad", "bad"))
+        self.assertEqual(scheduler.status()["copy"]["running"] +
+                         scheduler.status()["copy"]["queued"], ["bad"])
+        release.set()
+        self.assertTrue(scheduler.wait(timeout=5))
+        scheduler.shutdown()
+
+        convert.assert_not_called()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][:2], ("bad", "copy"))
+
+    def test_duplicate_while_waiting_for_slot(self):
+        """
+            A plate waiting for a free slot is not queued again by a
+            second submission of the same name
+        """
+        release = threading.Event()
+        calls = []
+
+        def copy(job):
+            calls.append(job)
+            if job == "plate_1":
+                release.wait(timeout=5)
+
+        scheduler = PlateScheduler([("copy", copy)], max_plates=1)
+        scheduler.submit("plate_1", "plate_1")
+        results = []
+        threads = [threading.Thread(
+                       target=lambda: results.append(
+                           scheduler.submit("plate_2", "plate_2")))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        # One submission returns straight away, the other waits
+        for _ in range(500):
+            if results:
+                break
+            time.sleep(0.01)
+        self.assertEqual(results, [False])
+        self.assertEqual(scheduler.status()["copy"]["waiting"], ["plate_2"])
+
+        release.set()
+        for thread in threads:
+            thread.join(timeout=5)
+        self.assertTrue(scheduler.wait(timeout=5))
+        scheduler.shutdown()
+        self.assertCountEqual(results, [False, True])
+        self.assertEqual(calls, ["plate_1", "plate_2"])
+
+    def test_deferred_admission(self):
+        """
+            Plates that admit() rejects wait, in order, until it accepts
+            them
+        """
+        space = {"free": False}
+        completed = []
+        scheduler = PlateScheduler([("copy", Mock())],
+                                   on_complete=completed.append,
+                                   admit=lambda job: space["free"])
+        scheduler.submit("plate_1", "plate_1")
+        scheduler.submit("plate_2", "plate_2")
+        self.assertEqual(scheduler.status()["copy"]["deferred"],
+                         ["plate_1", "plate_2"])
+        self.assertTrue(scheduler.wait(timeout=5))
+        self.assertEqual(completed, [])
+
+        space["free"] = True
+        scheduler.retry_deferred()
+        self.assertTrue(scheduler.wait(timeout=5))
+        scheduler.shutdown()
+        self.assertEqual(completed, ["plate_1", "plate_2"])
+
+
+@mock_aws
+class TestS3Transfer(unittest.TestCase):
+    """
+        Tests S3 transfers against moto's in-memory S3
+    """
+    def setUp(self):
+        patcher = patch.dict(os.environ, {"AWS_ACCESS_KEY_ID": "testing",
+                                          "AWS_SECRET_ACCESS_KEY": "testing",
+                                          "AWS_DEFAULT_REGION": "eu-west-1"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        utils.clear_s3_clients()
+        self.s3 = boto3.client("s3")
+        self.s3.create_bucket(Bucket="bucket", CreateBucketConfiguration={
+            "LocationConstraint": "eu-west-1"})
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.temp_dir.name, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def test_s3_upload_files(self):
+        """
+            Uploads small and multipart files and reports each file
+        """
+        small = self.make_file("small.fastq.gz", 1024)
+        large = self.make_file("large.fastq.gz", 12 * 1024**2)
+        files = [(small, "FZ2000/run/small.fastq.gz"),
+                 (large, "FZ2000/run/large.fastq.gz")]
+
+        results = utils.s3_upload_files(files, "bucket", None, threads=4,
+                                        part_size=5 * 1024**2,
+                                        multipart_threshold=5 * 1024**2)
+
+        self.assertEqual([(r["key"], r["bytes"]) for r in results],
+                         [("FZ2000/run/small.fastq.gz", 1024),
+                          ("FZ2000/run/large.fastq.gz", 12 * 1024**2)])
+        self.assertTrue(all(r["seconds"] >= 0 for r in results))
+        self.assertEqual(utils.s3_list_keys("bucket", "FZ2000/", None),
+                         {"FZ2000/run/small.fastq.gz": 1024,
+                          "FZ2000/run/large.fastq.gz": 12 * 1024**2})
+        # Multipart uploads have a "-{parts}" suffix on their ETag
+        etag = self.s3.head_object(Bucket="bucket",
+                                   Key="FZ2000/run/large.fastq.gz")["ETag"]
+        self.assertTrue(etag.endswith('-3"'))
+
+    def test_s3_upload_files_throttle(self):
+        """
+            Uploads wait on the throttle
+        """
+        files = [(self.make_file(f"{i}.fastq.gz", 400000),
+                  f"FZ2000/run/{i}.fastq.gz") for i in range(3)]
+        bucket = TokenBucket(rate=1000000)
+        utils.s3_upload_files(files, "bucket", None, throttle=bucket)
+        self.assertGreater(bucket.waited, 0.1)
+        self.assertEqual(len(utils.s3_list_keys("bucket", "FZ2000/", None)),
+                         3)
+
+    def test_s3_upload_files_does_not_overwrite(self):
+        """
+            Nothing is uploaded if any target key already exists
+        """
+        self.s3.put_object(Bucket="bucket", Key="FZ2000/run/a.fastq.gz",
+                           Body=b"existing")
+        files = [(self.make_file("a.fastq.gz", 10), "FZ2000/run/a.fastq.gz"),
+                 (self.make_file("b.fastq.gz", 10), "FZ2000/run/b.fastq.gz")]
+
+        with self.assertRaises(Exception):
+            utils.s3_upload_files(files, "bucket", None)
+
+        self.assertEqual(list(utils.s3_list_keys("bucket", "FZ2000/", None)),
+                         ["FZ2000/run/a.fastq.gz"])
+
+    def test_s3_etag(self):
+        """
+            Local ETags match S3's for single and multipart uploads
+        """
+        small = self.make_file("small.fastq.gz", 1024)
+        large = self.make_file("large.fastq.gz", 6 * 1024**2)
+        utils.s3_upload_files([(small, "small"), (large, "large")], "bucket",
+                              None, part_size=5 * 1024**2,
+                              multipart_threshold=5 * 1024**2)
+        remote = utils.s3_list_objects("bucket", "", None)
+        self.assertEqual(utils.s3_etag(small, 5 * 1024**2, 5 * 1024**2),
+                         remote["small"]["etag"])
+        self.assertEqual(utils.s3_etag(large, 5 * 1024**2, 5 * 1024**2),
+                         remote["large"]["etag"])
+        self.assertTrue(remote["large"]["etag"].endswith("-2"))
+
+    def test_upload_manifest(self):
+        """
+            A retry only uploads missing or changed files, and a prefix
+            holding another run's files is never written to
+        """
+        manifest = upload_manifest.UploadManifest(
+            os.path.join(self.temp_dir.name, "manifest.json"))
+        files = [(self.make_file(f"{name}.fastq.gz", 10),
+                  f"FZ2000/run/{name}.fastq.gz") for name in "abc"]
+        # Uploaded by an earlier attempt that failed before saving the
+        # manifest
+        self.s3.upload_file(files[0][0], "bucket", files[0][1])
+
+        with patch("utils.s3_upload_files",
+                   side_effect=utils.s3_upload_files) as upload_mock:
+            upload_manifest.upload_files(files, "bucket", None, manifest)
+            self.assertEqual(upload_mock.call_args.args[0], files[1:])
+
+            # Nothing left to upload
+            upload_manifest.upload_files(files, "bucket", None, manifest)
+            upload_mock.assert_called_once()
+
+            # A file rewritten locally is uploaded again
+            with open(files[2][0], "wb") as f:
+                f.write(b"c" * 20)
+            upload_manifest.upload_files(files, "bucket", None, manifest)
+            self.assertEqual(upload_mock.call_args.args[0], files[2:])
+        self.assertEqual(utils.s3_list_keys("bucket", "FZ2000/", None),
+                         {"FZ2000/run/a.fastq.gz": 10,
+                          "FZ2000/run/b.fastq.gz": 10,
+                          "FZ2000/run/c.fastq.gz": 20})
+
+        # Another run uploaded to the same run id
+        other_manifest = upload_manifest.UploadManifest(
+            os.path.join(self.temp_dir.name, "other.json"))
+        other = [(self.make_file("d.fastq.gz", 10), "FZ2000/run/a.fastq.gz")]
+        with self.assertRaises(Exception):
+            upload_manifest.upload_files(other, "bucket", None,
+                                         other_manifest)
+        other = [(files[0][0], "FZ2000/run/a.fastq.gz")]
+        with self.assertRaises(Exception):
+            upload_manifest.upload_files(other, "bucket", None,
+                                         other_manifest)
+
+    def test_upload_fastq_qc(self):
+        """
+            Read counts and qualities are added to meta.json, with the
+            per-sample statistics uploaded next to it
+        """
+        fastq_path = os.path.join(self.temp_dir.name,
+                                  "220401_NB501786_0396_AHKGT5AFX3", "")
+        os.makedirs(os.path.join(fastq_path, "FZ2000"))
+        for read in ["R1", "R2"]:
+            with gzip.open(os.path.join(fastq_path, "FZ2000",
+                                        f"s1_S1_{read}_001.fastq.gz"),
+                           "wb") as f:
+                f.write(b"@r1\nACGT\n+\nFF##\n@r2\nAC\n+\nFF\n")
+
+        handler = bcl_manager.BclEventHandler(
+            self.temp_dir.name, self.temp_dir.name, self.temp_dir.name,
+            "bucket", "key", None, "", "", fastq_qc=True)
+        event = Mock(fastq_path=fastq_path, streamer=None)
+        with patch("bcl_manager.submit_batch_job"):
+            handler.upload(event)
+
+        def read_json(key):
+            return json.loads(self.s3.get_object(
+                Bucket="bucket", Key=key)["Body"].read())
+
+        meta = read_json("key/FZ2000/NB501786_0396/meta.json")
+        self.assertEqual(meta["qc"], {"reads": 2, "bases": 12, "samples": 1,
+                                      "mean_quality": 25.33,
+                                      "q30_fraction": 0.6667})
+        stats = read_json("key/FZ2000/NB501786_0396/fastq-stats.json")
+        self.assertEqual(stats["samples"]["s1"]["reads"], 2)
+        self.assertEqual(stats["files"]["s1_S1_R2_001.fastq.gz"]["bases"], 6)
+
+        # The run is catalogued with its QC
+        handler.catalogue(event)
+        [line] = self.s3.get_object(
+            Bucket="bucket", Key="key/_catalogue/FZ2000/2022-04.jsonl")[
+                "Body"].read().splitlines()
+        self.assertEqual(json.loads(line)["qc"]["reads"], 2)
+
+    def test_catalogue(self):
+        """
+            Runs are added to partitions by project and month, uploading
+            a run again replaces its entry, and a rebuild from the
+            meta.json files gives the same catalogue
+        """
+        def meta(project_code, run_number, sequence_date):
+            return {"project_code": project_code,
+                    "run_id": f"NB501786_{run_number}",
+                    "sequence_date": sequence_date}
+
+        def read(key):
+            return self.s3.get_object(Bucket="bucket",
+                                      Key=key)["Body"].read().decode()
+
+        runs = [meta("FZ2000", "0396", "2022-04-01"),
+                meta("TB0001", "0396", "2022-04-01"),
+                meta("FZ2000", "0397", "2022-04-02"),
+                meta("FZ2000", "0398", "2022-05-01")]
+        catalogue.add_runs("bucket", runs[:2], None, "fastq")
+        catalogue.add_runs("bucket", runs[2:], None, "fastq")
+        catalogue.add_runs("bucket", [dict(runs[0], qc={"reads": 1})], None,
+                           "fastq")
+
+        lines = [json.loads(line) for line in
+                 read("fastq/_catalogue/FZ2000/2022-04.jsonl").splitlines()]
+        self.assertEqual([line["run_id"] for line in lines],
+                         ["NB501786_0396", "NB501786_0397"])
+        self.assertEqual(lines[0]["qc"], {"reads": 1})
+        manifest = json.loads(read("fastq/_catalogue/manifest.json"))
+        self.assertEqual(manifest["partitions"],
+                         {"FZ2000/2022-04": {"runs": 2},
+                          "FZ2000/2022-05": {"runs": 1},
+                          "TB0001/2022-04": {"runs": 1}})
+
+        # Rebuild from the meta.json files, of which one run is gone
+        for run in runs[:3]:
+            utils.upload_json("bucket", f"fastq/{run['project_code']}/"
+                              f"{run['run_id']}/meta.json", None, run)
+        self.assertEqual(catalogue.rebuild("bucket", None, "fastq"), 3)
+        manifest = json.loads(read("fastq/_catalogue/manifest.json"))
+        self.assertEqual(manifest["partitions"],
+                         {"FZ2000/2022-04": {"runs": 2},
+                          "TB0001/2022-04": {"runs": 1}})
+        self.assertFalse(utils.s3_object_exists(
+            "bucket", "fastq/_catalogue/FZ2000/2022-05.jsonl", None))
+
+    def test_catalogue_concurrent_update(self):
+        """
+            An update that loses a race is read and applied again
+        """
+        s3 = utils.s3_client(None)
+        calls = []
+
+        def update(body):
+            calls.append(body)
+            if len(calls) == 1:
+                # Another writer gets there first
+                s3.put_object(Bucket="bucket", Key="catalogue",
+                              Body=b"other\n")
+            return (body or b"") + b"mine\n"
+
+        catalogue.update_object(s3, "bucket", "catalogue", update)
+        self.assertEqual(calls, [None, b"other\n"])
+        self.assertEqual(s3.get_object(Bucket="bucket", Key="catalogue")
+                         ["Body"].read(), b"other\nmine\n")
+
+    def test_s3_client_reuse(self):
+        """
+            S3 clients are built once per profile and endpoint, without
+            changing the default boto3 session
+        """
+        with tempfile.NamedTemporaryFile("w", suffix=".cfg") as config:
+            config.write("[profile batch]\n"
+                         "aws_access_key_id = testing\n"
+                         "aws_secret_access_key = testing\n")
+            config.flush()
+            with patch.dict(os.environ, {"AWS_CONFIG_FILE": config.name}):
+                default_session = boto3.DEFAULT_SESSION
+                for i in range(3):
+                    utils.upload_json("bucket", f"{i}.json", None, {"i": i})
+                    utils.upload_json("bucket", f"batch/{i}.json", None,
+                                      {"i": i}, profile="batch")
+                    self.assertTrue(utils.s3_object_exists(
+                        "bucket", f"{i}.json", None))
+                self.assertIs(boto3.DEFAULT_SESSION, default_session)
+
+        self.assertEqual(utils.client_construction_counts,
+                         {(None, None): 1, ("batch", None): 1})
+        self.assertFalse(utils.s3_object_exists("bucket", "missing", None))
+
+    def test_fastq_streamer(self):
+        """
+            Settled files are uploaded during conversion and reconcile
+            uploads files that were missed or have changed since
+        """
+        fastq_path = os.path.join(self.temp_dir.name, "run", "")
+        os.makedirs(os.path.join(fastq_path, "FZ2000"))
+        first = os.path.join(fastq_path, "FZ2000", "a.fastq.gz")
+        with open(first, "wb") as f:
+            f.write(b"a" * 10)
+
+        streamer = FastqStreamer(fastq_path, "bucket", None,
+                                 lambda path: f"FZ2000/run/{basename(path)}",
+                                 settle_seconds=0, poll_interval=0.01)
+        streamer.start()
+        for _ in range(500):
+            if first in streamer.uploaded:
+                break
+            time.sleep(0.01)
+        streamer.stop()
+        self.assertIn(first, streamer.uploaded)
+
+        # Rewritten after upload, and written after streaming stopped
+        with open(first, "ab") as f:
+            f.write(b"a" * 10)
+        os.utime(first, (0, 0))
+        second = os.path.join(fastq_path, "FZ2000", "b.fastq.gz")
+        with open(second, "wb") as f:
+            f.write(b"b" * 5)
+
+        self.assertEqual(streamer.reconcile(),
+                         {first: "FZ2000/run/a.fastq.gz",
+                          second: "FZ2000/run/b.fastq.gz"})
+        self.assertEqual(utils.s3_list_keys("bucket", "FZ2000/", None),
+                         {"FZ2000/run/a.fastq.gz": 20,
+                          "FZ2000/run/b.fastq.gz": 5})
+
+    def test_fastq_streamer_does_not_overwrite(self):
+        """
+            Streaming refuses to upload under another run's prefix
+        """
+        self.s3.put_object(Bucket="bucket", Key="FZ2000/run/b.fastq.gz",
+                           Body=b"b")
+        fastq_path = os.path.join(self.temp_dir.name, "run", "")
+        os.makedirs(os.path.join(fastq_path, "FZ2000"))
+        with open(os.path.join(fastq_path, "FZ2000", "a.fastq.gz"),
+                  "wb") as f:
+            f.write(b"a")
+
+        streamer = FastqStreamer(fastq_path, "bucket", None,
+                                 lambda path: f"FZ2000/run/{basename(path)}")
+        with self.assertRaises(Exception):
+            streamer.reconcile()
+
+    def test_fastq_streamer_retry(self):
+        """
+            A plate whose conversion fails after files were streamed is
+            converted and uploaded again on retry, replacing its own
+            objects
+        """
+        name = "220401_NB501786_0396_AHKGT5AFX3"
+        fastq_dir = os.path.join(self.temp_dir.name, "fastq")
+        os.makedirs(fastq_dir)
+        handler = bcl_manager.BclEventHandler(
+            self.temp_dir.name, self.temp_dir.name, fastq_dir, "bucket",
+            "key", None, "", "", stream_upload=True, settle_seconds=0,
+            submit_jobs=False,
+            plate_index_path=os.path.join(self.temp_dir.name, "index.db"))
+        self.addCleanup(handler.plate_index.close)
+        event = Mock(src_name=name,
+                     fastq_path=os.path.join(fastq_dir, name, ""))
+        attempts = []
+
+        def run_conversion(event):
+            attempts.append(event)
+            os.makedirs(os.path.join(event.fastq_path, "FZ2000"))
+            with open(os.path.join(event.fastq_path, "FZ2000",
+                                   "a.fastq.gz"), "wb") as f:
+                f.write(b"a" * len(attempts))
+            if len(attempts) == 1:
+                # Streamed, then bcl-convert fails
+                event.streamer.reconcile()
+                raise Exception("bcl-convert failed")
+
+        with patch.object(handler, "run_conversion", run_conversion):
+            with self.assertRaises(Exception):
+                handler.convert(event)
+            self.assertEqual(
+                utils.s3_list_keys("bucket", "key/FZ2000/", None),
+                {"key/FZ2000/NB501786_0396/a.fastq.gz": 1})
+            handler.convert(event)
+        handler.upload(event)
+
+        self.assertEqual(len(attempts), 2)
+        uploaded = utils.s3_list_keys("bucket", "key/FZ2000/", None)
+        self.assertEqual(uploaded["key/FZ2000/NB501786_0396/a.fastq.gz"], 2)
+        self.assertIn("key/FZ2000/NB501786_0396/meta.json", uploaded)
+
+    def test_fastq_streamer_backup_retry(self):
+        """
+            A plate whose backup fails after its fastq was streamed keeps
+            its upload manifest, so the retry may replace its objects
+        """
+        name = "220401_NB501786_0396_AHKGT5AFX3"
+        fastq_dir = os.path.join(self.temp_dir.name, "fastq")
+        os.makedirs(fastq_dir)
+        handler = bcl_manager.BclEventHandler(
+            self.temp_dir.name, self.temp_dir.name, fastq_dir, "bucket",
+            "key", None, "", "", stream_upload=True, settle_seconds=0,
+            submit_jobs=False, overlap_backup=True,
+            plate_index_path=os.path.join(self.temp_dir.name, "index.db"))
+        self.addCleanup(handler.plate_index.close)
+        event = Mock(src_name=name,
+                     fastq_path=os.path.join(fastq_dir, name, ""))
+        attempts = []
+
+        def run_conversion(event):
+            attempts.append(event)
+            os.makedirs(os.path.join(event.fastq_path, "FZ2000"))
+            with open(os.path.join(event.fastq_path, "FZ2000",
+                                   "a.fastq.gz"), "wb") as f:
+                f.write(b"a" * len(attempts))
+            event.streamer.reconcile()
+
+        backup = Mock(side_effect=[Exception("backup failed"), None])
+        with patch.object(handler, "run_conversion", run_conversion), \
+                patch.object(handler, "backup", backup):
+            with self.assertRaisesRegex(Exception, "backup failed"):
+                handler.backup_and_convert(event)
+            self.assertEqual(os.listdir(event.fastq_path),
+                             [upload_manifest.MANIFEST])
+            handler.backup_and_convert(event)
+        handler.upload(event)
+
+        self.assertEqual(len(attempts), 2)
+        uploaded = utils.s3_list_keys("bucket", "key/FZ2000/", None)
+        self.assertEqual(uploaded["key/FZ2000/NB501786_0396/a.fastq.gz"], 2)
+
+
+class TestS3LoggingHandler(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.filename = os.path.join(self.temp_dir.name, "test.log")
+
+        with patch("s3_logging_handler.utils.s3_client") as s3_client:
+            self.handler = S3LoggingHandler(self.filename, "bucket",
+                                            "logs/test.log",
+                                            flush_interval=60,
+                                            flush_records=3)
+        self.s3 = s3_client.return_value
+        self.addCleanup(self.handler.close)
+
+        self.logger = logging.getLogger(f"test-{id(self)}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def wait_for_uploads(self, count):
+        for _ in range(500):
+            if self.s3.upload_file.call_count >= count:
+                return
+            time.sleep(0.01)
+
+    def test_batches_uploads(self):
+        """
+            Records are written to file straight away but only uploaded
+            once enough have built up
+        """
+        self.logger.info("one")
+        self.logger.info("two")
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), "one\ntwo\n")
+        self.s3.upload_file.assert_not_called()
+
+        self.logger.info("three")
+        self.wait_for_uploads(1)
+        self.s3.upload_file.assert_called_once_with(self.filename, "bucket",
+                                                    "logs/test.log")
+
+    def test_errors_and_close_force_upload(self):
+        """
+            Errors are uploaded straight away by the background thread,
+            without blocking the logging thread, and closing uploads the
+            remainder
+        """
+        release = threading.Event()
+        self.s3.upload_file.side_effect = lambda *args: release.wait(5)
+        start = time.time()
+        self.logger.error("failed")
+        self.wait_for_uploads(1)
+        # The upload is stuck, but logging carries on
+        self.logger.error("failed again")
+        self.assertLess(time.time() - start, 2)
+        self.assertFalse(release.is_set())
+        release.set()
+
+        self.logger.info("remainder")
+        self.handler.close()
+        self.assertEqual(self.s3.upload_file.call_args,
+                         call(self.filename, "bucket", "logs/test.log"))
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), "failed\nfailed again\nremainder\n")
+
+    def test_rotation(self):
+        """
+            Full or out of date segments are gzipped and uploaded once
+            to a dated key, and only the active segment is re-uploaded
+        """
+        self.handler.max_bytes = 10
+        self.handler.flush_records = 1000
+        segment_start = self.handler.segment_start
+
+        self.logger.info("0123456789")
+        self.logger.info("next")
+        self.wait_for_uploads(2)
+        segment_key = (f"logs/{segment_start.date()}/test.log."
+                       f"{segment_start.strftime('%Y%m%d-%H%M%S')}.gz")
+        self.assertEqual(self.s3.upload_file.call_args_list,
+                         [call(unittest.mock.ANY, "bucket", segment_key),
+                          call(self.filename, "bucket", "logs/test.log")])
+        self.assertEqual(os.listdir(self.temp_dir.name), ["test.log"])
+
+        # A record from another day starts a new segment
+        self.handler.max_bytes = 0
+        record = logging.makeLogRecord({"msg": "tomorrow",
+                                        "levelno": logging.INFO,
+                                        "levelname": "INFO"})
+        record.created += 24 * 60 * 60
+        self.logger.handle(record)
+        self.wait_for_uploads(4)
+        self.assertEqual(len(self.s3.upload_file.call_args_list), 4)
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), "tomorrow\n")
+
+    def test_ships_leftover_segments(self):
+        """
+            Segments left behind by a previous run are uploaded
+        """
+        self.handler.close()
+        segment = f"{self.filename}.20260102-030405"
+        with gzip.open(segment + ".gz", "wt") as f:
+            f.write("old\n")
+
+        with patch("s3_logging_handler.utils.s3_client") as s3_client:
+            handler = S3LoggingHandler(self.filename, "bucket",
+                                       "logs/test.log")
+            handler.close()
+        s3_client.return_value.upload_file.assert_any_call(
+            segment + ".gz", "bucket",
+            "logs/2026-01-02/test.log.20260102-030405.gz")
+        self.assertFalse(os.path.exists(segment + ".gz"))
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.src = os.path.join(self.temp_dir.name, "run")
+        files = {"RunInfo.xml": b"<RunInfo/>",
+                 "Data/Intensities/BaseCalls/L001/C1.1/L001_1.cbcl":
+                     os.urandom(3000),
+                 "Data/Intensities/BaseCalls/L001/s_1_1101.filter":
+                     os.urandom(100),
+                 "CopyComplete.txt": b""}
+        for path, data in files.items():
+            path = os.path.join(self.src, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        self.files = files
+
+    def assertCopied(self, dest, places=9):
+        """
+            Asserts every file is in dest with the same contents and
+            modification time (to 'places' decimal places of a second)
+        """
+        for path, data in self.files.items():
+            with open(os.path.join(dest, path), "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertAlmostEqual(
+                os.stat(os.path.join(dest, path)).st_mtime_ns / 1e9,
+                os.stat(os.path.join(self.src, path)).st_mtime_ns / 1e9,
+                places=places)
+
+    def test_copy_tree(self):
+        """
+            Copies every file, and refuses to copy into an existing path
+            unless resuming
+        """
+        dest = os.path.join(self.temp_dir.name, "backup")
+        stats = backup.copy_tree(self.src, dest, threads=4)
+        self.assertCopied(dest)
+        self.assertEqual((stats["files"], stats["copied"], stats["bytes"]),
+                         (4, 4, 3110))
+
+        with self.assertRaises(Exception):
+            backup.copy_tree(self.src, dest)
+
+        # Resuming only copies files that differ
+        partial = os.path.join(dest, "RunInfo.xml")
+        with open(partial, "wb") as f:
+            f.write(b"<Run")
+        stats = backup.copy_tree(self.src, dest, resume=True)
+        self.assertCopied(dest)
+        self.assertEqual((stats["copied"], stats["skipped"]), (1, 3))
+
+    def test_copy_file_fallback(self):
+        """
+            Falls back to a read/write copy if kernel copies fail
+        """
+        def unsupported(*args):
+            raise OSError(errno.ENOSYS, "not supported")
+
+        src = os.path.join(self.src, "RunInfo.xml")
+        dest = os.path.join(self.temp_dir.name, "RunInfo.xml")
+        with patch("backup.KERNEL_COPIES", [unsupported]):
+            self.assertEqual(backup.copy_file(src, dest), 10)
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), b"<RunInfo/>")
+
+    def test_archive_tree(self):
+        """
+            Archives a run into shards with an index that single files
+            can be extracted with
+        """
+        dest = os.path.join(self.temp_dir.name, "backup")
+        stats = backup.archive_tree(self.src, dest, shard_size=1000)
+        self.assertEqual((stats["files"], stats["bytes"]), (4, 3110))
+        self.assertTrue(backup.is_archive(dest))
+        self.assertFalse(backup.is_archive(self.src))
+
+        # Shards are split at shard_size
+        shards = backup.read_index(dest)["shards"]
+        self.assertGreater(len(shards), 1)
+        self.assertCountEqual(os.listdir(dest), ["index.json"] + shards)
+
+        for path, data in self.files.items():
+            extracted = os.path.join(self.temp_dir.name, "extracted")
+            backup.extract_file(dest, path, extracted)
+            with open(extracted, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+        restored = os.path.join(self.temp_dir.name, "restored")
+        backup.restore_archive(dest, restored)
+        self.assertCopied(restored, places=5)
+
+        with self.assertRaises(Exception):
+            backup.archive_tree(self.src, dest)
+
+    def test_copy_archive(self):
+        """
+            bcl_manager.copy can back up as an archive, which
+            remove_plate deletes like any other backup
+        """
+        dest = os.path.join(self.temp_dir.name, "backup", "run", "")
+        bcl_manager.copy(self.src, dest, archive=True)
+        self.assertTrue(backup.is_archive(dest))
+
+        bcl_manager.remove_plate([dest])
+        self.assertFalse(os.path.exists(dest))
+
+    def test_copy_resumes_partial_backup(self):
+        """
+            bcl_manager.copy resumes an interrupted backup but never
+            overwrites a completed one
+        """
+        dest = os.path.join(self.temp_dir.name, "backup", "run", "")
+        with patch("backup.copy_file", side_effect=Exception("interrupted")):
+            with self.assertRaises(Exception):
+                bcl_manager.copy(self.src, dest)
+        self.assertFalse(os.path.exists(dest))
+        self.assertTrue(os.path.isdir(dest[:-1] + ".partial"))
+
+        bcl_manager.copy(self.src, dest)
+        self.assertCopied(dest)
+        self.assertFalse(os.path.exists(dest[:-1] + ".partial"))
+
+        with self.assertRaises(Exception):
+            bcl_manager.copy(self.src, dest)
+
+
+class TestPlateIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.dirs = {name: os.path.join(self.temp_dir.name, name)
+                     for name in ["fastq_dir", "watch_dir", "backup_dir"]}
+        for plate in ["plate_1", "plate_2"]:
+            os.makedirs(os.path.join(self.dirs["fastq_dir"], plate, "Logs"))
+            os.makedirs(os.path.join(self.dirs["fastq_dir"], plate,
+                                     "Reports"))
+            os.makedirs(os.path.join(self.dirs["watch_dir"], plate))
+            os.makedirs(os.path.join(self.dirs["backup_dir"], plate))
+            with open(os.path.join(self.dirs["backup_dir"], plate, "a.cbcl"),
+                      "wb") as f:
+                f.write(b"0" * 100)
+        # Not processed
+        os.makedirs(os.path.join(self.dirs["fastq_dir"], "plate_3"))
+        pathlib.Path(self.dirs["fastq_dir"], "plate_4").touch()
+
+        self.index = PlateIndex(os.path.join(self.temp_dir.name, "index.db"))
+        self.addCleanup(self.index.close)
+
+    def path(self, directory, plate):
+        return os.path.join(self.dirs[directory], plate)
+
+    def test_rebuild(self):
+        """
+            Rebuilding indexes every processed plate in fastq_dir
+        """
+        self.assertTrue(self.index.is_empty())
+        self.index.rebuild(self.dirs["fastq_dir"], self.dirs["watch_dir"],
+                           self.dirs["backup_dir"])
+
+        self.assertEqual([row["name"] for row in self.index.bcl_pending()],
+                         ["plate_1", "plate_2"])
+        plate = self.index.get("plate_1")
+        self.assertEqual(plate["backup_bytes"], 100)
+        self.assertEqual(plate["bcl_path"], self.path("watch_dir", "plate_1"))
+        self.assertIsNone(self.index.get("plate_3"))
+
+    def test_clean_up_index(self):
+        """
+            Removes processed bcl data straight away, and all data of
+            plates older than 21 days
+        """
+        now = time.time()
+        self.index.record_processed("plate_1",
+                                    self.path("fastq_dir", "plate_1"),
+                                    self.path("backup_dir", "plate_1"),
+                                    self.path("watch_dir", "plate_1"),
+                                    now - 22 * 24 * 60 * 60)
+        self.index.record_processed("plate_2",
+                                    self.path("fastq_dir", "plate_2"),
+                                    self.path("backup_dir", "plate_2"),
+                                    self.path("watch_dir", "plate_2"),
+                                    now - 21 * 24 * 60 * 60)
+
+        with patch("bcl_manager.remove_plate",
+                   wraps=bcl_manager.remove_plate) as remove_plate:
+            bcl_manager.clean_up_index(self.index)
+            bcl_manager.clean_up_index(self.index)
+
+        self.assertCountEqual(
+            remove_plate.mock_calls,
+            [call([self.path("watch_dir", "plate_1")], None),
+             call([self.path("watch_dir", "plate_2")], None),
+             call([self.path("fastq_dir", "plate_1"),
+                   self.path("backup_dir", "plate_1")], None)])
+        self.assertTrue(os.path.exists(self.path("fastq_dir", "plate_2")))
+        self.assertEqual(self.index.get("plate_1")["removed"], 1)
+        self.assertEqual(self.index.bcl_pending(), [])
+
+    def test_clean_up_background(self):
+        """
+            With background deletion, old plates are moved to the trash
+            during clean up and deleted afterwards, and a trash left by
+            a crash is emptied on start up
+        """
+        self.index.record_processed("plate_1",
+                                    self.path("fastq_dir", "plate_1"),
+                                    self.path("backup_dir", "plate_1"),
+                                    self.path("watch_dir", "plate_1"),
+                                    time.time() - 22 * 24 * 60 * 60)
+        leftover = os.path.join(self.dirs["backup_dir"], deletion.TRASH_DIR,
+                                "plate_0.1")
+        os.makedirs(os.path.join(leftover, "Data"))
+        pathlib.Path(leftover, "Data", "a.cbcl").touch()
+
+        handler = bcl_manager.BclEventHandler(
+            self.dirs["watch_dir"], self.dirs["backup_dir"],
+            self.dirs["fastq_dir"], "bucket", "key", None, "", "",
+            background_deletion=True, deletion_threads=2,
+            deletion_limit=1000)
+        handler.plate_index = self.index
+        self.addCleanup(handler.deleter.shutdown)
+        with patch("bcl_manager.shutil.rmtree") as rmtree:
+            handler.run_clean_up()
+        rmtree.assert_not_called()
+        for directory in ["fastq_dir", "backup_dir", "watch_dir"]:
+            self.assertFalse(os.path.exists(self.path(directory, "plate_1")))
+        self.assertEqual(self.index.get("plate_1")["removed"], 1)
+        self.assertTrue(os.path.exists(self.path("watch_dir", "plate_2")))
+
+        handler.deleter.wait()
+        for directory in ["fastq_dir", "backup_dir", "watch_dir"]:
+            self.assertEqual(os.listdir(os.path.join(self.dirs[directory],
+                                                     deletion.TRASH_DIR)), [])
+        # The trash is not a run (only plate_2, without CopyComplete.txt,
+        # is counted) or a processed plate
+        self.assertEqual(throttle.count_sequencing_runs(
+            self.dirs["watch_dir"]), 1)
+        self.index.rebuild(self.dirs["fastq_dir"], self.dirs["watch_dir"],
+                           self.dirs["backup_dir"])
+        self.assertIsNone(self.index.get(deletion.TRASH_DIR))
+
+    def test_stage_journal(self):
+        """
+            Completed stages are journalled until the plate is removed
+        """
+        self.index.mark_stage("plate_1", "backed_up")
+        self.index.mark_stage("plate_1", "converted")
+        self.assertTrue(self.index.stage_completed("plate_1", "backed_up"))
+        self.assertFalse(self.index.stage_completed("plate_2", "backed_up"))
+        self.assertTrue(self.index.stage_completed("plate_1", "converted"))
+
+        self.index.clear_stage("plate_1", "converted")
+        self.assertFalse(self.index.stage_completed("plate_1", "converted"))
+        self.assertTrue(self.index.stage_completed("plate_1", "backed_up"))
+        self.index.mark_removed("plate_1")
+        self.assertFalse(self.index.stage_completed("plate_1", "backed_up"))
+
+    def test_resume(self):
+        """
+            A plate that failed part way through resumes from its first
+            incomplete stage, without uploading projects twice
+        """
+        handler = bcl_manager.BclEventHandler(
+            self.dirs["watch_dir"], self.dirs["backup_dir"],
+            self.dirs["fastq_dir"], "bucket", "key", None, "", "",
+            plate_index_path=os.path.join(self.temp_dir.name, "index.db"))
+        self.addCleanup(handler.plate_index.close)
+
+        name = "220401_NB501786_0396_AHKGT5AFX3"
+        event = Mock(src_name=name,
+                     abs_src_path=self.path("watch_dir", name) + "/",
+                     fastq_path=self.path("fastq_dir", name) + "/",
+                     streamer=None)
+
+        def convert_to_fastq(src, fastq_path, **settings):
+            for project in ["FZ2000", "FZ2001"]:
+                os.makedirs(os.path.join(fastq_path, project))
+                pathlib.Path(fastq_path, project, "a.fastq.gz").touch()
+
+        def copy(src, dest, *args, **kwargs):
+            os.makedirs(dest)
+
+        def upload_json(bucket, key, *args, **kwargs):
+            if key.startswith("key/FZ2001"):
+                raise Exception("upload failed")
+
+        # Objects "in S3"
+        objects = {}
+
+        def s3_upload_files(files, *args, **kwargs):
+            for path, key in files:
+                objects[key] = {"size": os.path.getsize(path), "etag": key}
+            return []
+
+        def s3_list_objects(bucket, prefix, *args):
+            return {key: obj for key, obj in objects.items()
+                    if key.startswith(prefix)}
+
+        with patch("bcl_manager.copy", side_effect=copy) as copy_mock, \
+                patch("bcl_manager.convert_to_fastq",
+                      side_effect=convert_to_fastq) as convert_mock, \
+                patch("bcl_manager.utils.s3_list_objects",
+                      side_effect=s3_list_objects), \
+                patch("bcl_manager.utils.s3_upload_files",
+                      side_effect=s3_upload_files) as upload_mock, \
+                patch("bcl_manager.utils.upload_json",
+                      side_effect=upload_json):
+            # Fails uploading the second project
+            with self.assertRaisesRegex(Exception, "upload failed"):
+                handler.process_bcl_plate(event)
+            self.assertEqual(
+                [stage for stage in ["backed_up", "converted",
+                                     "uploaded:FZ2000", "submitted:FZ2000",
+                                     "uploaded:FZ2001", "submitted:FZ2001"]
+                 if handler.plate_index.stage_completed(name, stage)],
+                ["backed_up", "converted", "uploaded:FZ2000",
+                 "submitted:FZ2000"])
+
+            # The fastq files reached S3, so only the failed project's
+            # meta.json is uploaded again, and the Salmonella pipeline is
+            # not resubmitted
+            uploads = upload_mock.call_count
+            with patch("bcl_manager.utils.upload_json") as upload_json:
+                handler.process_bcl_plate(event)
+            copy_mock.assert_called_once()
+            convert_mock.assert_called_once()
+            [(_, _, settings)] = handler.plate_index.conversions(name)
+            self.assertEqual(settings["threads"], len(os.sched_getaffinity(0)))
+            self.assertEqual(upload_mock.call_count, uploads)
+            upload_json.assert_called_once()
+
+    def test_catalogue_failure(self):
+        """
+            A plate whose catalogue update fails is still delivered, and
+            is catalogued by a later attempt
+        """
+        handler = bcl_manager.BclEventHandler(
+            self.dirs["watch_dir"], self.dirs["backup_dir"],
+            self.dirs["fastq_dir"], "bucket", "key", None, "", "",
+            catalogue_runs=True,
+            plate_index_path=os.path.join(self.temp_dir.name, "index.db"))
+        self.addCleanup(handler.plate_index.close)
+        name = "220401_NB501786_0396_AHKGT5AFX3"
+        event = Mock(src_name=name,
+                     abs_src_path=self.path("watch_dir", name) + "/",
+                     fastq_path=self.path("fastq_dir", name) + "/",
+                     projects={"FZ2000": "key/FZ2000/NB501786_0396"})
+
+        with patch.object(handler, "upload"), \
+                patch("bcl_manager.catalogue.read_meta"), \
+                patch("bcl_manager.catalogue.add_runs",
+                      side_effect=[Exception("conflict"), None]) as add_runs:
+            handler.deliver(event)
+            self.assertIsNotNone(handler.plate_index.get(name))
+            self.assertFalse(handler.stage_done(event, "catalogued"))
+
+            handler.deliver(event)
+            self.assertTrue(handler.stage_done(event, "catalogued"))
+        self.assertEqual(add_runs.call_count, 2)
+
+    def test_catch_up(self):
+        """
+            Runs that finished copying but are not in the index are
+            queued oldest first
+        """
+        runs = ["220402_NB501786_0397_AHKGT5AFX3",
+                "220401_NB501786_0396_AHKGT5AFX3",
+                "220403_NB501786_0398_AHKGT5AFX3",
+                "220404_NB501786_0399_AHKGT5AFX3"]
+        for run in runs[:3]:
+            os.makedirs(self.path("watch_dir", run))
+            pathlib.Path(self.path("watch_dir", run),
+                         "CopyComplete.txt").touch()
+        # Still copying
+        os.makedirs(self.path("watch_dir", runs[3]))
+
+        handler = bcl_manager.BclEventHandler(
+            self.dirs["watch_dir"], self.dirs["backup_dir"],
+            self.dirs["fastq_dir"], "bucket", "key", None, "", "",
+            plate_index_path=os.path.join(self.temp_dir.name, "index.db"))
+        self.addCleanup(handler.plate_index.close)
+        handler.plate_index.record_processed(
+            runs[2], self.path("fastq_dir", runs[2]),
+            self.path("backup_dir", runs[2]), self.path("watch_dir", runs[2]))
+        handler.scheduler = Mock()
+        handler.start_submitter()
+
+        handler.start_catch_up().join(5)
+        handler.submissions.join()
+
+        self.assertEqual([args[0] for args, _ in
+                          handler.scheduler.submit.call_args_list],
+                         [runs[1], runs[0]])
+
+    def test_disk_admission(self):
+        """
+            Plates are deferred if their estimated backup and fastq
+            would breach the free space watermark
+        """
+        handler = bcl_manager.BclEventHandler(
+            self.dirs["watch_dir"], self.dirs["backup_dir"],
+            self.dirs["fastq_dir"], "bucket", "key", None, "", "",
+            min_free_bytes=1000, fastq_size_ratio=0.5)
+        handler.request_clean_up = Mock()
+        name = "220401_NB501786_0396_AHKGT5AFX3"
+        os.makedirs(self.path("watch_dir", name))
+        with open(self.path("watch_dir", name) + "/a.cbcl", "wb") as f:
+            f.write(b"0" * 400)
+        event = Mock(src_name=name,
+                     abs_src_path=self.path("watch_dir", name) + "/")
+        handler.measure_plate(event)
+        self.assertEqual(event.input_bytes, 400)
+
+        # The run directory is not scanned while admitting the plate
+        directory_size = patch("bcl_manager.directory_size",
+                               side_effect=AssertionError)
+        directory_size.start()
+        self.addCleanup(directory_size.stop)
+        self.assertEqual(handler.estimate_footprint(event),
+                         {handler.backup_dir: 400, handler.fastq_dir: 200})
+
+        # Every directory shares one filesystem, needing 600 bytes
+        with patch("bcl_manager.monitor_disk_usage",
+                   return_value=(0, 1599)):
+            self.assertFalse(handler.admit(event))
+        handler.request_clean_up.assert_called_once()
+
+        with patch("bcl_manager.monitor_disk_usage",
+                   return_value=(0, 1600)):
+            self.assertTrue(handler.admit(event))
+            # The space is reserved until the plate finishes
+            other = Mock(src_name="other", input_bytes=400)
+            self.assertFalse(handler.admit(other))
+            handler.release_reservation(event)
+            self.assertTrue(handler.admit(other))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.seconds = metrics.Histogram("stage_seconds", "Stage duration",
+                                         ["stage"], buckets=(1, 10),
+                                         registry=self.registry)
+        self.bytes = metrics.Counter("stage_bytes_total", "Stage bytes",
+                                     ["stage"], registry=self.registry)
+        self.free = metrics.Gauge("free_bytes", "Free space", ["path"],
+                                  registry=self.registry)
+
+    def test_expose(self):
+        """
+            Metrics are exposed in the Prometheus text format
+        """
+        self.seconds.observe(5, stage="copy")
+        self.seconds.observe(20, stage="copy")
+        self.bytes.inc(100, stage="copy")
+        self.free.set_function(lambda: {('/data "raw"',): 42})
+
+        text = self.registry.expose()
+        for line in ['# TYPE stage_seconds histogram',
+                     'stage_seconds_bucket{stage="copy",le="1.0"} 0.0',
+                     'stage_seconds_bucket{stage="copy",le="10.0"} 1.0',
+                     'stage_seconds_bucket{stage="copy",le="+Inf"} 2.0',
+                     'stage_seconds_sum{stage="copy"} 25.0',
+                     'stage_seconds_count{stage="copy"} 2.0',
+                     '# TYPE stage_bytes_total counter',
+                     'stage_bytes_total{stage="copy"} 100.0',
+                     'free_bytes{path="/data \\"raw\\""} 42.0']:
+            self.assertIn(line, text.splitlines())
+
+        with self.assertRaises(Exception):
+            self.bytes.inc(stage="copy", plate="plate_1")
+
+    def test_track(self):
+        """
+            Durations are observed for successful stages and failures are
+            counted by stage
+        """
+        count = metrics.STAGE_SECONDS.count(stage="cleanup")
+        failures = metrics.STAGE_FAILURES.get(stage="cleanup")
+        with metrics.track("cleanup"):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.track("cleanup"):
+                raise ValueError()
+        self.assertEqual(metrics.STAGE_SECONDS.count(stage="cleanup"),
+                         count + 1)
+        self.assertEqual(metrics.STAGE_FAILURES.get(stage="cleanup"),
+                         failures + 1)
+
+    def test_exporters(self):
+        """
+            Metrics are served over HTTP on localhost and written to a
+            textfile
+        """
+        self.bytes.inc(7, stage="upload")
+        server = metrics.start_http_server(0, registry=self.registry)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            self.assertEqual(response.read().decode(),
+                             self.registry.expose())
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "bcl_manager.prom")
+            metrics.write_textfile(path, self.registry)
+            with open(path) as f:
+                self.assertIn('stage_bytes_total{stage="upload"} 7.0',
+                              f.read())
+            self.assertEqual(os.listdir(temp_dir), ["bcl_manager.prom"])
+
+
+class TestRunWatcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.watch_dir = self.temp_dir.name
+        self.handler = Mock()
+        self.reported = threading.Event()
+        self.handler.on_created.side_effect = \
+            lambda event: self.reported.set()
+
+    def write_run(self, name):
+        run = os.path.join(self.watch_dir, name)
+        os.makedirs(os.path.join(run, "Data", "Intensities", "L001"))
+        for i in range(10):
+            pathlib.Path(run, "Data", "Intensities", "L001",
+                         f"{i}.cbcl").touch()
+        pathlib.Path(run, "CopyComplete.txt").touch()
+        return run
+
+    def assertReported(self, runs):
+        self.assertCountEqual(
+            [args[0].src_path for args, _ in
+             self.handler.on_created.call_args_list],
+            [os.path.join(run, "CopyComplete.txt") for run in runs])
+
+    def test_watch_runs(self):
+        """
+            Only the CopyComplete file of each new run is reported, and
+            runs that were complete on start up are left to the catch up
+        """
+        complete = self.write_run("run_1")
+        os.makedirs(os.path.join(self.watch_dir, "run_2"))
+
+        observer = Observer()
+        watcher = RunWatcher(self.handler, self.watch_dir, observer=observer)
+        watcher.start()
+        observer.start()
+        self.addCleanup(observer.join)
+        self.addCleanup(observer.stop)
+        self.assertEqual(list(watcher.runs),
+                         [os.path.join(self.watch_dir, "run_2")])
+
+        pathlib.Path(self.watch_dir, "run_2", "CopyComplete.txt").touch()
+        self.assertTrue(self.reported.wait(5))
+        self.reported.clear()
+        run_3 = self.write_run("run_3")
+        self.assertTrue(self.reported.wait(5))
+
+        self.assertReported([os.path.join(self.watch_dir, "run_2"), run_3])
+        self.assertNotIn(complete, watcher.runs)
+        # Finished runs are no longer watched
+        self.assertEqual(watcher.runs, {})
+
+    def test_poll(self):
+        """
+            Polling reports each complete run once
+        """
+        self.write_run("run_1")
+        watcher = RunWatcher(self.handler, self.watch_dir)
+        watcher.start()
+        run_2 = self.write_run("run_2")
+        os.makedirs(os.path.join(self.watch_dir, "run_3"))
+        watcher.poll()
+        watcher.poll()
+        self.assertReported([run_2])
+
+    def test_start_after_catch_up(self):
+        """
+            Runs completing after the catch up's scan are reported
+        """
+        run_1 = self.write_run("run_1")
+        complete = bcl_manager.find_complete_runs(self.watch_dir)
+        run_2 = self.write_run("run_2")
+        watcher = RunWatcher(self.handler, self.watch_dir)
+        watcher.start(complete)
+        watcher.poll()
+        self.assertReported([run_2])
+        self.assertIn(run_1, watcher.reported)
+
+    def recreate_copy_complete(self, run):
+        # Renamed into place with a new mtime, so the change is seen
+        # even if the inode is reused
+        path = os.path.join(run, "CopyComplete.txt")
+        mtime = os.stat(path).st_mtime_ns
+        os.remove(path)
+        temp = os.path.join(run, "CopyComplete.tmp")
+        pathlib.Path(temp).touch()
+        os.utime(temp, ns=(mtime + 10**9, mtime + 10**9))
+        os.rename(temp, path)
+
+    def test_rearm_after_failure(self):
+        """
+            A failed run is reported again once its CopyComplete file is
+            re-created, whether watched or polled
+        """
+        os.makedirs(os.path.join(self.watch_dir, "run_1"))
+        observer = Observer()
+        watcher = RunWatcher(self.handler, self.watch_dir, observer=observer)
+        watcher.start()
+        observer.start()
+        self.addCleanup(observer.join)
+        self.addCleanup(observer.stop)
+        run_1 = os.path.join(self.watch_dir, "run_1")
+        pathlib.Path(run_1, "CopyComplete.txt").touch()
+        self.assertTrue(self.reported.wait(5))
+        self.reported.clear()
+
+        watcher.rearm(run_1 + "/")
+        self.assertIn(run_1, watcher.runs)
+        watcher.poll()
+        self.assertReported([run_1])
+
+        self.recreate_copy_complete(run_1)
+        self.assertTrue(self.reported.wait(5))
+        self.assertReported([run_1, run_1])
+        self.assertEqual(watcher.runs, {})
+
+        # Without an observer, polling sees the new file
+        poller = RunWatcher(self.handler, self.watch_dir)
+        poller.start()
+        poller.rearm(run_1)
+        poller.poll()
+        self.assertReported([run_1, run_1])
+        self.recreate_copy_complete(run_1)
+        poller.poll()
+        self.assertReported([run_1, run_1, run_1])
+
+
+class TestThrottle(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def test_token_bucket(self):
+        """
+            Bursts pass straight through, then callers wait for tokens
+        """
+        bucket = TokenBucket(rate=10000)
+        self.assertEqual(bucket.consume(10000), 0)
+        self.assertAlmostEqual(bucket.consume(2000), 0.2, delta=0.1)
+        self.assertEqual(TokenBucket().consume(10**9), 0)
+
+        # Lifting the limit releases a waiting caller
+        bucket.consume(10000)
+        waiter = threading.Thread(target=bucket.consume, args=(100000,))
+        waiter.start()
+        time.sleep(0.1)
+        bucket.set_rate(None)
+        waiter.join(2)
+        self.assertFalse(waiter.is_alive())
+
+    def test_schedule(self):
+        """
+            Limits are lifted during full speed hours and reduced while
+            runs are being sequenced
+        """
+        watch_dir = self.temp_dir.name
+        run = os.path.join(watch_dir, "220401_NB501786_0396_AHKGT5AFX3")
+        os.makedirs(run)
+        # Abandoned run
+        abandoned = os.path.join(watch_dir, "220101_NB501786_0300_AHKGT5AFX3")
+        os.makedirs(abandoned)
+        os.utime(abandoned, (0, 0))
+
+        limit = Throttle(1000, parse_hours("22-6"), 0.5, watch_dir)
+        self.assertEqual(limit.scheduled_rate(datetime(2022, 4, 1, 23)),
+                         (None, 0))
+        self.assertEqual(limit.scheduled_rate(datetime(2022, 4, 1, 5)),
+                         (None, 0))
+        self.assertEqual(limit.scheduled_rate(datetime(2022, 4, 1, 12)),
+                         (500, 1))
+        pathlib.Path(run, "CopyComplete.txt").touch()
+        limit.update(datetime(2022, 4, 1, 12))
+        self.assertEqual(limit.rate, 1000)
+
+        self.assertEqual(Throttle(None, None, 0.5, watch_dir).consume(10), 0)
+        with self.assertRaises(Exception):
+            parse_hours("22:00-06:00")
+
+    def test_throttled_copy(self):
+        """
+            The backup copy threads share the limit
+        """
+        src = os.path.join(self.temp_dir.name, "src")
+        os.makedirs(src)
+        for i in range(3):
+            with open(os.path.join(src, f"{i}.cbcl"), "wb") as f:
+                f.write(os.urandom(400000))
+
+        bucket = TokenBucket(rate=1000000)
+        dest = os.path.join(self.temp_dir.name, "dest")
+        backup.copy_tree(src, dest, threads=3, throttle=bucket)
+        self.assertGreater(bucket.waited, 0.1)
+        for i in range(3):
+            with open(os.path.join(src, f"{i}.cbcl"), "rb") as f, \
+                    open(os.path.join(dest, f"{i}.cbcl"), "rb") as g:
+                self.assertEqual(f.read(), g.read())
+
+        bucket = TokenBucket(rate=1000000)
+        backup.archive_tree(src, os.path.join(self.temp_dir.name, "archive"),
+                            throttle=bucket)
+        self.assertGreater(bucket.waited, 0.1)
+
+
+class TestFastqQC(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def write_fastq(self, name, records, trailing_newline=True):
+        path = os.path.join(self.temp_dir.name, name)
+        text = "".join(f"@read{i}\n{read}\n+\n{quality}\n"
+                       for i, (read, quality) in enumerate(records))
+        if not trailing_newline:
+            text = text[:-1]
+        with gzip.open(path, "wt") as f:
+            f.write(text)
+        return path
+
+    def test_fastq_stats(self):
+        """
+            Records split across chunks are counted once
+        """
+        records = [("ACGTACGTAC", "FFFFF:::##"), ("ACG", "F,#")] * 50
+        path = self.write_fastq("a_S1_L001_R1_001.fastq.gz", records, False)
+        expected = {"reads": 100, "bases": 650,
+                    "quality_sum": 50 * (5*37 + 3*25 + 2*2 + 37 + 11 + 2),
+                    "q30_bases": 50 * 6}
+        for chunk_size in [7, 64, 1024**2]:
+            self.assertEqual(fastq_qc.fastq_stats(path, chunk_size),
+                             expected)
+
+        truncated = self.write_fastq("b.fastq.gz", records)
+        with gzip.open(truncated, "ab") as f:
+            f.write(b"@read\nACGT\n")
+        with self.assertRaises(Exception):
+            fastq_qc.fastq_stats(truncated)
+
+    def test_project_stats(self):
+        """
+            Reads are counted once per pair, over every lane, and index
+            reads are left out of the sample statistics
+        """
+        paths = [self.write_fastq(f"s{sample}_S{sample}_L00{lane}_{read}"
+                                  "_001.fastq.gz", [("ACGT", "FFFF")] * lane)
+                 for sample in [1, 2] for lane in [1, 2]
+                 for read in ["R1", "R2", "I1"]]
+        for processes in [1, 2]:
+            summary, samples = fastq_qc.project_stats(paths, processes)
+            self.assertEqual(summary, {"reads": 6, "bases": 48, "samples": 2,
+                                       "mean_quality": 37.0,
+                                       "q30_fraction": 1.0})
+            self.assertEqual(samples["samples"]["s1"]["reads"], 3)
+            self.assertEqual(samples["samples"]["s2"]["bases"], 24)
+            self.assertEqual(len(samples["files"]), 12)
+
+
+class TestDeletion(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def make_tree(self, name):
+        root = os.path.join(self.temp_dir.name, name)
+        for lane in range(3):
+            for cycle in range(4):
+                directory = os.path.join(root, "Data", f"L00{lane}",
+                                         f"C{cycle}.1")
+                os.makedirs(directory)
+                with open(os.path.join(directory, "a.cbcl"), "wb") as f:
+                    f.write(b"0" * 10)
+        pathlib.Path(root, "CopyComplete.txt").touch()
+        os.symlink(os.path.join(root, "Data"), os.path.join(root, "link"))
+        return root
+
+    def test_delete_tree(self):
+        """
+            Every file is deleted, symbolic links are not followed, and
+            the files and bytes are counted
+        """
+        root = self.make_tree("run")
+        with concurrent.futures.ThreadPoolExecutor(3) as pool:
+            stats = deletion.delete_tree(root, pool, TokenBucket(1000))
+        self.assertEqual(stats["files"], 14)
+        self.assertEqual(stats["bytes"], 120 + len(os.path.join(root, "Data")))
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_deleter(self):
+        """
+            Trees are moved to the trash at once and deleted in the
+            background on lowered priority threads
+        """
+        root = self.make_tree("run")
+        deleter = deletion.Deleter(threads=2, nice=5, io_class=None)
+        self.addCleanup(deleter.shutdown)
+        priorities = []
+        deleter.pool.submit(lambda: priorities.append(
+            os.getpriority(os.PRIO_PROCESS, threading.get_native_id()))
+            ).result()
+        self.assertEqual(priorities, [max(5, os.getpriority(
+            os.PRIO_PROCESS, 0))])
+
+        with patch("deletion.delete_tree",
+                   wraps=deletion.delete_tree) as delete_tree:
+            trash = deleter.remove(root)
+            self.assertFalse(os.path.exists(root))
+            self.assertEqual(os.path.dirname(trash),
+                             os.path.join(self.temp_dir.name,
+                                          deletion.TRASH_DIR))
+            deleter.wait()
+        delete_tree.assert_called_once()
+        self.assertFalse(os.path.exists(trash))
+
+        # Failures are logged and left in the trash
+        with patch("deletion.delete_tree", side_effect=OSError("busy")):
+            trash = deleter.remove(self.make_tree("run_2"))
+            deleter.wait()
+        self.assertTrue(os.path.exists(trash))
+        self.assertEqual(deleter.resume([self.temp_dir.name]), 1)
+        deleter.wait()
+        self.assertEqual(os.listdir(os.path.join(self.temp_dir.name,
+                                                 deletion.TRASH_DIR)), [])
+
+
+class TestRecompress(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def write_fastq(self, name, data, level=1):
+        path = os.path.join(self.temp_dir.name, name)
+        with gzip.open(path, "wb", compresslevel=level) as f:
+            f.write(data)
+        return path
+
+    def test_recompress_file(self):
+        """
+            Fastq is rewritten as valid BGZF blocks with the same data,
+            and files already BGZF are left alone
+        """
+        data = benchmark.fastq_block(256 * 1024)
+        path = self.write_fastq("a_S1_R1_001.fastq.gz", data)
+        size = os.path.getsize(path)
+        result = recompress.recompress_file(path, 6)
+        self.assertTrue(result["replaced"])
+        self.assertEqual(result["reads"], data.count(b"\n") // 4)
+        self.assertEqual(result["bytes_in"], size)
+        self.assertEqual(result["bytes_out"], os.path.getsize(path))
+        self.assertLess(result["bytes_out"], size)
+        self.assertEqual(os.listdir(self.temp_dir.name),
+                         ["a_S1_R1_001.fastq.gz"])
+        with gzip.open(path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        # Every block has a BGZF header giving its size, and at most
+        # BLOCK_SIZE bytes of data
+        with open(path, "rb") as f:
+            body = f.read()
+        offset = 0
+        blocks = []
+        while offset < len(body):
+            self.assertEqual(body[offset:offset + 16], recompress.BGZF_HEADER)
+            block_size = int.from_bytes(body[offset + 16:offset + 18],
+                                        "little") + 1
+            blocks.append(body[offset:offset + block_size])
+            offset += block_size
+        self.assertEqual(offset, len(body))
+        self.assertEqual(blocks[-1], recompress.BGZF_EOF)
+        self.assertEqual(len(blocks) - 1,
+                         -(-len(data) // recompress.BLOCK_SIZE))
+
+        result = recompress.recompress_file(path, 6)
+        self.assertFalse(result["replaced"])
+        self.assertIsNone(result["reads"])
+
+    def test_recompress_checks(self):
+        """
+            Originals are kept if the recompressed file differs or is
+            not smaller
+        """
+        data = benchmark.fastq_block(64 * 1024)
+        path = self.write_fastq("a.fastq.gz", data, level=9)
+        with open(path, "rb") as f:
+            original = f.read()
+
+        with patch("recompress.read_summary", return_value=(0, 0, 0)):
+            with self.assertRaises(Exception):
+                recompress.recompress_file(path, 6)
+        result = recompress.recompress_file(path, 1)
+        self.assertFalse(result["replaced"])
+        self.assertEqual(result["reads"], data.count(b"\n") // 4)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), original)
+        self.assertEqual(os.listdir(self.temp_dir.name), ["a.fastq.gz"])
+
+    def test_recompress_files(self):
+        """
+            Files are recompressed in parallel and the savings summed
+        """
+        data = benchmark.fastq_block(128 * 1024)
+        paths = [self.write_fastq(f"{name}.fastq.gz", data)
+                 for name in ["a", "b", "c"]]
+        size = sum(os.path.getsize(path) for path in paths)
+        summary = recompress.recompress_files(paths, 6, processes=2)
+        self.assertEqual(summary["files"], 3)
+        self.assertEqual(summary["replaced"], 3)
+        self.assertEqual(summary["reads"], 3 * (data.count(b"\n") // 4))
+        self.assertEqual(summary["bytes_in"], size)
+        self.assertEqual(summary["bytes_out"],
+                         sum(os.path.getsize(path) for path in paths))
+        self.assertTrue(all(recompress.is_bgzf(path) for path in paths))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark(self):
+        """
+            A small benchmark processes every plate end to end
+        """
+        patcher = patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(utils.clear_s3_clients)
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+
+        with mock_aws():
+            results = benchmark.run_benchmark(
+                work_dir.name, plates=2, projects=["FZ2000", "FZ2001"],
+                files=4, file_size=1024, fastq_bytes=1024)
+
+        self.assertEqual(benchmark.read_samples(os.path.join(
+            work_dir.name, "backup", sorted(os.listdir(os.path.join(
+                work_dir.name, "backup")))[0], "SampleSheet.csv")),
+            [("FZ2000-0-S0", "FZ2000"), ("FZ2001-0-S1", "FZ2001")])
+        for stage in ["copy", "convert", "upload", "batch_submit"]:
+            self.assertEqual(results["stages"][stage]["runs"], 2)
+            self.assertEqual(results["stages"][stage]["failures"], 0)
+        self.assertGreater(results["plates_per_hour"], 0)
+        self.assertTrue(benchmark.compare(results, results))
+
+
 if __name__ == '__main__':
     unittest.main()
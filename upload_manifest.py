@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import threading
+
+import utils
+
+"""
+upload_manifest.py makes fastq uploads resumable and idempotent.
+
+Each plate keeps a local manifest of the S3 objects it uploaded: their
+key, size and ETag, and the size and modification time of the local file
+they were uploaded from. A retry lists what is already in S3 and only
+uploads files that are missing or differ. Objects that differ from the
+local files under a prefix this plate has not claimed belong to another
+run, and are never replaced.
+"""
+
+# Name of the manifest in the fastq directory of a plate
+MANIFEST = 'upload-manifest.json'
+
+# Written by the upload itself, so never a conflict
+IGNORED_KEYS = ['meta.json', 'fastq-stats.json']
+
+
+class UploadManifest:
+    """
+        Local record of a plate's uploads, saved as JSON at 'path':
+        {
+            "claimed": [S3 prefixes this plate uploads to],
+            "files": {key: {"path": str, "size": int, "mtime": float,
+                            "etag": str}}
+        }
+        A manifest may be shared by concurrent uploads of a plate's
+        projects
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.claimed = set()
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            self.claimed = set(manifest["claimed"])
+            self.files = manifest["files"]
+
+    def save(self):
+        """
+            Writes the manifest atomically
+        """
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump({"claimed": sorted(self.claimed),
+                           "files": self.files}, f, indent=4)
+            os.replace(temp_path, self.path)
+
+    def claim(self, prefix):
+        with self.lock:
+            self.claimed.add(prefix)
+
+    def record(self, path, key, etag):
+        stat = os.stat(path)
+        with self.lock:
+            self.files[key] = {"path": path, "size": stat.st_size,
+                               "mtime": stat.st_mtime, "etag": etag}
+
+    def uploaded(self, path, key, remote):
+        """
+            Returns True if the manifest records that the local file, as
+            it is now, was uploaded to key and is the remote object
+        """
+        with self.lock:
+            entry = self.files.get(key)
+        if entry is None or remote is None:
+            return False
+        stat = os.stat(path)
+        return entry["path"] == path and entry["size"] == stat.st_size \
+            and entry["mtime"] == stat.st_mtime \
+            and entry["etag"] == remote["etag"] \
+            and entry["size"] == remote["size"]
+
+
+def plan_upload(files, remote, manifest, etag):
+    """
+        Decides which files to upload.
+
+        files: list of (path, key) tuples, all under one S3 prefix
+        remote: s3_list_objects of that prefix
+        manifest: UploadManifest of the plate
+        etag: function returning the S3 ETag of a local path
+
+        Returns (to_upload, unchanged) lists of (path, key). Raises an
+        exception if the prefix has not been claimed by this plate and
+        holds objects that differ from the local files, i.e. another
+        run's data
+    """
+    prefix = os.path.dirname(files[0][1]) + '/'
+    with manifest.lock:
+        claimed = prefix in manifest.claimed
+    to_upload = []
+    unchanged = []
+    for path, key in files:
+        obj = remote.get(key)
+        if obj is None:
+            to_upload.append((path, key))
+        elif manifest.uploaded(path, key, obj):
+            unchanged.append((path, key))
+        elif obj["size"] == os.path.getsize(path) and \
+                etag(path) == obj["etag"]:
+            # Identical content, e.g. uploaded before the manifest was
+            # saved
+            manifest.record(path, key, obj["etag"])
+            unchanged.append((path, key))
+        elif claimed:
+            to_upload.append((path, key))
+        else:
+            raise Exception(f"S3 key {key} differs from {path}, another "
+                            "run may have been uploaded to the same run id")
+
+    if not claimed:
+        ours = {key for _, key in files} | \
+            {prefix + name for name in IGNORED_KEYS}
+        others = sorted(set(remote) - ours)
+        if others:
+            raise Exception(f"S3 key {others[0]} is not part of this run, "
+                            "another run may have been uploaded to the "
+                            "same run id")
+    return to_upload, unchanged
+
+
+def upload_files(files, bucket, s3_endpoint_url, manifest,
+                 **transfer_options):
+    """
+        Uploads (path, key) files to the S3 bucket, skipping those
+        already there according to the UploadManifest or their ETag.
+        Files are grouped by prefix (S3 "directory"), and each prefix is
+        claimed in the manifest before it is uploaded to. Every file is
+        then checked to be on S3 with the right size.
+
+        transfer_options are passed on to utils.s3_upload_files. Returns
+        the results of utils.s3_upload_files for the files uploaded
+    """
+    part_size = transfer_options.get("part_size", 64*1024**2)
+    threshold = transfer_options.get("multipart_threshold", 64*1024**2)
+
+    prefixes = {}
+    for path, key in files:
+        prefixes.setdefault(os.path.dirname(key) + '/', []).append((path, key))
+
+    to_upload = []
+    unchanged = 0
+    for prefix, prefix_files in sorted(prefixes.items()):
+        remote = utils.s3_list_objects(bucket, prefix, s3_endpoint_url)
+        upload, skipped = plan_upload(
+            prefix_files, remote, manifest,
+            lambda path: utils.s3_etag(path, part_size, threshold))
+        to_upload.extend(upload)
+        unchanged += len(skipped)
+        manifest.claim(prefix)
+    manifest.save()
+
+    logging.info(f"Uploading {len(to_upload)} files to s3://{bucket}, "
+                 f"{unchanged} already uploaded")
+    results = []
+    if to_upload:
+        results = utils.s3_upload_files(to_upload, bucket, s3_endpoint_url,
+                                        overwrite=True, **transfer_options)
+
+    # Record what S3 now holds, and check every file made it
+    uploaded = set(to_upload)
+    for prefix, prefix_files in sorted(prefixes.items()):
+        remote = utils.s3_list_objects(bucket, prefix, s3_endpoint_url)
+        for path, key in prefix_files:
+            obj = remote.get(key)
+            if obj is None or obj["size"] != os.path.getsize(path):
+                raise Exception(f"s3://{bucket}/{key} is missing or does "
+                                f"not match {path}")
+            if (path, key) in uploaded:
+                manifest.record(path, key, obj["etag"])
+    manifest.save()
+    return results
@@ -1,10 +1,98 @@
+import concurrent.futures
+import hashlib
+import importlib
 import json
-import subprocess
-import contextlib
-from os import devnull
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
 
-import boto3
-import botocore
+
+class LazyModule:
+    """
+        Stands in for a module that is slow to import, e.g. boto3, and
+        imports it (and the given submodules) the first time one of its
+        attributes is used. Commands that never touch S3 then start
+        without paying for it
+    """
+    def __init__(self, name, *submodules):
+        self.name = name
+        self.submodules = submodules
+        self.module = None
+        self.lock = threading.Lock()
+
+    def __getattr__(self, attribute):
+        # Only called for attributes not set in __init__
+        with self.lock:
+            if self.module is None:
+                module = importlib.import_module(self.name)
+                for submodule in self.submodules:
+                    importlib.import_module(f"{self.name}.{submodule}")
+                self.module = module
+        return getattr(self.module, attribute)
+
+
+def map_processes(function, items, processes=1):
+    """
+        Returns [function(item) for item in items], computed in up to
+        'processes' processes. bcl_manager is multithreaded, which fork
+        does not support, so the processes are started from a fork
+        server. The first failure is raised once every item has
+        finished
+    """
+    if processes > 1 and len(items) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+                min(processes, len(items)),
+                mp_context=multiprocessing.get_context("forkserver")) as pool:
+            futures = [pool.submit(function, item) for item in items]
+        return [future.result() for future in futures]
+    return [function(item) for item in items]
+
+
+boto3 = LazyModule("boto3", "session", "s3.transfer")
+botocore = LazyModule("botocore", "config", "exceptions")
+
+# Connections each cached client keeps open for concurrent requests
+MAX_POOL_CONNECTIONS = 32
+
+# Cached S3 clients, keyed by (profile, s3_endpoint_url)
+s3_clients = {}
+s3_clients_lock = threading.Lock()
+
+# Number of clients constructed for each (profile, s3_endpoint_url)
+client_construction_counts = Counter()
+
+
+def s3_client(s3_endpoint_url=None, profile=None):
+    """
+        Returns an S3 client for the aws profile and endpoint url.
+
+        Clients are cached and shared between threads, so their
+        connection pools are reused. Each client is made from its own
+        boto3 Session, so the global default session is never changed.
+        profile=None uses the default credentials.
+    """
+    cache_key = (profile, s3_endpoint_url)
+    with s3_clients_lock:
+        if cache_key not in s3_clients:
+            session = boto3.session.Session(profile_name=profile)
+            s3_clients[cache_key] = session.client(
+                's3', endpoint_url=s3_endpoint_url,
+                config=botocore.config.Config(
+                    max_pool_connections=MAX_POOL_CONNECTIONS))
+            client_construction_counts[cache_key] += 1
+        return s3_clients[cache_key]
+
+
+def clear_s3_clients():
+    """
+        Drops all cached S3 clients and their construction counts
+    """
+    with s3_clients_lock:
+        s3_clients.clear()
+        client_construction_counts.clear()
 
 
 def s3_object_exists(bucket, key, s3_endpoint_url):
@@ -15,10 +103,8 @@ def s3_object_exists(bucket, key, s3_endpoint_url):
 
     key_exists = True
 
-    s3 = boto3.resource('s3', endpoint_url=s3_endpoint_url)
-
     try:
-        s3.Object(bucket, key).load()
+        s3_client(s3_endpoint_url).head_object(Bucket=bucket, Key=key)
 
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
@@ -32,29 +118,167 @@ def s3_object_exists(bucket, key, s3_endpoint_url):
     return key_exists
 
 
-def s3_sync(src_dir, bucket, key, s3_endpoint_url):
+def s3_list_keys(bucket, prefix, s3_endpoint_url):
     """
-        Upload src_dir to s3://{bucket}/{key}
+        Returns a dictionary of key: size for every object under the
+        prefix in the S3 bucket
     """
-    target_uri = f's3://{bucket}/{key}'
+    return {key: obj["size"] for key, obj in
+            s3_list_objects(bucket, prefix, s3_endpoint_url).items()}
+
+
+def s3_list_objects(bucket, prefix, s3_endpoint_url):
+    """
+        Returns a dictionary of key: {"size": int, "etag": str} for every
+        object under the prefix in the S3 bucket
+    """
+    s3 = s3_client(s3_endpoint_url)
+    objects = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket,
+                                                             Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = {"size": obj['Size'],
+                                   "etag": obj['ETag'].strip('"')}
+    return objects
+
 
+def s3_etag(path, part_size=64*1024**2, multipart_threshold=64*1024**2):
+    """
+        Returns the ETag S3 gives a file uploaded by s3_upload_files with
+        the same part_size and multipart_threshold: the md5 of the file,
+        or for multipart uploads the md5 of the md5 of each part followed
+        by the number of parts. Not valid for SSE-KMS encrypted objects
+    """
+    size = os.path.getsize(path)
+    if size < multipart_threshold:
+        part_size = max(size, 1)
+    else:
+        # The transfer manager grows parts to stay within S3's limits
+        from s3transfer.utils import ChunksizeAdjuster
+        part_size = ChunksizeAdjuster().adjust_chunksize(part_size, size)
+
+    digests = []
+    with open(path, 'rb') as f:
+        while True:
+            part = f.read(part_size)
+            if not part and digests:
+                break
+            digests.append(hashlib.md5(part).digest())
+            if len(part) < part_size:
+                break
+
+    if size < multipart_threshold:
+        return digests[0].hex()
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+class TransferTimer:
+    """
+        Records when the transfer of a single file starts and finishes.
+        Subscribers only need the callbacks they use, so s3transfer's
+        BaseSubscriber is not imported
+    """
+    def __init__(self):
+        self.start = None
+        self.end = None
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        if self.start is None:
+            self.start = time.time()
+
+    def on_done(self, future, **kwargs):
+        self.end = time.time()
+        if self.start is None:
+            self.start = self.end
+
+
+class ThrottleSubscriber:
+    """
+        Rate limits a transfer: the transfer thread that sent the bytes
+        waits on a throttle.TokenBucket shared by every transfer
+    """
+    def __init__(self, throttle):
+        self.throttle = throttle
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        # Retries report negative progress
+        if bytes_transferred > 0:
+            self.throttle.consume(bytes_transferred)
+
+
+def s3_upload_files(files, bucket, s3_endpoint_url, threads=8,
+                    part_size=64*1024**2, multipart_threshold=64*1024**2,
+                    overwrite=False, throttle=None):
+    """
+        Uploads local files to S3 in parallel using a single boto3
+        transfer manager, so parts of every file share one pool of
+        threads. Unless overwrite is set, existing keys are never
+        overwritten: nothing is uploaded if any target key already
+        exists.
+
+        Parameters:
+            files (list): (path, key) tuples of local files and their
+                          S3 keys
+            bucket (str): S3 bucket name
+            s3_endpoint_url (str): the s3 endpoint url
+            threads (int): number of concurrent part uploads
+            part_size (int): size in bytes of each multipart part
+            multipart_threshold (int): files of at least this many bytes
+                                       are uploaded in parts
+            overwrite (bool): replace existing keys
+            throttle (throttle.TokenBucket): limits the upload bandwidth
+
+        Returns a list with a dictionary for each file:
+            {"path": str, "key": str, "bytes": int, "seconds": float}
+    """
     # Don't overwrite
-    if s3_object_exists(bucket, key, s3_endpoint_url):
-        raise Exception(f'{target_uri} already exists')
+    if not overwrite:
+        prefixes = {os.path.dirname(key) + '/' for _, key in files}
+        existing = set()
+        for prefix in prefixes:
+            existing.update(s3_list_keys(bucket, prefix, s3_endpoint_url))
+        clashes = sorted(existing.intersection(key for _, key in files))
+        if clashes:
+            raise Exception(f's3://{bucket}/{clashes[0]} already exists')
+
+    s3 = s3_client(s3_endpoint_url)
+    config = boto3.s3.transfer.TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=part_size,
+        max_concurrency=threads)
 
-    # Sync
-    return_code = subprocess.run([
-        "aws", "s3",
-        "--endpoint-url", s3_endpoint_url,
-        "sync", src_dir, target_uri
-    ]).returncode
+    start = time.time()
+    transfers = []
+    with boto3.s3.transfer.create_transfer_manager(s3, config) as manager:
+        for path, key in files:
+            timer = TransferTimer()
+            subscribers = [timer]
+            if throttle is not None:
+                subscribers.append(ThrottleSubscriber(throttle))
+            future = manager.upload(path, bucket, key,
+                                    subscribers=subscribers)
+            transfers.append((path, key, timer, future))
 
-    if return_code:
-        raise Exception('aws s3 sync failed: %s' % (return_code))
+        # Raise the first failure, the transfer manager cancels the rest
+        for _, _, _, future in transfers:
+            future.result()
+
+    results = [{"path": path,
+                "key": key,
+                "bytes": os.path.getsize(path),
+                "seconds": timer.end - timer.start}
+               for path, key, timer, _ in transfers]
+
+    total_bytes = sum(result["bytes"] for result in results)
+    seconds = time.time() - start
+    logging.info(f"Uploaded {len(results)} files ({total_bytes / 1024**2:.1f}"
+                 f" Mb) to s3://{bucket} in {seconds:.1f}s "
+                 f"({total_bytes / 1024**2 / max(seconds, 1e-6):.1f} Mb/s)")
+    return results
 
 
 def upload_json(bucket, key, s3_endpoint_url, dictionary,
-                profile='default', indent=4):
+                profile=None, indent=4):
     """
         Upload json data to s3
 
@@ -62,17 +286,13 @@ def upload_json(bucket, key, s3_endpoint_url, dictionary,
         key: S3 key the json file is stored under
         dictionary: json serialisable python dictionary for S3 upload
         endpoint_url: S3 endpoint url
+        profile: aws profile to upload with (default credentials if None)
         indent: Number of indentation spaces in the json
     """
-    # set the aws profile
-    boto3.setup_default_session(profile_name=profile)
-    s3 = boto3.resource('s3', endpoint_url=s3_endpoint_url)
-    obj = s3.Object(bucket, key)
-
-    obj.put(Body=(bytes(json.dumps(dictionary, indent=indent).encode('UTF-8'))),
-            ACL="bucket-owner-full-control")
-    # reset the aws profile
-    boto3.setup_default_session(profile_name='default')
+    s3_client(s3_endpoint_url, profile).put_object(
+        Bucket=bucket, Key=key,
+        Body=(bytes(json.dumps(dictionary, indent=indent).encode('UTF-8'))),
+        ACL="bucket-owner-full-control")
 
 
 def s3_download_file(bucket, key, dest, s3_endpoint_url):
@@ -81,7 +301,6 @@ def s3_download_file(bucket, key, dest, s3_endpoint_url):
         path (string)
     """
     if s3_object_exists(bucket, key, s3_endpoint_url):
-        s3 = boto3.client('s3')
-        s3.download_file(bucket, key, dest)
+        s3_client(s3_endpoint_url).download_file(bucket, key, dest)
     else:
         raise Exception(f'{key} not found in {bucket}')